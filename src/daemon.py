@@ -6,6 +6,7 @@ import logging
 import os
 import sys
 import signal
+import threading
 import time
 import errno
 import atexit
@@ -40,6 +41,7 @@ class Daemon(object):  # pragma: no cover
                             filemode='a')
         self.log = logging.getLogger('DAEMON')
         self.shutdown_callback = None
+        self.reload_callback = None
 
     def register_shutdown_callback(self, callback):
         """
@@ -47,6 +49,13 @@ class Daemon(object):  # pragma: no cover
         """
         self.shutdown_callback = callback
 
+    def register_reload_callback(self, callback):
+        """
+        Register a callback to be executed when the daemon receives a SIGHUP
+        signal.
+        """
+        self.reload_callback = callback
+
     def start(self):
         """
         Start the daemon. Raises a DaemonError if it's already running.
@@ -57,6 +66,16 @@ class Daemon(object):  # pragma: no cover
             raise DaemonError("Already running")
         if not self.foreground:
             self._fork()
+        signal.signal(signal.SIGHUP, self._reload)
+
+    def reload(self):
+        """
+        Tell the running daemon to reload by sending it a SIGHUP signal.
+        Raises a DaemonError if the daemon is not running.
+        """
+        if not self.is_running():
+            raise DaemonError("Not running")
+        os.kill(self.get_pid(), signal.SIGHUP)
 
     def stop(self):
         """
@@ -160,6 +179,24 @@ class Daemon(object):  # pragma: no cover
 
         return pid
 
+    def _reload(self, sig, frame):  # pylint: disable=unused-argument
+        """
+        Call the registered reload callback. It's run in a separate thread,
+        so that it doesn't interrupt whatever the main thread is doing. That
+        includes logging, which can't be done from a signal handler.
+        """
+        thread = threading.Thread(target=self._run_reload, args=(sig,))
+        thread.daemon = True
+        thread.start()
+
+    def _run_reload(self, sig):
+        """
+        Log the reload signal `sig` and call the reload callback, if any.
+        """
+        self.log.info("Received signal %s", sig)
+        if self.reload_callback is not None:
+            self.reload_callback()
+
     def _cleanup(self, sig=None):
         """
         Remove pid files and call registered shutodnw callbacks.
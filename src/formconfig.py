@@ -8,6 +8,9 @@ import logging
 import stat
 import os
 
+from staticcache import StaticCache
+from userauth import AuthCache
+
 
 class FormConfigError(Exception):
     """
@@ -22,7 +25,15 @@ class FormConfig(object):
     form configuration being served by this instance of ScriptForm.
     """
     def __init__(self, title, forms, users=None, static_dir=None,
-                 custom_css=None):
+                 custom_css=None, max_concurrent=None, max_queued=None,
+                 queue_timeout=None, jobs_dir=None, jobs_workers=4,
+                 jobs_max_age=86400, jobs_max_count=100, external_css=False,
+                 max_request_size=None, max_field_size=1024 * 1024 * 10,
+                 max_file_size=None, static_cache_control='no-cache',
+                 static_cache_size=1024 * 1024 * 16,
+                 static_cache_max_file_size=1024 * 256, compress_level=6,
+                 compress_min_size=1024, session_lifetime=0,
+                 session_secret=None, auth_cache_ttl=300):
         self.title = title
         self.users = {}
         if users is not None:
@@ -30,13 +41,77 @@ class FormConfig(object):
         self.forms = forms
         self.static_dir = static_dir
         self.custom_css = custom_css
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.jobs_dir = jobs_dir
+        self.jobs_workers = jobs_workers
+        self.jobs_max_age = jobs_max_age
+        self.jobs_max_count = jobs_max_count
+        self.external_css = external_css
+        self.max_request_size = max_request_size
+        self.max_field_size = max_field_size
+        self.max_file_size = max_file_size
+        self.static_cache_control = static_cache_control
+        self.compress_level = compress_level
+        self.compress_min_size = compress_min_size
+        self.session_lifetime = session_lifetime
+        if session_secret is None:
+            session_secret = os.urandom(32)
+        elif not isinstance(session_secret, bytes):
+            session_secret = session_secret.encode('utf8')
+        self.session_secret = session_secret
+        # Verified passwords. Dropped on reload along with the users.
+        self.auth_cache = AuthCache(auth_cache_ttl)
+        # Rendered pages and parts of pages. A new FormConfig is created when
+        # the configuration is reloaded, so this never holds stale results.
+        self.render_cache = {}
+        # Small static files, which are likewise dropped on reload.
+        self.static_cache = None
+        if static_dir and static_cache_size:
+            self.static_cache = StaticCache(static_cache_size,
+                                            static_cache_max_file_size)
         self.log = logging.getLogger('FORMCONFIG')
 
+        self.forms_by_name = dict((form_def.name, form_def)
+                                  for form_def in self.forms)
+        self.public_forms, self.visible_forms = self._index_visible_forms()
+
         # Validate scripts
         for form_def in self.forms:
             if not stat.S_IXUSR & os.stat(form_def.script)[stat.ST_MODE]:
                 msg = "{0} is not executable".format(form_def.script)
                 raise FormConfigError(msg)
+            if form_def.run_async and form_def.output == 'raw':
+                msg = "Form '{0}' can't be async with raw output".format(
+                    form_def.name)
+                raise FormConfigError(msg)
+
+    def _index_visible_forms(self):
+        """
+        Determine which forms are shown in the list of forms. Returns the
+        list of forms visible to everybody, and a dict with the lists of forms
+        visible to each user that is named in a form's `allowed_users`. Other
+        users see only the forms that are visible to everybody.
+        """
+        public_forms = []
+        usernames = set()
+        for form_def in self.forms:
+            if form_def.allowed_users is None:
+                if not form_def.hidden:
+                    public_forms.append(form_def)
+            else:
+                usernames.update(form_def.allowed_users)
+
+        visible_forms = {}
+        for username in usernames:
+            visible_forms[username] = [
+                form_def for form_def in self.forms
+                if not form_def.hidden and
+                (form_def.allowed_users is None or
+                 username in form_def.allowed_users)
+            ]
+        return public_forms, visible_forms
 
     def get_form_def(self, form_name):
         """
@@ -44,24 +119,15 @@ class FormConfig(object):
         an instance of FormDefinition class or raises ValueError if the form
         was not found.
         """
-        for form_def in self.forms:
-            if form_def.name == form_name:
-                return form_def
-
-        raise ValueError("No such form: {0}".format(form_name))
+        try:
+            return self.forms_by_name[form_name]
+        except KeyError:
+            raise ValueError("No such form: {0}".format(form_name)) from None
 
     def get_visible_forms(self, username=None):
         """
         Return a list of all visible forms. Excluded forms are those that have
-        the 'hidden' property set, and where the user has no access to.
+        the 'hidden' property set, and where the user has no access to. The
+        list is shared, so it must not be modified.
         """
-        form_list = []
-        for form_def in self.forms:
-            if form_def.allowed_users is not None and \
-               username not in form_def.allowed_users:
-                continue  # User is not allowed to run this form
-            if form_def.hidden:
-                continue  # Don't show hidden forms in the list.
-            else:
-                form_list.append(form_def)
-        return form_list
+        return self.visible_forms.get(username, self.public_forms)
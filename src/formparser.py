@@ -0,0 +1,303 @@
+"""
+The formparser module parses form data submitted in the body of POST
+requests. Multipart form data is parsed as it's read, so uploaded files are
+written straight to their temporary file without being stored anywhere else
+first.
+"""
+
+import os
+import email.parser
+import email.utils
+import tempfile
+import urllib.parse
+
+
+READ_SIZE = 1024 * 256
+MAX_HEADER_SIZE = 1024 * 16
+
+
+class FormParseError(Exception):
+    """
+    Raised when submitted form data can't be parsed or is too large.
+    `status_code` is the HTTP status code that should be sent to the client.
+    """
+    def __init__(self, msg, status_code=400):
+        self.msg = msg
+        self.status_code = status_code
+        Exception.__init__(self, msg, status_code)
+
+
+class FormField(object):
+    """
+    A single field of submitted form data. For uploaded files, `filename` is
+    the name of the file on the client and `path` the temporary file it was
+    stored in. Otherwise `value` is the value of the field.
+    """
+    def __init__(self, name, value=None, filename=None, path=None):
+        self.name = name
+        self.value = value
+        self.filename = filename
+        self.path = path
+
+
+class FormData(object):
+    """
+    The fields of submitted form data. Iterating over it gives the names of
+    the fields. Temporary files of uploaded files are in `tmp_files`. They
+    are removed by cleanup(), unless they're taken out of `tmp_files` first.
+    """
+    def __init__(self):
+        self.fields = []
+        self.tmp_files = []
+
+    def add(self, field):
+        """
+        Add the FormField `field`.
+        """
+        self.fields.append(field)
+        if field.path is not None:
+            self.tmp_files.append(field.path)
+
+    def __iter__(self):
+        seen = set()
+        for field in self.fields:
+            if field.name not in seen:
+                seen.add(field.name)
+                yield field.name
+
+    def __contains__(self, name):
+        return any(field.name == name for field in self.fields)
+
+    def __getitem__(self, name):
+        for field in self.fields:
+            if field.name == name:
+                return field
+        raise KeyError(name)
+
+    def getfirst(self, name, default=None):
+        """
+        Return the value of the first field called `name`, or `default` if
+        there's no such field. For uploaded files, the contents of the file
+        are returned as bytes.
+        """
+        try:
+            field = self[name]
+        except KeyError:
+            return default
+        if field.path is not None:
+            with open(field.path, 'rb') as upload_file:
+                return upload_file.read()
+        return field.value
+
+    def cleanup(self):
+        """
+        Remove the temporary files of uploaded files.
+        """
+        for path in self.tmp_files:
+            if os.path.exists(path):
+                os.unlink(path)
+        self.tmp_files = []
+
+
+def parse_form(rfile, headers, max_request_size=None, max_field_size=None,
+               max_file_size=None):
+    """
+    Read and parse the form data from `rfile`, according to the request
+    `headers`. Returns a FormData. Exactly as many bytes as specified by the
+    Content-Length header are read.
+
+    Requests larger than `max_request_size`, uploaded files larger than
+    `max_file_size` and other fields larger than `max_field_size` are
+    rejected with a FormParseError as soon as they exceed the limit. A limit
+    of None means unlimited.
+    """
+    try:
+        length = int(headers.get('Content-Length', 0))
+    except ValueError:
+        raise FormParseError("Invalid Content-Length") from None
+    if max_request_size is not None and length > max_request_size:
+        raise FormParseError("Request too large", 413)
+
+    content_type = headers.get_content_type()
+    if content_type == 'multipart/form-data':
+        boundary = headers.get_param('boundary')
+        if not boundary:
+            raise FormParseError("Missing multipart boundary")
+        parser = MultipartParser(rfile, length, boundary, max_field_size,
+                                 max_file_size)
+        return parser.parse()
+
+    form_data = FormData()
+    body = b''
+    while len(body) < length:
+        data = rfile.read(length - len(body))
+        if not data:
+            raise FormParseError("Unexpected end of form data")
+        body += data
+    if content_type == 'application/x-www-form-urlencoded':
+        query = urllib.parse.parse_qsl(body.decode('utf8', 'replace'))
+        for name, value in query:
+            if max_field_size is not None and len(value) > max_field_size:
+                raise FormParseError("Form field too large", 413)
+            form_data.add(FormField(name, value))
+    return form_data
+
+
+class MultipartParser(object):
+    """
+    Parser for 'multipart/form-data' bodies of `length` bytes from `rfile`.
+    The body is read in blocks of READ_SIZE bytes. File parts are written to
+    temporary files and other parts are kept in memory.
+    """
+    def __init__(self, rfile, length, boundary, max_field_size=None,
+                 max_file_size=None):
+        self.rfile = rfile
+        self.remaining = length
+        # The CRLF in front of the delimiter belongs to the delimiter, so the
+        # first delimiter is found by pretending the body starts with one.
+        self.delimiter = b'\r\n--' + boundary.encode('latin1')
+        self.buf = bytearray(b'\r\n')
+        self.max_field_size = max_field_size
+        self.max_file_size = max_file_size
+
+    def _fill(self):
+        """
+        Read the next block of the body into the buffer. Raises a
+        FormParseError if the entire body has already been read.
+        """
+        if self.remaining <= 0:
+            raise FormParseError("Unexpected end of form data")
+        data = self.rfile.read(min(READ_SIZE, self.remaining))
+        if not data:
+            raise FormParseError("Unexpected end of form data")
+        self.remaining -= len(data)
+        self.buf += data
+
+    def _skip_rest(self):
+        """
+        Read and discard the rest of the body.
+        """
+        while self.remaining > 0:
+            data = self.rfile.read(min(READ_SIZE, self.remaining))
+            if not data:
+                break
+            self.remaining -= len(data)
+
+    def parse(self):
+        """
+        Parse the body and return a FormData. If parsing fails, the
+        temporary files that were already written are removed.
+        """
+        form_data = FormData()
+        try:
+            # Skip the preamble
+            self._read_until(self.delimiter, lambda data: None)
+            while True:
+                while len(self.buf) < 2:
+                    self._fill()
+                if self.buf[:2] == b'--':
+                    # Final delimiter. Ignore the epilogue.
+                    self._skip_rest()
+                    break
+                # The rest of the delimiter line is followed by the headers
+                # of the part.
+                header_end = self._find(b'\r\n\r\n', MAX_HEADER_SIZE)
+                header_lines = self.buf[:header_end + 4].split(b'\r\n', 1)
+                del self.buf[:header_end + 4]
+                part_headers = email.parser.HeaderParser().parsestr(
+                    header_lines[-1].decode('utf8', 'replace'))
+                self._read_part(part_headers, form_data)
+        except BaseException:
+            form_data.cleanup()
+            raise
+        return form_data
+
+    def _find(self, sep, max_size):
+        """
+        Read until `sep` is in the buffer and return its position. Raises a
+        FormParseError if it's not found in the first `max_size` bytes.
+        """
+        while True:
+            pos = self.buf.find(sep)
+            if pos >= 0:
+                return pos
+            if len(self.buf) > max_size:
+                raise FormParseError("Multipart headers too large")
+            self._fill()
+
+    def _read_part(self, part_headers, form_data):
+        """
+        Read the contents of the part with `part_headers` and add it to
+        `form_data`.
+        """
+        name = _get_param(part_headers, 'name')
+        filename = _get_param(part_headers, 'filename')
+        if name is None:
+            raise FormParseError("Multipart field without a name")
+
+        if filename is None:
+            value = bytearray()
+
+            def write(data):
+                """
+                Collect the value of the field.
+                """
+                value.extend(data)
+                if self.max_field_size is not None and \
+                   len(value) > self.max_field_size:
+                    raise FormParseError("Form field too large", 413)
+            self._read_until(self.delimiter, write)
+            form_data.add(FormField(name, value.decode('utf8', 'replace')))
+        elif filename == '':
+            # File field without a file.
+            self._read_until(self.delimiter, lambda data: None)
+            form_data.add(FormField(name, filename=filename))
+        else:
+            fd, path = tempfile.mkstemp(prefix='scriptform_')
+            # The script may run as another user, which must be able to read
+            # the file.
+            os.fchmod(fd, 0o644)
+            form_data.add(FormField(name, filename=filename, path=path))
+            with os.fdopen(fd, 'wb') as upload_file:
+                size = [0]
+
+                def write(data):
+                    """
+                    Write the uploaded file.
+                    """
+                    size[0] += len(data)
+                    if self.max_file_size is not None and \
+                       size[0] > self.max_file_size:
+                        raise FormParseError("Uploaded file too large", 413)
+                    upload_file.write(data)
+                self._read_until(self.delimiter, write)
+
+    def _read_until(self, sep, write):
+        """
+        Pass everything up to the separator `sep` to `write` and remove it
+        and the separator from the buffer.
+        """
+        while True:
+            pos = self.buf.find(sep)
+            if pos >= 0:
+                write(self.buf[:pos])
+                del self.buf[:pos + len(sep)]
+                return
+            # Keep enough of the buffer to find a separator that's split
+            # over two blocks.
+            keep = len(sep) - 1
+            if len(self.buf) > keep:
+                write(self.buf[:-keep])
+                del self.buf[:-keep]
+            self._fill()
+
+
+def _get_param(part_headers, param):
+    """
+    Return the parameter `param` of the Content-Disposition header in
+    `part_headers`, or None if it isn't there.
+    """
+    value = part_headers.get_param(param, header='content-disposition')
+    if value is None:
+        return None
+    return email.utils.collapse_rfc2231_value(value)
@@ -30,10 +30,16 @@ HTML_FIELD_CHECKBOX = u'''
 HTML_REQUIRED = u'{0} <abbr title="This field is required" \
                 u"class="required">•</span>'
 
+# Marks the dynamic parts of a compiled field. See FormRender.compile_field().
+SLOT = u'\x00'
+
 
 class FormRender(object):
     """
-    FormRender takes care of the rendering of forms to HTML.
+    FormRender takes care of the rendering of forms to HTML. Fields are
+    compiled once into a list of static HTML fragments and slots for the
+    parts that depend on the submitted values, so that rendering a form is
+    mostly a matter of joining fragments.
     """
     field_tpl = {
         "string": u'<input {required} type="text" name="{name}" '
@@ -70,6 +76,192 @@ class FormRender(object):
 
     def __init__(self, form_def):
         self.form_def = form_def
+        self._plan = None
+
+    def render_fields(self, fields, form_values, errors, resolved):
+        """
+        Render `fields` to HTML, filled with `form_values` and showing
+        `errors` (a dict of lists of errors by field name). `resolved` is the
+        ResolvedForm that provides the options of dynamic radio and select
+        fields.
+        """
+        out = []
+        for field_name, render_cb in self.get_plan(fields):
+            render_cb(out, form_values, errors.get(field_name, []), resolved)
+        return u''.join(out)
+
+    def get_plan(self, fields):
+        """
+        Return the compiled `fields`. Like compiled validators, they are kept
+        for as long as the same list of fields is used.
+        """
+        compiled = self._plan
+        if compiled is None or compiled[0] is not fields:
+            compiled = (fields, self.compile_fields(fields))
+            self._plan = compiled
+        return compiled[1]
+
+    def compile_fields(self, fields):
+        """
+        Compile all `fields`. Returns a list of (field_name, render_cb)
+        tuples, where render_cb is called with a list to append the HTML
+        fragments to, the form values, the field's errors and the
+        ResolvedForm. Radio and select fields with dynamic options are
+        compiled each time they're rendered.
+        """
+        plan = []
+        for field in fields:
+            if 'options_from' in field:
+                plan.append((field['name'], self._compile_dynamic(field)))
+            else:
+                options = None
+                if field['type'] in ('radio', 'select'):
+                    options = self.form_def.get_options(field)
+                plan.append((field['name'],
+                             self.compile_field(field, options)))
+        return plan
+
+    def _compile_dynamic(self, field):
+        """
+        Return a render callback for a field with dynamic options, which
+        compiles the field with the options from the ResolvedForm.
+        """
+        def render_cb(out, form_values, errors, resolved):
+            """
+            Compile and render the field.
+            """
+            options = resolved.get_options(field)
+            self.compile_field(field, options)(out, form_values, errors,
+                                               resolved)
+        return render_cb
+
+    def compile_field(self, field, options=None):
+        """
+        Compile a single field definition (a line with the title and input).
+        The field is rendered once with slots in place of the values that
+        depend on the submitted form, and split into static fragments around
+        those slots. Returns a render callback as described in
+        compile_fields().
+        """
+        slots = []
+
+        def slot(kind, arg=None):
+            """
+            Return a marker for a dynamic part of the field.
+            """
+            slots.append((kind, arg))
+            return u'{0}{1}{0}'.format(SLOT, len(slots) - 1)
+
+        name = field['name']
+        field_type = field['type']
+        classes = []
+        if field.get('hidden', None):
+            classes.append('hidden')
+        if field.get('required', None):
+            classes.append('required')
+        classes.extend(field.get('classes', '').split())
+
+        params = {
+            'name': name,
+            'classes': ' '.join(classes),
+            'style': field.get('style', ''),
+        }
+        if field_type not in ('file', 'checkbox', 'radio', 'select'):
+            params['value'] = slot('value')
+        if field_type not in ('radio', 'checkbox', 'select'):
+            if field.get('required', False) is False:
+                params['required'] = ''
+            else:
+                params['required'] = 'required'
+        if field_type == 'string':
+            params['size'] = field.get('size', '')
+        if field_type in ('string', 'password', 'text'):
+            params['minlen'] = field.get('minlen', '')
+        if field_type in ('string', 'text'):
+            params['maxlen'] = field.get('maxlen', '')
+        if field_type in ('integer', 'float', 'date'):
+            params['minval'] = field.get('min', '')
+            params['maxval'] = field.get('max', '')
+        if field_type == 'date':
+            for param in ('minval', 'maxval'):
+                if params[param] == 'today':
+                    params[param] = slot('today')
+        if field_type == 'text':
+            params['rows'] = field.get('rows', '')
+            params['cols'] = field.get('cols', '')
+        if field_type == 'checkbox':
+            params['checked'] = slot('checked')
+
+        if field_type == 'radio':
+            tpl_option = self.field_tpl['radio_option']
+            h_input = u''.join([
+                tpl_option.format(name=name, value=o_value,
+                                  checked=slot('option', o_value),
+                                  label=o_label, classes=params['classes'],
+                                  style=params['style'])
+                for o_value, o_label in options
+            ])
+        elif field_type == 'select':
+            tpl_option = self.field_tpl['select_option']
+            select_elems = u''.join([
+                tpl_option.format(value=o_value,
+                                  selected=slot('option', o_value),
+                                  label=o_label, style=params['style'])
+                for o_value, o_label in options
+            ])
+            h_input = self.field_tpl['select'].format(
+                name=name, select_elems=select_elems,
+                classes=params['classes'], style=params['style'])
+        else:
+            method = getattr(self, 'r_field_{0}'.format(field_type))
+            h_input = method(**params)  # pylint: disable=not-callable
+            if field.get('required', False) is True:
+                h_input = HTML_REQUIRED.format(h_input)
+
+        line = self.r_form_line(field_type, field['title'], h_input, classes,
+                                [slot('errors')])
+        parts = line.split(SLOT)
+        fragments = parts[0::2]
+        plan = list(zip([slots[int(i)] for i in parts[1::2]], fragments[1:]))
+        first_fragment = fragments[0]
+
+        default_value = field.get('default_value', '')
+        default_checked = bool(field.get('checked', False))
+        first_option = None
+        option_mark = 'selected'
+        if field_type == 'radio':
+            first_option = options[0][0]
+            option_mark = 'checked'
+
+        def render_cb(out, form_values, errors, resolved):
+            """
+            Append the field's fragments, filled in from `form_values` and
+            `errors`, to `out`.
+            """
+            # pylint: disable=unused-argument
+            value = form_values.get(name, default_value)
+            if first_option is not None and not form_values.get(name, None):
+                value = first_option
+            checked = default_checked
+            if name in form_values:
+                checked = form_values[name] == 'on'
+
+            out.append(first_fragment)
+            for (kind, arg), fragment in plan:
+                if kind == 'value':
+                    if field_type == 'date' and value == 'today':
+                        value = datetime.datetime.now().strftime("%Y-%m-%d")
+                    out.append(u'{0}'.format(value))
+                elif kind == 'option':
+                    out.append(option_mark if arg == value else '')
+                elif kind == 'checked':
+                    out.append('checked' if checked else '')
+                elif kind == 'errors':
+                    out.append(u', '.join(errors))
+                elif kind == 'today':
+                    out.append(datetime.datetime.now().strftime("%Y-%m-%d"))
+                out.append(fragment)
+        return render_cb
 
     def cast_params(self, params):
         """
@@ -0,0 +1,269 @@
+"""
+The jobs module runs scripts of asynchronous forms in the background and
+stores their results on disk, so they can be retrieved later.
+"""
+
+import logging
+import os
+import re
+import io
+import json
+import uuid
+import time
+import shutil
+import tempfile
+import threading
+import concurrent.futures
+
+
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class JobError(Exception):
+    """
+    Default error for Job errors
+    """
+
+
+class Job(object):
+    """
+    A single run of a form's script in the background. The job's metadata is
+    stored in `meta.json` in its directory, along with the script's output in
+    `stdout` and `stderr`.
+    """
+    def __init__(self, job_id, path, form_name, username=None,
+                 status='queued', exitcode=None, created=None, started=None,
+                 finished=None):
+        self.job_id = job_id
+        self.path = path
+        self.form_name = form_name
+        self.username = username
+        self.status = status
+        self.exitcode = exitcode
+        self.created = created
+        self.started = started
+        self.finished = finished
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a job from its directory `path`.
+        """
+        with open(os.path.join(path, 'meta.json'), 'r') as fh:
+            meta = json.load(fh)
+        return cls(path=path, **meta)
+
+    def save(self):
+        """
+        Atomically write the job's metadata to its directory.
+        """
+        meta = {
+            'job_id': self.job_id,
+            'form_name': self.form_name,
+            'username': self.username,
+            'status': self.status,
+            'exitcode': self.exitcode,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as fh:
+            json.dump(meta, fh)
+        os.rename(meta_path + '.tmp', meta_path)
+
+    def is_finished(self):
+        """
+        Return True if the job is no longer queued or running.
+        """
+        return self.status not in ('queued', 'running')
+
+    def output_path(self, stream):
+        """
+        Return the path to the file holding the `stream` ('stdout' or
+        'stderr') output of the job.
+        """
+        if stream not in ('stdout', 'stderr'):
+            raise JobError("Invalid stream: {0}".format(stream))
+        return os.path.join(self.path, stream)
+
+    def open_output(self, stream):
+        """
+        Open the `stream` ('stdout' or 'stderr') output of the job for reading
+        as bytes. If there's no output, an empty file object is returned.
+        """
+        path = self.output_path(stream)
+        if not os.path.exists(path):
+            return io.BytesIO()
+        return open(path, 'rb')
+
+    def read_output(self, stream):
+        """
+        Return the `stream` ('stdout' or 'stderr') output of the job as bytes.
+        """
+        path = self.output_path(stream)
+        if not os.path.exists(path):
+            return b''
+        with open(path, 'rb') as fh:
+            return fh.read()
+
+
+class JobStore(object):
+    """
+    Runs jobs in a bounded pool of `workers` threads and keeps their results
+    in `path`. If `path` is None, a temporary directory is created when the
+    first job is submitted. Finished jobs older than `max_age` seconds are
+    removed, as are the oldest finished jobs if there are more than
+    `max_count`.
+    """
+    def __init__(self, path=None, workers=4, max_age=86400, max_count=100):
+        self.path = path
+        self.workers = workers
+        self.max_age = max_age
+        self.max_count = max_count
+        self.log = logging.getLogger('JOBS')
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.executor = None
+
+        if self.path is not None and os.path.isdir(self.path):
+            self._load()
+
+    def _load(self):
+        """
+        Load existing jobs from disk. Jobs that were still queued or running
+        when Scriptform was stopped are marked as lost.
+        """
+        for job_id in os.listdir(self.path):
+            job_path = os.path.join(self.path, job_id)
+            try:
+                job = Job.load(job_path)
+            except (OSError, ValueError, TypeError) as err:
+                self.log.warning("Can't load job from %s: %s", job_path, err)
+                continue
+            if not job.is_finished():
+                job.status = 'lost'
+                job.save()
+            self.jobs[job.job_id] = job
+
+    def init_dir(self):
+        """
+        Create the job directory if it doesn't exist yet. This is normally
+        done on first use, but must be done before forking worker processes
+        so that they all share the same directory.
+        """
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix='scriptform_jobs_')
+        elif not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _init(self):
+        """
+        Create the job directory and worker pool on first use.
+        """
+        self.init_dir()
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers)
+
+    def submit(self, form_name, username, run_cb, tmp_files=None):
+        """
+        Queue a new job for `form_name`. `run_cb` is called in a worker thread
+        and must return the result of `runscript.run_script()`, with the
+        output either as bytes or as spooled file objects. Files in
+        `tmp_files` are removed once the job has finished. Returns the Job.
+        """
+        with self.lock:
+            self._init()
+            job_id = uuid.uuid4().hex
+            job_path = os.path.join(self.path, job_id)
+            os.mkdir(job_path)
+            job = Job(job_id, job_path, form_name, username,
+                      created=time.time())
+            job.save()
+            self.jobs[job_id] = job
+            self._prune()
+            self.executor.submit(self._run, job, run_cb, tmp_files or [])
+        self.log.info("Queued job %s for form %s", job_id, form_name)
+        return job
+
+    def _run(self, job, run_cb, tmp_files):
+        """
+        Run the job and store its results. Called in a worker thread.
+        """
+        job.status = 'running'
+        job.started = time.time()
+        job.save()
+        try:
+            result = run_cb()
+            for stream in ('stdout', 'stderr'):
+                output = result[stream]
+                with open(job.output_path(stream), 'wb') as fh:
+                    if isinstance(output, bytes):
+                        fh.write(output)
+                    else:
+                        # Spooled output file
+                        with output:
+                            shutil.copyfileobj(output, fh)
+            job.exitcode = result['exitcode']
+            job.status = 'done'
+        except Exception as err:  # pylint: disable=broad-except
+            self.log.exception(err)
+            with open(job.output_path('stderr'), 'wb') as fh:
+                fh.write(str(err).encode('utf8'))
+            job.status = 'failed'
+        finally:
+            job.finished = time.time()
+            job.save()
+            for file_name in tmp_files:
+                if os.path.exists(file_name):
+                    os.unlink(file_name)
+        self.log.info("Job %s finished with status %s", job.job_id,
+                      job.status)
+
+    def _is_expired(self, job):
+        """
+        Return True if the finished `job` is older than `max_age`.
+        """
+        return self.max_age is not None and job.is_finished() and \
+            job.created < time.time() - self.max_age
+
+    def _prune(self):
+        """
+        Remove finished jobs that exceed the retention limits. Must be called
+        with the lock held.
+        """
+        finished = sorted([job for job in self.jobs.values()
+                           if job.is_finished()],
+                          key=lambda job: job.created)
+        expired = [job for job in finished if self._is_expired(job)]
+        if self.max_count is not None:
+            nr_too_many = len(self.jobs) - self.max_count
+            if nr_too_many > 0:
+                expired.extend(finished[:nr_too_many])
+        for job in expired:
+            if job.job_id in self.jobs:
+                del self.jobs[job.job_id]
+                shutil.rmtree(job.path, ignore_errors=True)
+
+    def get(self, job_id):
+        """
+        Return the Job with id `job_id`. Jobs that were submitted by another
+        worker process are read from disk. Raises a KeyError if there is no
+        such job. Jobs that exceed the retention limits are removed first, so
+        that they expire even if no new jobs are submitted.
+        """
+        with self.lock:
+            self._prune()
+            if job_id in self.jobs:
+                return self.jobs[job_id]
+        if self.path is None or not JOB_ID_RE.match(job_id):
+            raise KeyError(job_id)
+        try:
+            job = Job.load(os.path.join(self.path, job_id))
+        except (OSError, ValueError, TypeError):
+            raise KeyError(job_id) from None
+        if self._is_expired(job):
+            # Left for the worker process that submitted it to remove.
+            raise KeyError(job_id)
+        return job
@@ -5,23 +5,340 @@ their output.
 
 import logging
 import os
+import asyncio
 import pwd
 import grp
 import subprocess
 import json
+import threading
+import time
+import tempfile
+import selectors
 
 
-def from_file(fname):
+TRUNCATED_MARKER = b'\n[Output truncated]\n'
+
+
+class QueueFullError(Exception):
     """
-    Read or execute `fname` and decode its contents as JSON. Used for reading
-    parts of forms from external files or scripts.
+    Raised when a script can't be run because too many scripts are already
+    running and waiting.
     """
-    log = logging.getLogger(__name__)
 
+
+class ScriptLimiter(object):
+    """
+    Limit the number of scripts that may run at the same time, both globally
+    and per form. Scripts that can't run yet wait in a bounded queue for at
+    most `queue_timeout` seconds. If the queue is full or the timeout expires,
+    a QueueFullError is raised. A limit of None means unlimited.
+    """
+    def __init__(self, max_concurrent=None, max_queued=None,
+                 queue_timeout=None):
+        self.cond = threading.Condition()
+        self.async_waiters = []  # (event loop, future) of acquire_async()
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.running_forms = {}  # form name -> nr of running scripts
+        self.queued = 0
+        self.waited = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.rejected = 0
+
+    def configure(self, max_concurrent=None, max_queued=None,
+                  queue_timeout=None):
+        """
+        Change the limits. Scripts that are already running are not affected.
+        """
+        with self.cond:
+            self.max_concurrent = max_concurrent
+            self.max_queued = max_queued
+            self.queue_timeout = queue_timeout
+            self._notify()
+
+    def _can_run(self, form_name, form_max_concurrent):
+        """
+        Return True if a script for `form_name` may be started now.
+        """
+        if self.max_concurrent is not None and \
+           self.running >= self.max_concurrent:
+            return False
+        if form_max_concurrent is not None and \
+           self.running_forms.get(form_name, 0) >= form_max_concurrent:
+            return False
+        return True
+
+    def _enqueue(self):
+        """
+        Count a script that has to wait. Raises a QueueFullError if too many
+        scripts are waiting already. Must be called with the lock held.
+        """
+        if self.max_queued is not None and self.queued >= self.max_queued:
+            self.rejected += 1
+            raise QueueFullError("Too many scripts queued")
+        self.queued += 1
+
+    def _wait_timeout(self, start):
+        """
+        Return the number of seconds a script that started waiting at `start`
+        may still wait, or None if there's no timeout. Raises a
+        QueueFullError if it has waited too long. Must be called with the
+        lock held.
+        """
+        if self.queue_timeout is None:
+            return None
+        timeout = self.queue_timeout - (time.monotonic() - start)
+        if timeout <= 0:
+            self.rejected += 1
+            raise QueueFullError("Timed out waiting for a script slot")
+        return timeout
+
+    def _waited(self, start):
+        """
+        Record the wait time of a script that started waiting at `start`.
+        Must be called with the lock held.
+        """
+        wait_time = time.monotonic() - start
+        self.waited += 1
+        self.wait_time_total += wait_time
+        self.wait_time_max = max(self.wait_time_max, wait_time)
+
+    def _start(self, form_name):
+        """
+        Count a script for `form_name` as running. Must be called with the
+        lock held.
+        """
+        self.running += 1
+        self.running_forms[form_name] = \
+            self.running_forms.get(form_name, 0) + 1
+
+    def _notify(self):
+        """
+        Wake up all waiting scripts so they can check whether they may run.
+        Must be called with the lock held.
+        """
+        self.cond.notify_all()
+        waiters, self.async_waiters = self.async_waiters, []
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(_wake, waiter)
+
+    def acquire(self, form_name, form_max_concurrent=None):
+        """
+        Wait until a script for `form_name` may be run. Every successful call
+        must be followed by a call to `release()`.
+        """
+        with self.cond:
+            if not self._can_run(form_name, form_max_concurrent):
+                self._enqueue()
+                start = time.monotonic()
+                try:
+                    while not self._can_run(form_name, form_max_concurrent):
+                        self.cond.wait(self._wait_timeout(start))
+                finally:
+                    self.queued -= 1
+                self._waited(start)
+            self._start(form_name)
+
+    async def acquire_async(self, form_name, form_max_concurrent=None):
+        """
+        Like `acquire()`, but for use in an asyncio event loop. The event loop
+        isn't blocked while waiting.
+        """
+        with self.cond:
+            if self._can_run(form_name, form_max_concurrent):
+                self._start(form_name)
+                return
+            self._enqueue()
+
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        waiter = None
+        try:
+            while True:
+                with self.cond:
+                    if self._can_run(form_name, form_max_concurrent):
+                        self._waited(start)
+                        self._start(form_name)
+                        return
+                    timeout = self._wait_timeout(start)
+                    waiter = loop.create_future()
+                    self.async_waiters.append((loop, waiter))
+                try:
+                    await asyncio.wait_for(waiter, timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.cond:
+                self.queued -= 1
+                if (loop, waiter) in self.async_waiters:
+                    self.async_waiters.remove((loop, waiter))
+
+    def release(self, form_name):
+        """
+        Signal that a script for `form_name` has finished.
+        """
+        with self.cond:
+            self.running -= 1
+            self.running_forms[form_name] -= 1
+            if self.running_forms[form_name] == 0:
+                del self.running_forms[form_name]
+            self._notify()
+
+    def stats(self):
+        """
+        Return a dictionary with the limits, current queue depth and wait
+        times for monitoring purposes.
+        """
+        with self.cond:
+            wait_time_avg = 0.0
+            if self.waited:
+                wait_time_avg = self.wait_time_total / self.waited
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queued': self.max_queued,
+                'queue_timeout': self.queue_timeout,
+                'running': self.running,
+                'running_forms': dict(self.running_forms),
+                'queued': self.queued,
+                'waited': self.waited,
+                'wait_time_avg': wait_time_avg,
+                'wait_time_max': self.wait_time_max,
+                'rejected': self.rejected,
+            }
+
+
+def _wake(waiter):
+    """
+    Wake up a script that's waiting in `ScriptLimiter.acquire_async()`.
+    """
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+script_limiter = ScriptLimiter()
+
+
+class FromFileCache(object):
+    """
+    Thread-safe cache for the decoded output of `from_file()`, keyed by the
+    full path of the file or script. Each caller decides for itself how old a
+    cached result may be (`ttl`), so forms with different TTLs can share the
+    same script. Concurrent lookups for the same path while it is being
+    executed wait for that single execution instead of starting their own.
+
+    Cached values are shared between callers and must not be modified.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # path -> (time fetched, decoded result)
+        self.in_flight = {}  # path -> _Flight
+
+    def get(self, path, ttl, loader):
+        """
+        Return the cached result for `path` if it is younger than `ttl`
+        seconds. Otherwise call `loader(path)` to produce a fresh result.
+        """
+        with self.lock:
+            entry = self.entries.get(path, None)
+            if entry is not None and time.monotonic() - entry[0] < ttl:
+                return entry[1]
+            flight = self.in_flight.get(path, None)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.in_flight[path] = flight
+
+        if not leader:
+            # Someone else is already executing this script. Wait for it.
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            fetched = time.monotonic()
+            flight.result = loader(path)
+            with self.lock:
+                self.entries[path] = (fetched, flight.result)
+            return flight.result
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[path]
+            flight.done.set()
+
+    def invalidate(self, path=None):
+        """
+        Drop the cached result for `path`, or all cached results if `path` is
+        None.
+        """
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(path, None)
+
+
+class _Flight(object):
+    """
+    A single in-progress execution in the FromFileCache.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+from_file_cache = FromFileCache()
+
+
+def _resolve_path(fname):
+    """
+    Return the full path for `fname`, which is relative to the current working
+    dir unless it's absolute.
+    """
     if not fname.startswith('/'):
-        path = os.path.join(os.path.realpath(os.curdir), fname)
+        return os.path.join(os.path.realpath(os.curdir), fname)
     else:
-        path = fname
+        return fname
+
+
+def from_file(fname, cache_ttl=0):
+    """
+    Read or execute `fname` and decode its contents as JSON. Used for reading
+    parts of forms from external files or scripts. If `cache_ttl` is larger
+    than zero, a result that is at most `cache_ttl` seconds old may be
+    returned from the cache instead.
+    """
+    path = _resolve_path(fname)
+    if cache_ttl and cache_ttl > 0:
+        return from_file_cache.get(path, cache_ttl, _load_file)
+    else:
+        return _load_file(path)
+
+
+def invalidate_from_file(fname=None):
+    """
+    Remove the cached result of `fname` from the `from_file()` cache, so the
+    next call reads or executes it again. If `fname` is None, the entire cache
+    is cleared.
+    """
+    if fname is None:
+        from_file_cache.invalidate()
+    else:
+        from_file_cache.invalidate(_resolve_path(fname))
+
+
+def _load_file(path):
+    """
+    Read or execute `path` and decode its contents as JSON.
+    """
+    log = logging.getLogger(__name__)
 
     if os.access(path, os.X_OK):
         # Executable. Run and grab output
@@ -61,14 +378,166 @@ def run_as(uid, gid, groups):
     return set_acc
 
 
-def run_script(form_def, form_values, env, stdout=None, stderr=None):
+def run_script(form_def, form_values, env, stdout=None, stderr=None,
+               spool=False, live=None, uploads=None):
     """
     Perform a callback for the form `form_def`. This calls a script.
     `form_values` is a dictionary of validated values as returned by
     FormDefinition.validate(). If form_def.output is of type 'raw', `stdout`
     and `stderr` have to be open filehandles where the output of the
     callback should be written. The output of the script is hooked up to
-    the output, depending on the output type.
+    the output, depending on the output type. They may also be objects with
+    a write() method, through which the output is piped.
+
+    For other output types, the output is spooled to temporary files which
+    are kept in memory up to `form_def.spool_size` bytes. Output beyond
+    `form_def.max_output` bytes is replaced by a marker. If `spool` is True,
+    the stdout and stderr in the result are the spooled file objects, which
+    the caller must close. Otherwise they are read into bytes.
+
+    If `live` is given, its start() method is called right before the script
+    is started and its write() method is called with each piece of stdout
+    output as soon as it's read. The stdout output is then not spooled.
+
+    `uploads` is a dict of uploaded files in `form_values` that are passed to
+    the script as an open file instead of by their path, as returned by
+    ResolvedForm.get_uploads(). See `_open_uploads()`.
+
+    The number of concurrently running scripts is limited by
+    `script_limiter`. If no script can be started in time, a QueueFullError
+    is raised.
+    """
+    script_limiter.acquire(form_def.name, form_def.max_concurrent)
+    try:
+        result = _run_script(form_def, form_values, env, stdout, stderr,
+                             live, uploads)
+    finally:
+        script_limiter.release(form_def.name)
+
+    if form_def.output != 'raw' and not spool:
+        for stream in ('stdout', 'stderr'):
+            with result[stream] as spool_file:
+                result[stream] = spool_file.read()
+    return result
+
+
+class _OutputSpool(object):
+    """
+    Store the output from one of a script's pipes in a temporary file, which
+    is kept in memory up to `spool_size` bytes. If `writer` is given, the
+    output is passed to it instead. Output beyond `max_output` bytes is
+    discarded and replaced by a marker.
+    """
+    def __init__(self, spool_size, max_output, writer=None):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.writer = writer or self.file.write
+        self.max_output = max_output
+        self.size = 0
+        self.truncated = False
+
+    def write(self, buf):
+        """
+        Store (or pass on) a piece of output.
+        """
+        if self.max_output is not None:
+            # Keep reading past the maximum so the script doesn't block,
+            # but discard the output.
+            remaining = self.max_output - self.size
+            if len(buf) > remaining:
+                buf = buf[:max(remaining, 0)]
+                if not self.truncated:
+                    self.truncated = True
+                    buf += TRUNCATED_MARKER
+        if buf:
+            self.size += len(buf)
+            self.writer(buf)
+
+
+async def run_script_async(form_def, form_values, env, stdout=None,
+                           stderr=None, spool=False, live=None, drain=None,
+                           uploads=None):
+    """
+    Like `run_script()`, but for use in an asyncio event loop. The script is
+    run with asyncio.create_subprocess_exec(), so the event loop isn't
+    blocked while it runs and no thread is needed to wait for it.
+
+    For 'raw' output, `stdout` and `stderr` are objects with a write()
+    method, such as a connection to the client, to which the output of the
+    script is passed. If `drain` is given, it's a coroutine function that is
+    awaited after output was passed to `stdout`, `stderr` or `live`, so the
+    script is slowed down to the speed of the client.
+    """
+    await script_limiter.acquire_async(form_def.name,
+                                       form_def.max_concurrent)
+    try:
+        result = await _run_script_async(form_def, form_values, env, stdout,
+                                         stderr, live, drain, uploads)
+    finally:
+        script_limiter.release(form_def.name)
+
+    if form_def.output != 'raw' and not spool:
+        for stream in ('stdout', 'stderr'):
+            with result[stream] as spool_file:
+                result[stream] = spool_file.read()
+    return result
+
+
+def _spool_output(proc, spool_size, max_output, live=None):
+    """
+    Read the stdout and stderr of `proc` until they are closed, and store them
+    in temporary files. If `live` is given, stdout is passed to its write()
+    method instead. Returns the files for stdout and stderr, positioned at
+    the start, and whether any output was truncated.
+    """
+    spools = {
+        proc.stdout: _OutputSpool(spool_size, max_output,
+                                  live.write if live is not None else None),
+        proc.stderr: _OutputSpool(spool_size, max_output),
+    }
+    _read_pipes(dict((pipe, spool.write) for pipe, spool in spools.items()))
+
+    for spool in spools.values():
+        spool.file.seek(0)
+    truncated = any(spool.truncated for spool in spools.values())
+    return spools[proc.stdout].file, spools[proc.stderr].file, truncated
+
+
+def _read_pipes(writers):
+    """
+    Read the pipes in the `writers` dict until they are closed, and pass
+    what's read from each pipe to its write function.
+    """
+    selector = selectors.DefaultSelector()
+    for pipe in writers:
+        selector.register(pipe, selectors.EVENT_READ)
+
+    while selector.get_map():
+        for key, _ in selector.select():
+            pipe = key.fileobj
+            buf = os.read(pipe.fileno(), 1024 * 64)
+            if not buf:
+                selector.unregister(pipe)
+                pipe.close()
+                continue
+            writers[pipe](buf)
+    selector.close()
+
+
+def _error_output(msg):
+    """
+    Return a spooled file containing the error message `msg`.
+    """
+    spool_file = tempfile.SpooledTemporaryFile()
+    spool_file.write(msg.encode('utf8'))
+    spool_file.seek(0)
+    return spool_file
+
+
+def _prepare_script(form_def, form_values, env, stdout, stderr):
+    """
+    Validate the parameters for running the script of `form_def` and add the
+    `form_values` to the environment `env`. Returns the function that
+    switches to the user the script must be run as, or None.
     """
     log = logging.getLogger('RUNSCRIPT')
 
@@ -107,47 +576,238 @@ def run_script(form_def, form_values, env, stdout=None, stderr=None):
         if form_def.run_as is not None:
             log.critical("Not running as root, so we can't run the "
                          "script as user '%s'", form_def.run_as)
+    return run_as_fn
+
+
+def _open_uploads(form_values, env, uploads, stdin):
+    """
+    Open the uploaded files in `uploads` so they can be passed to the script
+    as open files, and point the script's environment at them. Files that
+    are delivered on 'stdin' become the script's stdin, while 'fd' files
+    are inherited by the script as an extra file descriptor. The temporary
+    files are removed right away, so the script can only read them through
+    the file descriptor and their space is freed as soon as it's done.
+
+    Returns the stdin for the script (`stdin` if no file is delivered on
+    stdin), the file descriptors the script should inherit and the list of
+    opened files, which must be closed once the script was started.
+    """
+    pass_fds = []
+    upload_files = []
+    try:
+        for field_name, deliver in (uploads or {}).items():
+            path = form_values[field_name]
+            upload_file = open(path, 'rb')
+            upload_files.append(upload_file)
+            os.unlink(path)
+            if deliver == 'stdin':
+                stdin = upload_file
+                env[field_name] = '/dev/stdin'
+            else:
+                fd = upload_file.fileno()
+                env[field_name] = '/dev/fd/{0}'.format(fd)
+                env['{0}__fd'.format(field_name)] = str(fd)
+                pass_fds.append(fd)
+    except BaseException:
+        _close_files(upload_files)
+        raise
+    return stdin, pass_fds, upload_files
+
+
+def _close_files(files):
+    """
+    Close all `files`.
+    """
+    for open_file in files:
+        open_file.close()
+
+
+def _run_script(form_def, form_values, env, stdout, stderr, live, uploads):
+    """
+    Run the script for `form_def`. See `run_script()`.
+    """
+    log = logging.getLogger('RUNSCRIPT')
+    run_as_fn = _prepare_script(form_def, form_values, env, stdout, stderr)
 
     # If the form output type is 'raw', we directly stream the output to
     # the browser. Otherwise we store it for later displaying.
     if form_def.output == 'raw':
+        # File-like objects without a file descriptor can't be passed to the
+        # script, so its output is piped through them.
+        piped = not hasattr(stdout, 'fileno')
         try:
-            proc = subprocess.Popen(form_def.script,
-                                    shell=True,
-                                    stdout=stdout,
-                                    stderr=stderr,
-                                    env=env,
-                                    close_fds=True,
-                                    preexec_fn=run_as_fn)
-            stdout, stderr = proc.communicate(input)
-            log.info("Exit code: %s", proc.returncode)
-            return proc.returncode
+            stdin, pass_fds, upload_files = _open_uploads(
+                form_values, env, uploads, None)
+            try:
+                proc = subprocess.Popen(form_def.script,
+                                        shell=True,
+                                        stdin=stdin,
+                                        stdout=subprocess.PIPE if piped
+                                        else stdout,
+                                        stderr=subprocess.PIPE if piped
+                                        else stderr,
+                                        env=env,
+                                        close_fds=True,
+                                        pass_fds=pass_fds,
+                                        preexec_fn=run_as_fn)
+            finally:
+                _close_files(upload_files)
         except OSError as err:
             log.exception(err)
             stderr.write(str(err) + '. Please see the log file.')
             return -1
-    else:
+        if piped:
+            try:
+                _read_pipes({proc.stdout: stdout.write,
+                             proc.stderr: stderr.write})
+            except BaseException:
+                # The client went away.
+                _kill(proc)
+                raise
+        proc.wait()
+        log.info("Exit code: %s", proc.returncode)
+        return proc.returncode
+
+    if live is not None:
+        live.start()
+    try:
+        stdin, pass_fds, upload_files = _open_uploads(
+            form_values, env, uploads, subprocess.DEVNULL)
         try:
             proc = subprocess.Popen(form_def.script,
                                     shell=True,
-                                    stdin=subprocess.PIPE,
+                                    stdin=stdin,
                                     stdout=subprocess.PIPE,
                                     stderr=subprocess.PIPE,
                                     env=env,
                                     close_fds=True,
+                                    pass_fds=pass_fds,
                                     preexec_fn=run_as_fn)
-            stdout, stderr = proc.communicate()
-            log.info("Exit code: %s", proc.returncode)
-            return {
-                'stdout': stdout,
-                'stderr': stderr,
-                'exitcode': proc.returncode
-            }
-        except OSError as err:
-            log.exception(err)
-            return {
-                'stdout': '',
-                'stderr': 'Internal error: {0}. Please see the log '
-                          'file.'.format(str(err)),
-                'exitcode': -1
-            }
+        finally:
+            _close_files(upload_files)
+    except OSError as err:
+        log.exception(err)
+        return {
+            'stdout': _error_output(''),
+            'stderr': _error_output('Internal error: {0}. Please see '
+                                    'the log file.'.format(str(err))),
+            'exitcode': -1,
+            'truncated': False,
+        }
+    try:
+        stdout, stderr, truncated = _spool_output(proc, form_def.spool_size,
+                                                  form_def.max_output, live)
+    except BaseException:
+        # The client went away.
+        _kill(proc)
+        raise
+    proc.wait()
+    log.info("Exit code: %s", proc.returncode)
+    if truncated:
+        log.warning("Output truncated to %s bytes", form_def.max_output)
+    return {
+        'stdout': stdout,
+        'stderr': stderr,
+        'exitcode': proc.returncode,
+        'truncated': truncated,
+    }
+
+
+def _kill(proc):
+    """
+    Kill the script `proc` and wait for it, so that it doesn't keep running
+    when its output can't be sent anywhere.
+    """
+    proc.kill()
+    proc.wait()
+
+
+async def _run_script_async(form_def, form_values, env, stdout, stderr, live,
+                            drain, uploads):
+    """
+    Run the script for `form_def`. See `run_script_async()`.
+    """
+    log = logging.getLogger('RUNSCRIPT')
+    run_as_fn = _prepare_script(form_def, form_values, env, stdout, stderr)
+    raw = form_def.output == 'raw'
+
+    if live is not None and not raw:
+        live.start()
+    try:
+        stdin, pass_fds, upload_files = _open_uploads(
+            form_values, env, uploads, subprocess.DEVNULL)
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                '/bin/sh', '-c', form_def.script,
+                stdin=stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=env,
+                close_fds=True,
+                pass_fds=pass_fds,
+                preexec_fn=run_as_fn)
+        finally:
+            _close_files(upload_files)
+    except OSError as err:
+        log.exception(err)
+        if raw:
+            stderr.write((str(err) + '. Please see the log file.').encode())
+            return -1
+        return {
+            'stdout': _error_output(''),
+            'stderr': _error_output('Internal error: {0}. Please see '
+                                    'the log file.'.format(str(err))),
+            'exitcode': -1,
+            'truncated': False,
+        }
+
+    if raw:
+        # Pass the output on as it is. Unlike with run_script(), the script
+        # can't write to the connection directly, because the event loop
+        # uses it in non-blocking mode.
+        pumps = [_pump(proc.stdout, stdout.write, drain),
+                 _pump(proc.stderr, stderr.write, drain)]
+    else:
+        spool_stdout = _OutputSpool(form_def.spool_size, form_def.max_output,
+                                    live.write if live is not None else None)
+        spool_stderr = _OutputSpool(form_def.spool_size, form_def.max_output)
+        pumps = [_pump(proc.stdout, spool_stdout.write,
+                       drain if live is not None else None),
+                 _pump(proc.stderr, spool_stderr.write)]
+    try:
+        await asyncio.gather(*pumps)
+        await proc.wait()
+    except BaseException:
+        # The client went away or the server is shutting down.
+        if proc.returncode is None:
+            proc.kill()
+        raise
+    log.info("Exit code: %s", proc.returncode)
+
+    if raw:
+        return proc.returncode
+    truncated = spool_stdout.truncated or spool_stderr.truncated
+    if truncated:
+        log.warning("Output truncated to %s bytes", form_def.max_output)
+    spool_stdout.file.seek(0)
+    spool_stderr.file.seek(0)
+    return {
+        'stdout': spool_stdout.file,
+        'stderr': spool_stderr.file,
+        'exitcode': proc.returncode,
+        'truncated': truncated,
+    }
+
+
+async def _pump(stream, write, drain=None):
+    """
+    Read the asyncio `stream` until it's closed and pass the output to
+    `write`. If `drain` is given, it's awaited after every write.
+    """
+    while True:
+        buf = await stream.read(1024 * 64)
+        if not buf:
+            break
+        write(buf)
+        if drain is not None:
+            await drain()
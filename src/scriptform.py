@@ -11,8 +11,10 @@ import os
 import json
 import logging
 import threading
-import hashlib
+import signal
+import time
 import getpass
+import sqlite3
 
 if hasattr(sys, 'dont_write_bytecode'):
     sys.dont_write_bytecode = True
@@ -20,9 +22,13 @@ if hasattr(sys, 'dont_write_bytecode'):
 # pylint: disable=wrong-import-position
 from daemon import Daemon
 from formdefinition import FormDefinition
-from formconfig import FormConfig
-from webserver import ThreadedHTTPServer
-from webapp import ScriptFormWebApp
+from formconfig import FormConfig, FormConfigError
+from jobs import JobStore
+from webserver import ThreadedHTTPServer, ThreadPoolHTTPServer, \
+    AsyncHTTPServer
+from webapp import ScriptFormWebApp, AsyncScriptFormWebApp
+import runscript
+import userauth
 
 
 class ScriptForm(object):
@@ -35,27 +41,118 @@ class ScriptForm(object):
         self.cache = cache
         self.log = logging.getLogger('SCRIPTFORM')
         self.form_config_singleton = None
+        self.config_mtimes = {}
+        self.form_defs = {}
+        self.user_file = None
+        self.reload_lock = threading.Lock()
         self.websrv = None
+        self.worker_pids = {}
+        self.stopping = False
         self.running = False
         self.httpd = None
+        # Session tokens are signed with a random secret, unless one is
+        # configured. It's created before the worker processes are forked, so
+        # that they all accept each other's sessions.
+        self.session_secret = os.urandom(32)
 
         # Init form config so it can raise errors about problems.
-        self.get_form_config()
+        form_config = self.get_form_config()
+
+        # Results of asynchronous forms must survive config reloads, so the
+        # job store is only configured once.
+        self.job_store = JobStore(form_config.jobs_dir,
+                                  form_config.jobs_workers,
+                                  form_config.jobs_max_age,
+                                  form_config.jobs_max_count)
 
     def get_form_config(self):
         """
-        Read and return the form configuration in the form of a FormConfig
-        instance. If it has already been read, a cached version is returned.
+        Return the form configuration in the form of a FormConfig instance.
+        It's read the first time it's needed. If caching is disabled (with
+        the --reload option), it's read again when the form configuration
+        file or the custom CSS file has changed.
         """
-        # Cache
-        if self.cache and self.form_config_singleton is not None:
+        form_config = self.form_config_singleton
+        if form_config is not None and \
+           (self.cache or not self.config_changed()):
+            return form_config
+
+        with self.reload_lock:
+            if self.form_config_singleton is not form_config:
+                # Another thread has already reloaded the configuration.
+                return self.form_config_singleton
+            if form_config is None:
+                form_config = self.load_form_config()
+                self.form_config_singleton = form_config
+                return form_config
+            self.log.info("Form configuration changed. Reloading.")
+            self._reload_form_config()
             return self.form_config_singleton
 
+    def reload_form_config(self):
+        """
+        Read the form configuration again, regardless of whether it has
+        changed, and replace the current one if it's valid. Returns True if
+        the configuration was replaced. Called when the daemon receives a
+        SIGHUP, which is passed on to the worker processes, if any.
+        """
+        self.log.info("Reloading form configuration.")
+        self.signal_workers(signal.SIGHUP)
+        with self.reload_lock:
+            return self._reload_form_config()
+
+    def _reload_form_config(self):
+        """
+        Load the form configuration and replace the current one. If it can't
+        be loaded, the error is logged and the current one is kept until the
+        files change again. Must be called with the reload lock held.
+        """
+        try:
+            form_config = self.load_form_config()
+        except Exception as err:  # pylint: disable=broad-except
+            self.log.error("Can't reload form configuration: %s", err)
+            self.config_mtimes = self.get_mtimes(self.config_mtimes)
+            return False
+        # Replacing the reference is atomic. Requests that are being handled
+        # keep using the configuration they started with.
+        self.form_config_singleton = form_config
+        return True
+
+    def config_changed(self):
+        """
+        Return True if the form configuration file or custom CSS file have
+        been modified since the configuration was last loaded.
+        """
+        return self.get_mtimes(self.config_mtimes) != self.config_mtimes
+
+    @staticmethod
+    def get_mtimes(paths):
+        """
+        Return a dict with the modification times of `paths`, or None for
+        paths that don't exist.
+        """
+        mtimes = {}
+        for path in paths:
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def load_form_config(self):
+        """
+        Read the form configuration file and return it as a new FormConfig
+        instance. Form definitions that haven't changed since the previous
+        load are reused.
+        """
+        config_mtimes = self.get_mtimes([self.config_file])
         with open(self.config_file, "r") as fh:
             file_contents = fh.read()
         try:
             config = json.loads(file_contents)
         except ValueError as err:
+            if self.form_config_singleton is not None:
+                raise
             sys.stderr.write("Error in form configuration '{}': {}\n".format(
                 self.config_file, err))
             sys.exit(1)
@@ -68,10 +165,17 @@ class ScriptForm(object):
         if 'static_dir' in config:
             static_dir = config['static_dir']
         if 'custom_css' in config:
+            config_mtimes.update(self.get_mtimes([config['custom_css']]))
             with open(config["custom_css"], "r") as fh:
                 custom_css = fh.read()
         if 'users' in config:
             users = config['users']
+        if 'users_file' in config:
+            if users is not None:
+                raise FormConfigError(
+                    "Can't use both 'users' and 'users_file'")
+            users = self.get_user_file(config['users_file'])
+        form_defs = {}
         for form in config['forms']:
             form_name = form['name']
             if not form['script'].startswith('/'):
@@ -81,55 +185,268 @@ class ScriptForm(object):
             else:
                 # Absolute path to the script
                 script = form['script']
-            forms.append(
-                FormDefinition(form_name,
-                               form['title'],
-                               form['description'],
-                               form.get('fields', None),
-                               script,
-                               fields_from=form.get("fields_from", None),
-                               default_value=form.get('default_value', ""),
-                               output=form.get('output', 'escaped'),
-                               hidden=form.get('hidden', False),
-                               submit_title=form.get('submit_title', 'Submit'),
-                               allowed_users=form.get('allowed_users', None),
-                               run_as=form.get('run_as', None))
-            )
+
+            # Reuse the form definition (and its compiled validators) if
+            # its part of the configuration hasn't changed.
+            form_key = (script, json.dumps(form, sort_keys=True))
+            if self.form_defs.get(form_name, (None, None))[0] == form_key:
+                form_def = self.form_defs[form_name][1]
+            else:
+                form_def = self.create_form_def(form, script)
+            form_defs[form_name] = (form_key, form_def)
+            forms.append(form_def)
 
         form_config = FormConfig(
             config['title'],
             forms,
             users,
             static_dir,
-            custom_css
+            custom_css,
+            max_concurrent=config.get('max_concurrent', None),
+            max_queued=config.get('max_queued', None),
+            queue_timeout=config.get('queue_timeout', None),
+            jobs_dir=config.get('jobs_dir', None),
+            jobs_workers=config.get('jobs_workers', 4),
+            jobs_max_age=config.get('jobs_max_age', 86400),
+            jobs_max_count=config.get('jobs_max_count', 100),
+            external_css=config.get('external_css', False),
+            max_request_size=config.get('max_request_size', None),
+            max_field_size=config.get('max_field_size', 1024 * 1024 * 10),
+            max_file_size=config.get('max_file_size', None),
+            static_cache_control=config.get('static_cache_control',
+                                            'no-cache'),
+            static_cache_size=config.get('static_cache_size',
+                                         1024 * 1024 * 16),
+            static_cache_max_file_size=config.get(
+                'static_cache_max_file_size', 1024 * 256),
+            compress_level=config.get('compress_level', 6),
+            compress_min_size=config.get('compress_min_size', 1024),
+            session_lifetime=config.get('session_lifetime', 0),
+            session_secret=config.get('session_secret', self.session_secret),
+            auth_cache_ttl=config.get('auth_cache_ttl', 300)
         )
-        self.form_config_singleton = form_config
+        runscript.script_limiter.configure(form_config.max_concurrent,
+                                           form_config.max_queued,
+                                           form_config.queue_timeout)
+        self.form_defs = form_defs
+        self.config_mtimes = config_mtimes
         return form_config
 
-    def run(self, listen_addr='0.0.0.0', listen_port=8081):
+    def get_user_file(self, path):
+        """
+        Return a UserFile for the users file `path`. The users file keeps
+        itself up to date, so it's reused when the form configuration is
+        reloaded, instead of reading all the users again.
+        """
+        path = os.path.realpath(path)
+        if self.user_file is None or self.user_file.path != path:
+            self.user_file = userauth.UserFile(path)
+        return self.user_file
+
+    @staticmethod
+    def create_form_def(form, script):
+        """
+        Create a FormDefinition from the `form` part of the configuration.
+        `script` is the full path to the form's script.
+        """
+        return FormDefinition(form['name'],
+                              form['title'],
+                              form['description'],
+                              form.get('fields', None),
+                              script,
+                              fields_from=form.get("fields_from", None),
+                              default_value=form.get('default_value', ""),
+                              output=form.get('output', 'escaped'),
+                              hidden=form.get('hidden', False),
+                              submit_title=form.get('submit_title', 'Submit'),
+                              allowed_users=form.get('allowed_users', None),
+                              run_as=form.get('run_as', None),
+                              fields_cache_ttl=form.get('fields_cache_ttl',
+                                                        0),
+                              options_cache_ttl=form.get('options_cache_ttl',
+                                                         0),
+                              batch_workers=form.get('batch_workers', 1),
+                              max_concurrent=form.get('max_concurrent', None),
+                              run_async=form.get('async', False),
+                              spool_size=form.get('spool_size', 1024 * 1024),
+                              max_output=form.get('max_output', None),
+                              stream=form.get('stream', False),
+                              compress=form.get('compress', False))
+
+    def run(self, listen_addr='0.0.0.0', listen_port=8081, workers=1,
+            threads=None, backlog=None, timeout=60, max_connections=None,
+            keepalive_timeout=5, keepalive_requests=100, engine='threads'):
         """
         Start the webserver on address `listen_addr` and port `listen_port`.
         This call is blocking until the user hits Ctrl-c, the shutdown() method
-        is called or something like SystemExit is raised in a handler.
+        is called or something like SystemExit is raised in a handler. If
+        `workers` is more than 1, that many worker processes are forked to
+        handle requests. See run_workers().
+
+        Requests are handled in a new thread for every connection, or by a
+        pool of `threads` threads if given. `backlog` is the number of
+        connections the OS queues before they're accepted, `timeout` the
+        number of seconds a connection may be idle while reading or writing
+        (None for no limit), and `max_connections` the number of connections
+        that may be handled or waiting for a thread at the same time.
+
+        Connections are kept open for at most `keepalive_requests` requests
+        and closed when no new request arrives within `keepalive_timeout`
+        seconds. Set `keepalive_requests` to 1 to disable keep-alive.
+
+        If `engine` is 'asyncio', all connections are handled in a single
+        thread by an asyncio event loop instead, and `threads` is ignored.
         """
         ScriptFormWebApp.scriptform = self
-        self.httpd = ThreadedHTTPServer((listen_addr, listen_port),
-                                        ScriptFormWebApp)
-        self.httpd.daemon_threads = True
+        ScriptFormWebApp.keepalive_timeout = keepalive_timeout
+        ScriptFormWebApp.keepalive_max_requests = keepalive_requests
+        server_args = {
+            'backlog': backlog,
+            'request_timeout': timeout,
+            'max_connections': max_connections,
+        }
+        if engine == 'asyncio':
+            if threads:
+                self.log.warning("The asyncio engine doesn't use threads. "
+                                 "Ignoring the number of threads.")
+            self.httpd = AsyncHTTPServer((listen_addr, listen_port),
+                                         AsyncScriptFormWebApp, **server_args)
+        elif threads:
+            self.httpd = ThreadPoolHTTPServer((listen_addr, listen_port),
+                                              ScriptFormWebApp,
+                                              threads=threads,
+                                              **server_args)
+        else:
+            self.httpd = ThreadedHTTPServer((listen_addr, listen_port),
+                                            ScriptFormWebApp, **server_args)
+            self.httpd.daemon_threads = True
         self.log.info("Listening on %s:%s", listen_addr, listen_port)
         self.running = True
         try:
-            self.httpd.serve_forever()
+            if workers > 1:
+                self.run_workers(workers)
+            else:
+                self.httpd.serve_forever()
         except KeyboardInterrupt:
             pass
+        self.httpd.server_close()
         self.running = False
 
+    def run_workers(self, nr_of_workers):
+        """
+        Fork `nr_of_workers` worker processes that all accept connections on
+        the listening socket, and supervise them. Workers that die are
+        restarted. SIGHUP and SIGTERM are passed on to the workers. Returns
+        when the server is shut down.
+        """
+        # Workers must share the directory where asynchronous jobs are
+        # stored, so they can show each other's jobs.
+        self.job_store.init_dir()
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            # Not running as a daemon, which would call shutdown().
+            signal.signal(signal.SIGTERM, self._shutdown_on_signal)
+
+        self.stopping = False
+        try:
+            for _ in range(nr_of_workers):
+                self._fork_worker()
+            while self.worker_pids:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                started = self.worker_pids.pop(pid, None)
+                if started is None or self.stopping:
+                    continue
+                self.log.error("Worker %s died with status %s. Restarting.",
+                               pid, status)
+                if time.time() - started < 1:
+                    # Don't restart workers that fail immediately in a tight
+                    # loop.
+                    time.sleep(1)
+                self._fork_worker()
+        finally:
+            self.stopping = True
+            self.signal_workers(signal.SIGTERM)
+            for pid in list(self.worker_pids):
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+            self.worker_pids = {}
+            self.httpd.server_close()
+
+    def _fork_worker(self):
+        """
+        Fork a worker process that handles requests until it's sent SIGTERM.
+        """
+        master_pid = os.getpid()
+        pid = os.fork()
+        if pid > 0:
+            self.log.info("Started worker %s", pid)
+            self.worker_pids[pid] = time.time()
+            return
+
+        # Worker process
+        exitcode = 0
+        self.worker_pids = {}
+        signal.signal(signal.SIGTERM, self._shutdown_on_signal)
+
+        def check_master():
+            """
+            Stop the worker if the master process has died. Called by the
+            server between requests and at least every half second.
+            """
+            if os.getppid() != master_pid and not self.stopping:
+                self.log.error("Master process died. Stopping worker.")
+                self.stopping = True
+                self.shutdown()
+        self.httpd.service_actions = check_master
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        except Exception as err:  # pylint: disable=broad-except
+            self.log.exception(err)
+            exitcode = 1
+        finally:
+            # Don't run the master's exit handlers, such as the one that
+            # removes the pid file.
+            logging.shutdown()
+            os._exit(exitcode)  # pylint: disable=protected-access
+
+    def _shutdown_on_signal(self, sig, frame):  # pylint: disable=W0613
+        """
+        Signal handler that shuts the server down. shutdown() is run in a
+        separate thread, so that it doesn't interrupt whatever the main
+        thread is doing, such as writing to the log.
+        """
+        thread = threading.Thread(target=self.shutdown)
+        thread.daemon = True
+        thread.start()
+
+    def signal_workers(self, sig):
+        """
+        Send signal `sig` to all worker processes.
+        """
+        for pid in list(self.worker_pids):
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
     def shutdown(self):
         """
         Shutdown the server. This interupts the run() method and must thus be
         run in a seperate thread.
         """
         self.log.info("Attempting server shutdown")
+        if self.worker_pids:
+            # We're the master process. Stop the workers, which ends
+            # run_workers().
+            self.stopping = True
+            self.signal_workers(signal.SIGTERM)
+            return
 
         def t_shutdown(scriptform_instance):
             """
@@ -161,12 +478,82 @@ def main():  # pragma: no cover
                         action='store_true',
                         default=False,
                         help='Generate password')
+    parser.add_argument('--pw-hash',
+                        dest='pw_hash',
+                        choices=userauth.HASH_SCHEMES,
+                        default='pbkdf2',
+                        help='Hash scheme for --generate-pw (default=pbkdf2)')
+    parser.add_argument('--users-file',
+                        metavar='PATH',
+                        dest='users_file',
+                        default=None,
+                        help='Add the password generated with --generate-pw '
+                             'to the users file PATH')
+    parser.add_argument('--user',
+                        metavar='NAME',
+                        dest='user',
+                        default=None,
+                        help='Username for --users-file')
     parser.add_argument('-p', '--port',
                         metavar='PORT',
                         dest='port',
                         type=int,
                         default=8081,
                         help='Port to listen on (default=8081)')
+    parser.add_argument('-w', '--workers',
+                        metavar='N',
+                        dest='workers',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes (default=1)')
+    parser.add_argument('--engine',
+                        dest='engine',
+                        choices=['threads', 'asyncio'],
+                        default='threads',
+                        help='Handle connections with threads or with an '
+                             'asyncio event loop (default=threads)')
+    parser.add_argument('--threads',
+                        metavar='N',
+                        dest='threads',
+                        type=int,
+                        default=None,
+                        help='Handle requests with a pool of N threads '
+                             '(default: a thread per connection)')
+    parser.add_argument('--backlog',
+                        metavar='N',
+                        dest='backlog',
+                        type=int,
+                        default=None,
+                        help='Number of connections waiting to be accepted '
+                             '(default=5)')
+    parser.add_argument('--timeout',
+                        metavar='SECONDS',
+                        dest='timeout',
+                        type=float,
+                        default=60,
+                        help='Close idle connections after SECONDS, or '
+                             'never if 0 (default=60)')
+    parser.add_argument('--max-connections',
+                        metavar='N',
+                        dest='max_connections',
+                        type=int,
+                        default=None,
+                        help='Maximum number of connections '
+                             '(default: unlimited)')
+    parser.add_argument('--keepalive-timeout',
+                        metavar='SECONDS',
+                        dest='keepalive_timeout',
+                        type=float,
+                        default=5,
+                        help='Close kept-alive connections after SECONDS '
+                             'without a new request (default=5)')
+    parser.add_argument('--keepalive-requests',
+                        metavar='N',
+                        dest='keepalive_requests',
+                        type=int,
+                        default=100,
+                        help='Maximum number of requests per connection '
+                             '(default=100)')
     parser.add_argument('-f', '--foreground',
                         dest='foreground',
                         action='store_true',
@@ -176,7 +563,7 @@ def main():  # pragma: no cover
                         dest='reload',
                         action='store_true',
                         default=False,
-                        help='Reload form config on every request (DEV)')
+                        help='Reload form config when it changes')
     parser.add_argument('--pid-file',
                         metavar='PATH',
                         dest='pid_file',
@@ -194,20 +581,37 @@ def main():  # pragma: no cover
                         action='store_true',
                         default=None,
                         help='Stop daemon')
+    parser.add_argument('--reload-config',
+                        dest='action_reload',
+                        action='store_true',
+                        default=None,
+                        help='Reload the form config of the running daemon')
     parser.add_argument(dest='config',
                         metavar="CONFIG_FILE",
+                        nargs='?',
                         help="Path to form definition config",
                         )
     options = parser.parse_args()
+    if options.config is None and not options.generate_pw:
+        parser.error("the following arguments are required: CONFIG_FILE")
+    if options.users_file is not None and not options.user:
+        parser.error("--users-file requires --user")
 
     if options.generate_pw:
-        # Generate a password for use in the `users` section
+        # Generate a password for use in the `users` section or users file
         plain_pw = getpass.getpass()
         if plain_pw != getpass.getpass('Repeat password: '):
             sys.stderr.write("Passwords do not match.\n")
             sys.exit(1)
-        sha = hashlib.sha256(plain_pw.encode('utf8')).hexdigest()
-        sys.stdout.write("{}\n".format(sha))
+        pw_hash = userauth.hash_password(plain_pw, options.pw_hash)
+        if options.users_file is not None:
+            try:
+                userauth.add_user(options.users_file, options.user, pw_hash)
+            except (ValueError, OSError, sqlite3.Error) as err:
+                sys.stderr.write("Can't add user: {}\n".format(err))
+                sys.exit(1)
+        else:
+            sys.stdout.write("{}\n".format(pw_hash))
         sys.exit(0)
     else:
         # Switch to dir of form definition configuration
@@ -221,12 +625,26 @@ def main():  # pragma: no cover
         if options.action_stop:
             daemon.stop()
             sys.exit(0)
+        elif options.action_reload:
+            daemon.reload()
+            sys.exit(0)
         else:
             cache = not options.reload
             scriptform_instance = ScriptForm(formconfig_path, cache=cache)
             daemon.register_shutdown_callback(scriptform_instance.shutdown)
+            daemon.register_reload_callback(
+                scriptform_instance.reload_form_config)
             daemon.start()
-            scriptform_instance.run(listen_port=options.port)
+            scriptform_instance.run(
+                listen_port=options.port,
+                workers=options.workers,
+                threads=options.threads,
+                backlog=options.backlog,
+                timeout=options.timeout or None,
+                max_connections=options.max_connections,
+                keepalive_timeout=options.keepalive_timeout,
+                keepalive_requests=options.keepalive_requests,
+                engine=options.engine)
 
 
 if __name__ == "__main__":  # pragma: no cover
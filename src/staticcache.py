@@ -0,0 +1,189 @@
+"""
+The staticcache module keeps small static files in memory, along with their
+gzip compressed variant, so that they can be served without reading them from
+disk.
+"""
+
+import collections
+import email.utils
+import gzip
+import mimetypes
+import os
+import stat
+import threading
+
+
+# Content types that are worth compressing, besides text/*.
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+])
+
+
+def file_validators(file_stat):
+    """
+    Return the ETag and Last-Modified header values for a file with
+    `file_stat`.
+    """
+    etag = '"{0:x}-{1:x}"'.format(file_stat.st_mtime_ns, file_stat.st_size)
+    last_modified = email.utils.formatdate(file_stat.st_mtime, usegmt=True)
+    return etag, last_modified
+
+
+def is_compressible(content_type):
+    """
+    Return True if files of `content_type` are worth compressing.
+    """
+    return content_type is not None and (
+        content_type.startswith('text/') or
+        content_type in COMPRESSIBLE_TYPES)
+
+
+class StaticFile(object):
+    """
+    A cached static file. `gzip_data` is the gzip compressed contents of the
+    file, None if it hasn't been compressed yet or False if it's not worth
+    compressing.
+    """
+    def __init__(self, path, file_stat, data):
+        self.path = path
+        self.mtime_ns = file_stat.st_mtime_ns
+        self.mtime = int(file_stat.st_mtime)
+        self.size = file_stat.st_size
+        self.data = data
+        self.etag, self.last_modified = file_validators(file_stat)
+        self.content_type = mimetypes.guess_type(path)[0]
+        self.compressible = is_compressible(self.content_type)
+        self.gzip_data = None if self.compressible else False
+
+
+class StaticCache(object):
+    """
+    Thread-safe LRU cache of the contents of static files, keyed by their
+    path and validated against their modification time and size on every
+    lookup. Files larger than `max_file_size` aren't cached. The least
+    recently used files are evicted when the cached files (including their
+    compressed variants) take up more than `max_size` bytes.
+    """
+    def __init__(self, max_size=1024 * 1024 * 16, max_file_size=1024 * 256):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # path -> StaticFile
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        """
+        Return the StaticFile for `path`, reading it into the cache if it
+        isn't cached yet or has changed. Returns None if the file doesn't
+        exist, isn't a regular file or is too large to cache.
+        """
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(file_stat.st_mode) or \
+           file_stat.st_size > min(self.max_file_size, self.max_size):
+            return None
+
+        with self.lock:
+            entry = self.entries.get(path, None)
+            if entry is not None and entry.mtime_ns == file_stat.st_mtime_ns \
+               and entry.size == file_stat.st_size:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        try:
+            with open(path, 'rb') as static_file:
+                file_stat = os.fstat(static_file.fileno())
+                data = static_file.read(self.max_file_size + 1)
+        except OSError:
+            return None
+        if len(data) != file_stat.st_size:
+            # The file changed while it was read.
+            return None
+        entry = StaticFile(path, file_stat, data)
+
+        with self.lock:
+            old_entry = self.entries.pop(path, None)
+            if old_entry is not None:
+                self.size -= self._entry_size(old_entry)
+            self.entries[path] = entry
+            self.size += self._entry_size(entry)
+            self._evict()
+        return entry
+
+    def get_gzip(self, entry):
+        """
+        Return the gzip compressed contents of the cached `entry`, or None if
+        it's not worth compressing. A pre-compressed variant of the file
+        ('<path>.gz') is used if it's at least as new as the file itself.
+        Otherwise the file is compressed once and the result is cached.
+        """
+        if entry.gzip_data is None:
+            gzip_data = self._read_gzip(entry)
+            if gzip_data is None:
+                gzip_data = gzip.compress(entry.data, 6)
+            if len(gzip_data) >= entry.size:
+                gzip_data = False
+            with self.lock:
+                if entry.gzip_data is None:
+                    entry.gzip_data = gzip_data
+                    if self.entries.get(entry.path, None) is entry:
+                        self.size += len(gzip_data or b'')
+                        self._evict()
+        return entry.gzip_data or None
+
+    @staticmethod
+    def _read_gzip(entry):
+        """
+        Return the contents of the pre-compressed variant of `entry`, or None
+        if there isn't an up-to-date one.
+        """
+        try:
+            with open(entry.path + '.gz', 'rb') as gzip_file:
+                gzip_stat = os.fstat(gzip_file.fileno())
+                if gzip_stat.st_mtime_ns < entry.mtime_ns:
+                    return None
+                return gzip_file.read()
+        except OSError:
+            return None
+
+    @staticmethod
+    def _entry_size(entry):
+        """
+        Return the number of bytes `entry` takes up in the cache.
+        """
+        return entry.size + len(entry.gzip_data or b'')
+
+    def _evict(self):
+        """
+        Evict the least recently used files until the cache fits in
+        `max_size`. Must be called with the lock held.
+        """
+        while self.size > self.max_size and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= self._entry_size(entry)
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Return a dictionary with the size and hit rate of the cache for
+        monitoring purposes.
+        """
+        with self.lock:
+            return {
+                'max_size': self.max_size,
+                'size': self.size,
+                'files': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
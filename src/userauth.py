@@ -0,0 +1,414 @@
+"""
+The userauth module hashes and verifies the passwords of users, reads users
+from users files, and creates and verifies the signed session tokens with
+which clients can authenticate without sending their password on every
+request.
+"""
+
+import base64
+import binascii
+import collections
+import hashlib
+import hmac
+import logging
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+
+# Schemes supported by hash_password(). 'sha256' is the unsalted hash of
+# older versions of Scriptform, which is still accepted by check_password().
+HASH_SCHEMES = ('pbkdf2', 'scrypt', 'sha256')
+PBKDF2_ITERATIONS = 600000
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+# Files starting with this header are read as SQLite databases.
+SQLITE_MAGIC = b'SQLite format 3\x00'
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+SQLITE_CREATE = ("CREATE TABLE IF NOT EXISTS users "
+                 "(username TEXT PRIMARY KEY, password TEXT NOT NULL)")
+# Number of bytes at the end of the part of a text users file that was read,
+# which are compared to see whether the file was only appended to.
+TAIL_SIZE = 4096
+
+
+def _b64encode(data):
+    """
+    Encode `data` as URL-safe base64 without padding.
+    """
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    """
+    Decode URL-safe base64 `text`, of which the padding may be missing.
+    """
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def hash_password(password, scheme='pbkdf2'):
+    """
+    Return a salted hash of `password` for use in the `users` section of the
+    form configuration. `scheme` is one of HASH_SCHEMES.
+    """
+    password = password.encode('utf8')
+    salt = os.urandom(16)
+    if scheme == 'pbkdf2':
+        digest = hashlib.pbkdf2_hmac('sha256', password, salt,
+                                     PBKDF2_ITERATIONS)
+        parts = ['pbkdf2_sha256', str(PBKDF2_ITERATIONS)]
+    elif scheme == 'scrypt':
+        digest = hashlib.scrypt(password, salt=salt, n=SCRYPT_N, r=SCRYPT_R,
+                                p=SCRYPT_P)
+        parts = ['scrypt', str(SCRYPT_N), str(SCRYPT_R), str(SCRYPT_P)]
+    elif scheme == 'sha256':
+        return hashlib.sha256(password).hexdigest()
+    else:
+        raise ValueError("Unknown password hash scheme '{0}'".format(scheme))
+    return '$'.join(parts + [_b64encode(salt), _b64encode(digest)])
+
+
+def check_password(password, pw_hash):
+    """
+    Return True if `password` matches `pw_hash`, which is either a hash made
+    by hash_password() or the hex digest of the unsalted SHA256 hash of the
+    password. Malformed hashes never match.
+    """
+    password = password.encode('utf8')
+    parts = pw_hash.split('$')
+    try:
+        if parts[0] == 'pbkdf2_sha256' and len(parts) == 4:
+            salt, expected = _b64decode(parts[2]), _b64decode(parts[3])
+            digest = hashlib.pbkdf2_hmac('sha256', password, salt,
+                                         int(parts[1]), len(expected))
+        elif parts[0] == 'scrypt' and len(parts) == 6:
+            salt, expected = _b64decode(parts[4]), _b64decode(parts[5])
+            digest = hashlib.scrypt(password, salt=salt, n=int(parts[1]),
+                                    r=int(parts[2]), p=int(parts[3]),
+                                    maxmem=1024 * 1024 * 256,
+                                    dklen=len(expected))
+        elif len(parts) == 1:
+            expected = pw_hash.encode('utf8')
+            digest = hashlib.sha256(password).hexdigest().encode('ascii')
+        else:
+            return False
+    except (ValueError, binascii.Error):
+        return False
+    return hmac.compare_digest(digest, expected)
+
+
+def is_slow_hash(pw_hash):
+    """
+    Return True if checking a password against `pw_hash` is deliberately
+    slow, which is the case for all hashes made by hash_password() except
+    unsalted SHA256 hashes.
+    """
+    return '$' in pw_hash
+
+
+def dummy_hash(users):
+    """
+    Return the password hash to check the password of an unknown user
+    against, so that rejecting unknown users takes as long as rejecting
+    known users with a wrong password, and usernames can't be discovered by
+    timing. It's the hash of an arbitrary user in `users`, so that it has
+    the same scheme and cost as the other hashes. Returns None if there are
+    no users.
+    """
+    for pw_hash in users.values():
+        return pw_hash
+    return None
+
+
+def _sign_session(payload, pw_hash, secret):
+    """
+    Return the signature of the session token `payload`. The password hash
+    of the user is signed along, so that changing the password invalidates
+    existing sessions.
+    """
+    msg = '{0}${1}'.format(payload, pw_hash).encode('utf8')
+    return hmac.new(secret, msg, hashlib.sha256).hexdigest()
+
+
+def make_session(username, pw_hash, secret, lifetime):
+    """
+    Return a session token for `username`, whose password hash is `pw_hash`,
+    that is valid for `lifetime` seconds. The token is signed with `secret`
+    (bytes).
+    """
+    expires = int(time.time()) + lifetime
+    payload = '{0}.{1}'.format(_b64encode(username.encode('utf8')), expires)
+    return '{0}.{1}'.format(payload,
+                            _sign_session(payload, pw_hash, secret))
+
+
+def check_session(token, users, secret):
+    """
+    Return the username of the session `token`, or None if the token isn't
+    valid, has expired or belongs to a user that isn't in `users` (a dict of
+    usernames and password hashes).
+    """
+    try:
+        user, expires, signature = token.split('.')
+        username = _b64decode(user).decode('utf8')
+        expires = int(expires)
+    except (ValueError, binascii.Error):
+        return None
+    if expires < time.time() or username not in users:
+        return None
+    payload = '{0}.{1}'.format(user, expires)
+    expected = _sign_session(payload, users[username], secret)
+    if not hmac.compare_digest(signature.encode('utf8'),
+                               expected.encode('ascii')):
+        return None
+    return username
+
+
+class AuthCache(object):
+    """
+    Thread-safe cache of successfully verified passwords, so that clients
+    that send the same credentials with every request don't have to wait for
+    a slow password hash more than once every `ttl` seconds. Entries are
+    keyed by an HMAC of the credentials with a random key, so passwords
+    aren't kept in memory. At most `max_entries` entries are kept.
+    """
+    def __init__(self, ttl=300, max_entries=1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.key = os.urandom(32)
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # digest -> expiry time
+
+    def check(self, username, password, pw_hash):
+        """
+        Return True if `password` matches `pw_hash` (see check_password()),
+        using the cached result of an earlier successful check if there is
+        one.
+        """
+        if not self.ttl:
+            return check_password(password, pw_hash)
+
+        msg = '\0'.join((username, password, pw_hash)).encode('utf8')
+        digest = hmac.new(self.key, msg, hashlib.sha256).digest()
+        now = time.monotonic()
+        with self.lock:
+            expires = self.entries.get(digest, None)
+            if expires is not None and expires > now:
+                return True
+
+        if not check_password(password, pw_hash):
+            return False
+        with self.lock:
+            self.entries.pop(digest, None)
+            self.entries[digest] = now + self.ttl
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return True
+
+
+def _is_sqlite(path):
+    """
+    Return True if `path` is an SQLite database. Files that don't exist yet
+    are databases if their extension says so.
+    """
+    try:
+        with open(path, 'rb') as users_file:
+            return users_file.read(16) == SQLITE_MAGIC
+    except FileNotFoundError:
+        return os.path.splitext(path)[1] in SQLITE_EXTENSIONS
+
+
+def add_user(path, username, pw_hash):
+    """
+    Add the user `username` with password hash `pw_hash` to the users file
+    `path`, replacing the user's current password if it's already in there.
+    The file is created if it doesn't exist yet. Text files are only
+    appended to (later lines override earlier ones), so that running
+    instances of Scriptform only have to read the new line.
+    """
+    if not username or set(username) & set(':\r\n'):
+        raise ValueError("Invalid username '{0}'".format(username))
+    if _is_sqlite(path):
+        conn = sqlite3.connect(path)
+        try:
+            with conn:
+                conn.execute(SQLITE_CREATE)
+                conn.execute("INSERT OR REPLACE INTO users "
+                             "(username, password) VALUES (?, ?)",
+                             (username, pw_hash))
+        finally:
+            conn.close()
+        return
+    line = '{0}:{1}\n'.format(username, pw_hash).encode('utf8')
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o600)
+    with os.fdopen(fd, 'r+b') as users_file:
+        size = os.fstat(fd).st_size
+        if size:
+            users_file.seek(size - 1)
+            if users_file.read(1) != b'\n':
+                line = b'\n' + line
+        users_file.write(line)
+
+
+class UserFile(object):
+    """
+    The users in a users file, which maps usernames to password hashes like
+    the `users` dict of the form configuration. The file is either a text
+    file with a 'username:hash' line for each user, like htpasswd files, or
+    an SQLite database with a 'users' table with 'username' and 'password'
+    columns.
+
+    The users are kept in a dict, which is replaced by an updated dict when
+    the file has changed, so readers never see it half updated. At most once
+    every `check_interval` seconds, the file is checked for changes. Lines
+    appended to a text file are read without reading the rest of the file
+    again. A last line without a newline may still be being written, so it's
+    only read once its newline is there. If the file can't be read, the users
+    that were read before are kept.
+    """
+    def __init__(self, path, check_interval=1):
+        self.path = path
+        self.check_interval = check_interval
+        self.log = logging.getLogger('USERAUTH')
+        self.lock = threading.Lock()
+        self.users = {}
+        self.version = None
+        self.offset = 0
+        self.tail = b''
+        self.next_check = 0
+        self.sqlite = _is_sqlite(path)
+        # Raise errors about the file right away
+        self._load(self._get_version())
+
+    def _get_version(self):
+        """
+        Return a value that changes whenever the file changes. The
+        write-ahead log of an SQLite database is taken into account as well.
+        """
+        paths = [self.path]
+        if self.sqlite:
+            paths.append(self.path + '-wal')
+        version = []
+        for path in paths:
+            try:
+                file_stat = os.stat(path)
+            except FileNotFoundError:
+                version.append(None)
+                continue
+            version.append((file_stat.st_dev, file_stat.st_ino,
+                            file_stat.st_size, file_stat.st_mtime_ns))
+        return tuple(version)
+
+    def refresh(self):
+        """
+        Reload the users if the file has changed.
+        """
+        version = self._get_version()
+        if version == self.version:
+            return
+        with self.lock:
+            if version == self.version:
+                return
+            try:
+                self._load(version)
+            except (OSError, sqlite3.Error, UnicodeDecodeError) as err:
+                self.log.error("Can't read users file '%s': %s", self.path,
+                               err)
+                self.version = version
+
+    def _check(self):
+        """
+        Refresh the users, unless that was done less than `check_interval`
+        seconds ago.
+        """
+        now = time.monotonic()
+        if now >= self.next_check:
+            self.next_check = now + self.check_interval
+            self.refresh()
+
+    def _load(self, version):
+        """
+        Read the users from the file, which has version `version`. Must be
+        called with the lock held, except from __init__().
+        """
+        if self.sqlite:
+            conn = sqlite3.connect('file:{0}?mode=ro'.format(
+                urllib.parse.quote(self.path)), uri=True)
+            try:
+                rows = conn.execute("SELECT username, password FROM users")
+                self.users = dict(rows)
+            finally:
+                conn.close()
+        else:
+            self._load_text(version)
+        self.version = version
+
+    def _load_text(self, version):
+        """
+        Read the users from a text file. If the file is the same file as
+        before and has only been appended to, only the new lines are read.
+        """
+        with open(self.path, 'rb') as users_file:
+            users = None
+            if self.version is not None and self.version[0] is not None and \
+               version[0] is not None and \
+               self.version[0][:2] == version[0][:2] and \
+               version[0][2] >= self.offset:
+                # Make sure the part that was read before hasn't changed.
+                users_file.seek(self.offset - len(self.tail))
+                if users_file.read(len(self.tail)) == self.tail:
+                    users = dict(self.users)
+            if users is None:
+                users = {}
+                self.offset = 0
+                self.tail = b''
+                users_file.seek(0)
+            data = users_file.read()
+
+        # A last line without a newline may still be being written, so it's
+        # read again next time.
+        done = data.rfind(b'\n') + 1
+        for line in data[:done].decode('utf8').splitlines():
+            line = line.strip()
+            if not line or line.startswith('#') or ':' not in line:
+                continue
+            username, pw_hash = line.split(':', 1)
+            users[username] = pw_hash.strip()
+        self.users = users
+        self.offset += done
+        self.tail = (self.tail + data[:done])[-TAIL_SIZE:]
+
+    def __bool__(self):
+        # A users file always requires authentication, even if it's empty.
+        return True
+
+    def __len__(self):
+        self._check()
+        return len(self.users)
+
+    def __contains__(self, username):
+        self._check()
+        return username in self.users
+
+    def __getitem__(self, username):
+        self._check()
+        return self.users[username]
+
+    def values(self):
+        """
+        Return the password hashes of all users.
+        """
+        self._check()
+        return self.users.values()
+
+    def get(self, username, default=None):
+        """
+        Return the password hash of `username`, or `default` if there's no
+        such user.
+        """
+        self._check()
+        return self.users.get(username, default)
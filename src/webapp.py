@@ -5,87 +5,104 @@ handling them.
 
 import html
 import logging
-import tempfile
+import asyncio
 import os
 import base64
+import binascii
 import hashlib
+import gzip
 import copy
+import shutil
+import codecs
+import json
+import math
+import concurrent.futures
+import http.cookies
 
 from formrender import FormRender
-from webserver import HTTPError, RequestHandler
+from webserver import HTTPError, RequestHandler, AsyncRequestHandler, \
+    RawResponseCompressor, gzip_etag
 import runscript
+import userauth
 
 
+# Name of the cookie holding the session token of logged in users.
+SESSION_COOKIE = 'scriptform_session'
+
 HTML_HEADER = u'''<html>
 <head>
   <meta charset="UTF-8">
-  <style>
-    /* Default classes */
-    .btn {{ color: #FFFFFF; font-weight: bold; font-size: 0.9em;
-            background-color: #1D98E4; padding: 9px; border-radius: 4px;
-            border-width: 0px; text-decoration: none; }}
-    .btn-act {{ background-color: #1D98E4; }}
-    .btn-lnk {{ background-color: #B0B0B0; }}
-    .error {{ color: #FF0000; }}
+  {style}
+</head>
+<body>
+  <h1>{title}</h1>
+  <div class="page">
+'''
+
+HTML_STYLE_INLINE = u'''<style>
+{css}
+  </style>'''
+
+HTML_STYLE_LINK = u'<link rel="stylesheet" href="css?v={version}">'
+
+HTML_CSS = u'''    /* Default classes */
+    .btn { color: #FFFFFF; font-weight: bold; font-size: 0.9em;
+           background-color: #1D98E4; padding: 9px; border-radius: 4px;
+           border-width: 0px; text-decoration: none; }
+    .btn-act { background-color: #1D98E4; }
+    .btn-lnk { background-color: #B0B0B0; }
+    .error { color: #FF0000; }
 
     /* Main element markup */
-    *,body {{ font-family: sans-serif; }}
-    h1 {{ color: #555555; text-align: center; margin: 32px auto 32px auto; }}
-    pre {{ font-family: monospace; }}
+    *,body { font-family: sans-serif; }
+    h1 { color: #555555; text-align: center; margin: 32px auto 32px auto; }
+    pre { font-family: monospace; }
 
     /* List of available forms */
-    div.list {{ width: 50%; margin: 40px auto 0px auto; }}
-    div.list li {{ font-size: 0.90em; list-style: none;
-                  margin-bottom: 65px; }}
-    div.list h2 {{ background-color: #E0E5E5;
-                  border-radius: 3px; font-weight: bold;
-                  padding: 10px; font-size: 1.2em; }}
-    div.list p.form-description {{ margin-left: 25px; }}
-    div.list a.form-link {{ margin-left: 25px; }}
+    div.list { width: 50%; margin: 40px auto 0px auto; }
+    div.list li { font-size: 0.90em; list-style: none;
+                 margin-bottom: 65px; }
+    div.list h2 { background-color: #E0E5E5;
+                 border-radius: 3px; font-weight: bold;
+                 padding: 10px; font-size: 1.2em; }
+    div.list p.form-description { margin-left: 25px; }
+    div.list a.form-link { margin-left: 25px; }
 
     /* Form display */
-    div.form {{ width: 50%; margin: 40px auto 0px auto; }}
-    div.form h2 {{ font-weight: bold; background-color: #E0E5E5; padding: 25px;
-                  border-radius: 10px; }}
-    div.form p.form-description {{ font-size: 0.90em;
-                                  margin: 40px 25px 65px 25px; }}
-    div.form li {{ font-size: 0.90em; list-style: none; }}
-    div.form li.hidden {{ display: none; }}
-    div.form p.form-field-title {{ margin-bottom: 0px; }}
-    div.form p.form-field-input {{ margin-top: 0px; }}
-    div.form li.checkbox p.form-field-input {{ display: inline; }}
-    div.form li.checkbox p.form-field-title {{ display: inline; }}
-    div.form li.required abbr {{ color: #FF0000; }}
+    div.form { width: 50%; margin: 40px auto 0px auto; }
+    div.form h2 { font-weight: bold; background-color: #E0E5E5; padding: 25px;
+                 border-radius: 10px; }
+    div.form p.form-description { font-size: 0.90em;
+                                 margin: 40px 25px 65px 25px; }
+    div.form li { font-size: 0.90em; list-style: none; }
+    div.form li.hidden { display: none; }
+    div.form p.form-field-title { margin-bottom: 0px; }
+    div.form p.form-field-input { margin-top: 0px; }
+    div.form li.checkbox p.form-field-input { display: inline; }
+    div.form li.checkbox p.form-field-title { display: inline; }
+    div.form li.required abbr { color: #FF0000; }
     select,
     textarea,
     input[type=text],
     input[type=number],
     input[type=date],
-    input[type=password] {{ color: #606060; padding: 9px; border-radius: 4px;
-                            border: 1px solid #D0D0D0;
-                            background-color: #F9F9F9; }}
-    textarea {{ font-family: monospace; }}
+    input[type=password] { color: #606060; padding: 9px; border-radius: 4px;
+                           border: 1px solid #D0D0D0;
+                           background-color: #F9F9F9; }
+    textarea { font-family: monospace; }
 
     /* Result display */
-    div.result {{ width: 50%; margin: 40px auto 0px auto; }}
-    div.result h2 {{ background-color: #E0E5E5; border-radius: 3px;
-                    font-weight: bold; padding: 10px; }}
-    div.result div.result-result {{ margin-left: 25px; }}
-    div.result ul.nav {{ margin: 64px 0px 128px 0px; padding-left: 0px; }}
-    div.result ul.nav li {{ list-style: none; float: left;
-                        font-size: 0.90em; margin-right: 20px; }}
+    div.result { width: 50%; margin: 40px auto 0px auto; }
+    div.result h2 { background-color: #E0E5E5; border-radius: 3px;
+                   font-weight: bold; padding: 10px; }
+    div.result div.result-result { margin-left: 25px; }
+    div.result ul.nav { margin: 64px 0px 128px 0px; padding-left: 0px; }
+    div.result ul.nav li { list-style: none; float: left;
+                       font-size: 0.90em; margin-right: 20px; }
 
     /* Other */
-    div.about {{ text-align: center; font-size: 12px; color: #808080; }}
-    div.about a {{ text-decoration: none; color: #000000; }}
-
-    /* Custom css */
-    {custom_css}
-  </style>
-</head>
-<body>
-  <h1>{title}</h1>
-  <div class="page">
+    div.about { text-align: center; font-size: 12px; color: #808080; }
+    div.about a { text-decoration: none; color: #000000; }
 '''
 
 HTML_FOOTER = u'''
@@ -100,15 +117,12 @@ HTML_FOOTER = u'''
 '''
 
 HTML_LIST = u'''
-{header}
 <div class="list">
   {form_list}
 </div>
-{footer}
 '''
 
 HTML_FORM = u'''
-{header}
 <div class="form">
   <h2 class="form-title">{title}</h2>
   <p class="form-description">{description}</p>
@@ -128,7 +142,6 @@ HTML_FORM = u'''
     </ul>
   </form>
 </div>
-{footer}
 '''
 
 HTML_FORM_LIST = u'''
@@ -142,7 +155,6 @@ HTML_FORM_LIST = u'''
 '''
 
 HTML_SUBMIT_RESPONSE = u'''
-{header}
 <div class="result">
   <h2 class="result-title">{title}</h2>
   <h3 class="result-subtitle">Result</h3>
@@ -156,31 +168,365 @@ HTML_SUBMIT_RESPONSE = u'''
     <li><a class="btn btn-lnk" href=".">Back to the list</a></li>
   </ul>
 </div>
-{footer}
 '''
 
+HTML_JOB = u'''
+<div class="result">
+  <h2 class="result-title">{title}</h2>
+  <h3 class="result-subtitle">Job {job_id}: {status}</h3>
+  <div class="result-result">{msg}</div>
+  <ul class="nav">
+    <li>
+      <a class="back-form btn btn-lnk" href="form?form_name={form_name}">
+        Back to the form
+      </a>
+    </li>
+    <li><a class="btn btn-lnk" href=".">Back to the list</a></li>
+  </ul>
+</div>
+'''
+
+HTML_JOB_PENDING = u'<p>The job has not finished yet. This page refreshes ' \
+                   u'automatically.</p>'
+
+OUTPUT_CHUNK_SIZE = 1024 * 64
+
+
+class PageChrome(object):
+    """
+    The header and footer shared by all pages of a FormConfig, rendered once
+    as encoded bytes. If the form config has `external_css` set, the CSS is
+    not included in the header but served separately from '/css', so
+    browsers can cache it.
+    """
+    def __init__(self, form_config):
+        css = HTML_CSS
+        if form_config.custom_css:
+            css += u'\n    /* Custom css */\n' + form_config.custom_css
+        self.css = css.encode('utf8')
+        self.css_version = hashlib.sha256(self.css).hexdigest()[:16]
+        self.css_etag = '"{0}"'.format(self.css_version)
+        if form_config.external_css:
+            style = HTML_STYLE_LINK.format(version=self.css_version)
+        else:
+            style = HTML_STYLE_INLINE.format(css=css)
+        self.header = HTML_HEADER.format(
+            title=form_config.title,
+            style=style
+        ).encode('utf8')
+        self.footer = HTML_FOOTER.encode('utf8')
+
+
+def get_page_chrome(form_config):
+    """
+    Return the PageChrome for `form_config`. It's rendered on first use and
+    kept in the form config's render cache.
+    """
+    chrome = form_config.render_cache.get('chrome')
+    if chrome is None:
+        chrome = PageChrome(form_config)
+        form_config.render_cache['chrome'] = chrome
+    return chrome
+
 
-def censor_form_values(form_def, form_values):
+def censor_form_values(resolved, form_values):
     """
-    Remove sensitive field values from form_values dict.
+    Remove sensitive field values from form_values dict. `resolved` is the
+    ResolvedForm the values were validated against.
     """
     censored_form_values = copy.copy(form_values)
-    for field in form_def.get_fields():
+    for field in resolved.fields:
         if field['type'] == 'password':
             censored_form_values[field['name']] = '********'
     return censored_form_values
 
 
+def call_script(form_def, form_values, username, resolved, stdout=None,
+                stderr=None, spool=False, live=None):
+    """
+    Log the call for auditing purposes and run the script of `form_def` with
+    the validated `form_values`. Returns the result of
+    `runscript.run_script()`.
+    """
+    env = script_env(form_def, form_values, username, resolved)
+    return runscript.run_script(form_def, form_values, env, stdout, stderr,
+                                spool, live,
+                                resolved.get_uploads(form_values))
+
+
+async def call_script_async(form_def, form_values, username, resolved,
+                            stdout=None, stderr=None, spool=False, live=None,
+                            drain=None):
+    """
+    Like call_script(), but for use in an asyncio event loop. Returns the
+    result of `runscript.run_script_async()`.
+    """
+    env = script_env(form_def, form_values, username, resolved)
+    return await runscript.run_script_async(form_def, form_values, env,
+                                            stdout, stderr, spool, live,
+                                            drain,
+                                            resolved.get_uploads(form_values))
+
+
+def script_env(form_def, form_values, username, resolved):
+    """
+    Log the call of the script of `form_def` for auditing purposes and return
+    the base environment for it.
+    """
+    # Log the callback and its parameters for auditing purposes.
+    log = logging.getLogger('CALLBACK_AUDIT')
+    cwd = os.path.realpath(os.curdir)
+    log.info("Calling script: %s", form_def.script)
+    log.info("Current working dir: %s", cwd)
+    log.info("User: %s", username)
+    log.info("Vars: %s", censor_form_values(resolved, form_values))
+
+    # Construct base environment. The field values are added in
+    # run_scripts.
+    env = os.environ.copy()
+    env["__SF__FORM"] = form_def.name
+    if username is not None:
+        env["__SF__USER"] = username
+    return env
+
+
+def iter_result(form_def, stdout, stderr, exitcode):
+    """
+    Generate the output of a script as HTML in chunks, depending on the exit
+    code and the form's output type. `stdout` and `stderr` are file objects,
+    which are read incrementally so large outputs are never fully in memory.
+    """
+    if exitcode != 0:
+        yield u'<span class="error">'
+        for chunk in _iter_decoded(stderr):
+            yield html.escape(chunk)
+        yield u'</span>'
+    elif form_def.output == 'escaped':
+        yield u'<pre>'
+        for chunk in _iter_decoded(stdout):
+            yield html.escape(chunk)
+        yield u'</pre>'
+    else:
+        # Non-escaped output (html, usually)
+        for chunk in _iter_decoded(stdout):
+            yield chunk
+
+
+def iter_live_result(form_def, stderr, exitcode):
+    """
+    Generate the HTML that closes the output of a script that was streamed
+    to the client with LiveOutput: the errors, if any, and the exit code.
+    """
+    if form_def.output == 'escaped':
+        yield u'</pre>'
+    if exitcode != 0:
+        yield u'<span class="error">'
+        for chunk in _iter_decoded(stderr):
+            yield html.escape(chunk)
+        yield u'</span>'
+    yield u'<p class="result-exitcode">Exit code: {0}</p>'.format(exitcode)
+
+
+def _iter_decoded(output_file):
+    """
+    Read `output_file` in chunks and generate them decoded as UTF8.
+    """
+    decoder = codecs.getincrementaldecoder('utf8')('replace')
+    while True:
+        buf = output_file.read(OUTPUT_CHUNK_SIZE)
+        if not buf:
+            break
+        yield decoder.decode(buf)
+    yield decoder.decode(b'', final=True)
+
+
+def _decode_output(output):
+    """
+    Decode script output, which is normally bytes but may be a string if the
+    script couldn't be run.
+    """
+    if isinstance(output, bytes):
+        return output.decode('utf8', 'replace')
+    return output
+
+
+def batch_results(line_nrs, validated):
+    """
+    Return the initial results of the `validated` rows of a batch
+    submission: the number of each row, the number of the line it was on
+    (from `line_nrs`) and its validation errors.
+    """
+    return [{'row': row_nr, 'line': line_nr, 'errors': row_errors}
+            for row_nr, (line_nr, (row_errors, _))
+            in enumerate(zip(line_nrs, validated))]
+
+
+def add_batch_result(row_result, result):
+    """
+    Add the `result` of a script to the `row_result` of a batch submission.
+    """
+    row_result.update({
+        'exitcode': result['exitcode'],
+        'stdout': _decode_output(result['stdout']),
+        'stderr': _decode_output(result['stderr']),
+    })
+
+
+def queue_full_error(err):
+    """
+    Return a 503 HTTPError for the runscript.QueueFullError `err`, telling
+    the client to retry after the queue timeout.
+    """
+    queue_timeout = runscript.script_limiter.queue_timeout or 0
+    retry_after = max(1, int(math.ceil(queue_timeout)))
+    headers = {'Retry-After': str(retry_after)}
+    return HTTPError(503, "Server busy: {0}".format(err), headers)
+
+
+def get_form_render(form_config, form_def):
+    """
+    Return the FormRender for `form_def`. It's kept in the form config's
+    render cache, so fields are only compiled once.
+    """
+    cache_key = ('form_render', form_def.name)
+    form_render = form_config.render_cache.get(cache_key)
+    if form_render is None:
+        form_render = FormRender(form_def)
+        form_config.render_cache[cache_key] = form_render
+    return form_render
+
+
+class LiveOutput(object):
+    """
+    Write the stdout of a script to the client as soon as it's read, for
+    forms with `stream` enabled. The response headers and the start of the
+    page (`head`, as bytes) are sent when the script is started. The output
+    is escaped unless the form's output is 'html'.
+    """
+    def __init__(self, request_handler, form_def, head):
+        self.request_handler = request_handler
+        self.head = head
+        self.escape = form_def.output == 'escaped'
+        self.decoder = codecs.getincrementaldecoder('utf8')('replace')
+        self.started = False
+
+    def start(self):
+        """
+        Send the response headers and the start of the page.
+        """
+        self.request_handler.send_response(200)
+        self.request_handler.send_header('Content-type', 'text/html')
+        self.request_handler.send_header('Cache-Control', 'no-cache')
+        # Ask proxies such as Nginx not to buffer the response.
+        self.request_handler.send_header('X-Accel-Buffering', 'no')
+        self.request_handler.start_stream(compress=True)
+        self.request_handler.write_stream(self.head)
+        if self.escape:
+            self.write_text(u'<pre>')
+        self.started = True
+
+    def write(self, buf):
+        """
+        Decode, escape and send a piece of the script's output.
+        """
+        self.write_output(self.decoder.decode(buf))
+
+    def finish(self):
+        """
+        Send any output that's still left in the decoder.
+        """
+        self.write_output(self.decoder.decode(b'', final=True))
+
+    def write_output(self, text):
+        """
+        Escape (if required) and send `text`.
+        """
+        if self.escape:
+            text = html.escape(text)
+        self.write_text(text)
+
+    def write_text(self, text):
+        """
+        Send `text` to the client.
+        """
+        if text:
+            self.request_handler.write_stream(text.encode('utf8'))
+            self.request_handler.flush_stream()
+
+
+def batch_value(value, line_nr, key):
+    """
+    Convert the JSON `value` of field `key` on line `line_nr` of a batch
+    submission to the string a browser would have submitted for it. Raises a
+    400 HTTPError for values that aren't scalars.
+    """
+    if isinstance(value, str):
+        return value
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'on' if value else 'off'
+    if isinstance(value, (int, float)):
+        return str(value)
+    msg = "Invalid value for '{0}' on line {1}".format(key, line_nr)
+    raise HTTPError(400, msg)
+
+
 class ScriptFormWebApp(RequestHandler):
     """
     This class is a request handler for the webserver.
     """
+    form_config = None
+    authenticated = False
+    username = None
+    auth_error = None
+    session_cookie = None
+
+    def handle_one_request(self):
+        """
+        Handle a single request. The form configuration is looked up again
+        and the user is authenticated again for every request.
+        """
+        self.form_config = None
+        self.authenticated = False
+        self.username = None
+        self.auth_error = None
+        RequestHandler.handle_one_request(self)
+
+    def get_form_limits(self):
+        """
+        Return the size limits for submitted form data from the form config.
+        """
+        form_config = self.get_form_config()
+        return {
+            'max_request_size': form_config.max_request_size,
+            'max_field_size': form_config.max_field_size,
+            'max_file_size': form_config.max_file_size,
+        }
+
+    def get_compression(self):
+        """
+        Return the compression settings for responses from the form config.
+        """
+        form_config = self.get_form_config()
+        return form_config.compress_level, form_config.compress_min_size
+
+    def get_form_config(self):
+        """
+        Return the form configuration for the current request. It's retrieved
+        once per request, so that a request is handled entirely with the same
+        configuration, even if it's reloaded in the meantime.
+        """
+        if self.form_config is None:
+            self.form_config = self.scriptform.get_form_config()
+        return self.form_config
+
     def index(self):
         """
         Index handler. If there's only one form defined, render that form.
         Otherwise render a list of available forms.
         """
-        form_config = self.scriptform.get_form_config()
+        form_config = self.get_form_config()
 
         username = self.auth()
         visible_forms = form_config.get_visible_forms(username)
@@ -196,29 +542,52 @@ class ScriptFormWebApp(RequestHandler):
         definition contains a 'users' field (unless pre-auth from a front-end
         such as Apache is used). Returns the username if the user is validated
         or None if no validation is required. Otherwise, raises a 401 HTTP
-        back to the client.
+        back to the client. The result (or the HTTP error) is remembered for
+        the rest of the request.
+        """
+        if not self.authenticated:
+            try:
+                self.username = self._authenticate()
+            except HTTPError as err:
+                self.auth_error = err
+            self.authenticated = True
+        if self.auth_error is not None:
+            raise self.auth_error
+        return self.username
+
+    def _authenticate(self):
         """
-        form_config = self.scriptform.get_form_config()
-        username = None
+        Authenticate the user of the current request. See auth().
+        """
+        form_config = self.get_form_config()
 
         # Allow pre-auth from e.g. Apache htauth
         if 'REMOTE_USER' in self.headers:
-            username = self.headers.get('REMOTE_USER')
             return self.headers.get('REMOTE_USER')
 
         # If a 'users' element was present in the form configuration file, the
         # user must be authenticated.
         if form_config.users:
-            auth_header = self.headers.get("Authorization")
-            if auth_header is not None:
+            # A valid session cookie saves checking the password again.
+            if form_config.session_lifetime:
+                token = self.get_cookie(SESSION_COOKIE)
+                if token is not None:
+                    username = userauth.check_session(
+                        token, form_config.users, form_config.session_secret)
+                    if username is not None:
+                        return username
+
+            credentials = self.get_basic_auth()
+            if credentials is not None:
                 # Validate the username and password
-                auth_unpw = auth_header.split(' ', 1)[1].encode('utf-8')
-                username, password = \
-                    base64.b64decode(auth_unpw).decode('utf-8').split(":", 1)
-                pw_hash = hashlib.sha256(password.encode('utf-8')).hexdigest()
-                if username in form_config.users and \
-                   pw_hash == form_config.users[username]:
+                username, password = credentials
+                pw_hash = self.check_password(form_config, username, password)
+                if pw_hash is not None:
                     # Valid username and password. Return the username.
+                    if form_config.session_lifetime:
+                        self.session_cookie = userauth.make_session(
+                            username, pw_hash, form_config.session_secret,
+                            form_config.session_lifetime)
                     return username
 
             # Authentication needed, but not provided or wrong username/pw.
@@ -228,159 +597,157 @@ class ScriptFormWebApp(RequestHandler):
         # No authentication required. Return None as the username.
         return None
 
+    @staticmethod
+    def check_password(form_config, username, password):
+        """
+        Check the `password` of `username` against the users in `form_config`.
+        Returns the user's password hash if it's correct, or None otherwise.
+        """
+        pw_hash = form_config.users.get(username, None)
+        if pw_hash is None:
+            # Spend as much time as on checking a known user's password, so
+            # that usernames can't be discovered by timing.
+            fake_hash = userauth.dummy_hash(form_config.users)
+            if fake_hash is not None:
+                userauth.check_password(password, fake_hash)
+            return None
+        if not form_config.auth_cache.check(username, password, pw_hash):
+            return None
+        return pw_hash
+
+    def get_basic_auth(self):
+        """
+        Return the username and password from the Basic Authorization header
+        of the request, or None if there's no such (valid) header.
+        """
+        auth_header = self.headers.get("Authorization")
+        if auth_header is None:
+            return None
+        try:
+            scheme, auth_unpw = auth_header.split(' ', 1)
+            if scheme.lower() != 'basic':
+                return None
+            username, password = base64.b64decode(
+                auth_unpw.strip(), validate=True).decode('utf-8').split(":", 1)
+        except (ValueError, binascii.Error):
+            return None
+        return username, password
+
+    def get_cookie(self, name):
+        """
+        Return the value of the cookie `name` of the request, or None if it
+        wasn't sent.
+        """
+        try:
+            cookies = http.cookies.SimpleCookie(self.headers.get('Cookie', ''))
+        except http.cookies.CookieError:
+            return None
+        if name not in cookies:
+            return None
+        return cookies[name].value
+
+    def end_headers(self):
+        """
+        Send the blank line ending the headers, preceded by the session
+        cookie if the user logged in with this request.
+        """
+        if self.session_cookie is not None:
+            form_config = self.get_form_config()
+            cookie = '{0}={1}; Max-Age={2}; Path=/; HttpOnly; SameSite=Lax'
+            self.send_header('Set-Cookie', cookie.format(
+                SESSION_COOKIE, self.session_cookie,
+                form_config.session_lifetime))
+            self.session_cookie = None
+        RequestHandler.end_headers(self)
+
     def h_list(self):
         """
-        Render a list of available forms.
+        Render a list of available forms. The list only depends on which forms
+        the user can see, so it's cached for each set of visible forms.
         """
         username = self.auth()
-        form_config = self.scriptform.get_form_config()
-        h_form_list = []
-        for form_def in form_config.get_visible_forms(username):
-            h_form_list.append(
-                HTML_FORM_LIST.format(
-                    title=form_def.title,
-                    description=form_def.description,
-                    name=form_def.name
+        form_config = self.get_form_config()
+        visible_forms = form_config.get_visible_forms(username)
+
+        def render():
+            """
+            Render the list of forms.
+            """
+            h_form_list = []
+            for form_def in visible_forms:
+                h_form_list.append(
+                    HTML_FORM_LIST.format(
+                        title=form_def.title,
+                        description=form_def.description,
+                        name=form_def.name
+                    )
                 )
+            return HTML_LIST.format(
+                form_list=u''.join(h_form_list)
             )
 
-        output = HTML_LIST.format(
-            header=HTML_HEADER.format(title=form_config.title,
-                                      custom_css=form_config.custom_css),
-            footer=HTML_FOOTER,
-            form_list=u''.join(h_form_list)
-        )
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(output.encode('utf8'))
+        form_names = tuple(form_def.name for form_def in visible_forms)
+        self.write_cached_page(('list', form_names), render)
 
     def h_form(self, form_name, errors=None, **form_values):
         """
         Render a form.
         """
-        def render_field(field, errors):
-            """
-            Render a HTML field.
-            """
-            params = {
-                'name': field['name'],
-                'classes': [],
-            }
-
-            if field.get('hidden', None):
-                params['classes'].append('hidden')
-
-            if field.get('required', None):
-                params['classes'].append('required')
-
-            params['classes'].extend(field.get('classes', '').split())
-
-            params["style"] = field.get("style", "")
-
-            # Get field-specific parameters
-            if field['type'] not in ('file', 'checkbox'):
-                default_value = field.get('default_value', '')
-                params['value'] = form_values.get(field['name'], default_value)
+        self.render_form(form_name, errors, form_values)
 
-            if field['type'] not in ('radio', 'checkbox', 'select'):
-                params['required'] = field.get('required', False)
-
-            if field['type'] == 'string':
-                params['size'] = field.get('size', '')
-
-            if field['type'] in ('string', 'password', 'text'):
-                params['minlen'] = field.get('minlen', '')
-
-            if field['type'] in ('string', 'text'):
-                params['maxlen'] = field.get('maxlen', '')
-
-            if field['type'] in ('integer', 'float'):
-                params['minval'] = field.get('min', '')
-                params['maxval'] = field.get('max', '')
-
-            if field['type'] == 'date':
-                params['minval'] = field.get('min', '')
-                params['maxval'] = field.get('max', '')
-
-            if field['type'] == 'text':
-                params['rows'] = field.get('rows', '')
-                params['cols'] = field.get('cols', '')
-
-            if field['type'] == 'radio':
-                if 'options_from' in field:
-                    fname = field['options_from']
-                    options = runscript.from_file(fname)
-                else:
-                    options = field['options']
-
-                if not form_values.get(field['name'], None):
-                    # Set default value
-                    params['value'] = options[0][0]
-
-            if field['type'] in ('radio', 'select'):
-                if 'options_from' in field:
-                    fname = field['options_from']
-                    params['options'] = runscript.from_file(fname)
-                else:
-                    params['options'] = field['options']
-
-            if field['type'] == 'checkbox':
-                # Set default value from field definition
-                params['checked'] = False
-                if 'checked' in field and field['checked']:
-                    params['checked'] = True
-
-                # Set value from submitted form if applicable
-                if field['name'] in form_values:
-                    if form_values[field['name']] == 'on':
-                        params['checked'] = True
-                    else:
-                        params['checked'] = False
-
-            h_input = fr_inst.r_field(field['type'], **params)
-
-            return fr_inst.r_form_line(field['type'], field['title'],
-                                       h_input, params['classes'], errors)
+    def get_allowed_form(self, form_name):
+        """
+        Authenticate the user and return the form definition of `form_name`.
+        Raises a 403 HTTP error if the user isn't allowed to access it.
+        """
+        username = self.auth()
+        form_def = self.get_form_config().get_form_def(form_name)
+        if form_def.allowed_users is not None and \
+           username not in form_def.allowed_users:
+            raise HTTPError(403, "You're not authorized to view this form")
+        return form_def
 
+    def render_form(self, form_name, errors, form_values, resolved=None):
+        """
+        Render the form `form_name`, filled with `form_values` and showing
+        `errors`. `resolved` is an optional ResolvedForm of the form, so that
+        dynamic fields and options used during validation can be reused.
+        """
         if errors is None:
             errors = {}
 
-        username = self.auth()
-        form_config = self.scriptform.get_form_config()
-        fr_inst = FormRender(None)
+        form_config = self.get_form_config()
+        form_def = self.get_allowed_form(form_name)
+        if resolved is None:
+            resolved = form_def.resolve()
 
-        # Make sure the user is allowed to access this form.
-        form_def = form_config.get_form_def(form_name)
-        if form_def.allowed_users is not None and \
-           username not in form_def.allowed_users:
-            raise HTTPError(403, "You're not authorized to view this form")
+        def render():
+            """
+            Render the form.
+            """
+            html_errors = u''
+            if errors:
+                html_errors = u'<ul>'
+                for error in errors:
+                    html_errors += u'<li class="error">{0}</li>'.format(error)
+                html_errors += u'</ul>'
+
+            return HTML_FORM.format(
+                title=form_def.title,
+                description=form_def.description,
+                errors=html_errors,
+                name=form_def.name,
+                fields=get_form_render(form_config, form_def).render_fields(
+                    resolved.fields, form_values, errors, resolved
+                ),
+                submit_title=form_def.submit_title
+            )
 
-        html_errors = u''
-        if errors:
-            html_errors = u'<ul>'
-            for error in errors:
-                html_errors += u'<li class="error">{0}</li>'.format(error)
-            html_errors += u'</ul>'
-
-        output = HTML_FORM.format(
-            header=HTML_HEADER.format(title=form_config.title,
-                                      custom_css=form_config.custom_css),
-            footer=HTML_FOOTER,
-            title=form_def.title,
-            description=form_def.description,
-            errors=html_errors,
-            name=form_def.name,
-            fields=u''.join(
-                [render_field(f, errors.get(f['name'], []))
-                 for f in form_def.get_fields()]
-            ),
-            submit_title=form_def.submit_title
-        )
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        self.wfile.write(output.encode('utf8'))
+        if not errors and not form_values and form_def.is_static():
+            # The empty form is the same for everybody.
+            self.write_cached_page(('form', form_def.name), render)
+        else:
+            self.write_page(render())
 
     def h_submit(self, form_values):
         """
@@ -388,126 +755,756 @@ class ScriptFormWebApp(RequestHandler):
         a callback to a script. How the output is handled depends on settings
         in the form definition.
         """
-        username = self.auth()
-
-        form_config = self.scriptform.get_form_config()
-        form_name = form_values.getfirst('form_name', None)
-        form_def = form_config.get_form_def(form_name)
-        if form_def.allowed_users is not None and \
-           username not in form_def.allowed_users:
-            raise HTTPError(403, "You're not authorized to view this form")
+        form_def, values, username = self.read_submission(form_values)
+        self.submit(form_def, values, username, form_values.tmp_files)
 
-        # Convert FieldStorage to a simple dict, because we're not allowd to
-        # add items to it. For normal fields, the form field name becomes the
-        # key and the value becomes the field value. For file upload fields, we
-        # stream the uploaded file to a temp file and then put the temp file in
-        # the destination dict. We also add an extra field with the originally
-        # uploaded file's name.
+    def read_submission(self, form_values):
+        """
+        Authenticate the user and read the submitted `form_values` (a
+        formparser.FormData). Returns the form definition, the values as a
+        dict and the username.
+        """
+        username = self.auth()
+        form_def = self.get_allowed_form(
+            form_values.getfirst('form_name', None))
+
+        # Convert the form data to a simple dict. For normal fields, the form
+        # field name becomes the key and the value becomes the field value.
+        # Uploaded files were already streamed to a temp file while the
+        # request was parsed, so the temp file is put in the dict. We also
+        # add an extra field with the originally uploaded file's name.
         values = {}
-        tmp_files = []
         for field_name in form_values:
             field = form_values[field_name]
             if field.filename is not None:
-                # Field is an uploaded file. Stream it to a temp file if
-                # something was actually uploaded
+                # Field is an uploaded file. Skip it if nothing was actually
+                # uploaded.
                 if field.filename == '':
                     continue
-                tmp_fname = tempfile.mktemp(prefix="scriptform_")
-                with open(tmp_fname, "wb") as tmp_file:
-                    while True:
-                        buf = field.file.read(1024 * 16)
-                        if not buf:
-                            break
-                        tmp_file.write(buf)
-                field.file.close()
-
-                tmp_files.append(tmp_fname)  # For later cleanup
-                values[field_name] = tmp_fname
+                values[field_name] = field.path
                 values['{0}__name'.format(field_name)] = field.filename
+            elif field_name.endswith('__name') and \
+                    field_name[:-len('__name')] in form_values:
+                # A normal field can't pretend to be the original name of an
+                # uploaded file, or it could pass off any path as an upload.
+                continue
             else:
                 # Field is a normal form field. Store its value.
-                values[field_name] = form_values.getfirst(field_name, None)
+                values[field_name] = field.value
 
-        form_errors, form_values = form_def.validate(values)
+        return form_def, values, username
 
-        if not form_errors:
+    def submit(self, form_def, values, username, tmp_files):
+        """
+        Validate the submitted `values` for `form_def` and call the script if
+        they're valid. Otherwise the form is shown again with the errors.
+        Asynchronous forms take over the uploaded `tmp_files` and clean them
+        up once the job has finished.
+        """
+        resolved = form_def.resolve()
+        form_errors, form_values = form_def.validate(values, resolved)
+
+        if not form_errors and form_def.run_async:
+            self.submit_job(form_def, form_values, username, resolved,
+                            tmp_files)
+        elif not form_errors and form_def.stream and form_def.output != 'raw':
+            self.submit_live(form_def, form_values, username, resolved)
+        elif not form_errors:
             # Call script. If a result is returned, we wrap its output in some
             # nice HTML. If no result is returned, the output was raw and the
             # callback should have written its own response to the self.wfile
             # filehandle.
-
-            # Log the callback and its parameters for auditing purposes.
-            log = logging.getLogger('CALLBACK_AUDIT')
-            cwd = os.path.realpath(os.curdir)
-            log.info("Calling script: %s", form_def.script)
-            log.info("Current working dir: %s", cwd)
-            log.info("User: %s", username)
-            log.info("Vars: %s", censor_form_values(form_def, form_values))
-
-            form_def = form_config.get_form_def(form_name)
-
-            # Construct base environment. The field values are added in
-            # run_scripts.
-            env = os.environ.copy()
-            env["__SF__FORM"] = form_name
-            if username is not None:
-                env["__SF__USER"] = username
-
-            result = runscript.run_script(form_def, form_values, env,
-                                          self.wfile, self.wfile)
+            output = self.wfile
+            if form_def.output == 'raw':
+                # The script writes directly to the connection, which it
+                # can't do if the connection has a timeout (and is thus
+                # non-blocking). Since the length of the output isn't known,
+                # the connection is closed afterwards.
+                self.connection.settimeout(None)
+                self.close_connection = True
+                output = self.raw_output(form_def)
+
+            try:
+                result = call_script(form_def, form_values, username,
+                                     resolved, output, output, spool=True)
+            except runscript.QueueFullError as err:
+                raise queue_full_error(err) from None
             if form_def.output != 'raw':
                 # Ignore everything if we're doing raw output, since it's the
                 # scripts responsibility.
-                if result['exitcode'] != 0:
-                    stderr = html.escape(result['stderr'].decode('utf8'))
-                    msg = u'<span class="error">{0}</span>'.format(stderr)
-                else:
-                    if form_def.output == 'escaped':
-                        stdout = html.escape(result['stdout'].decode('utf8'))
-                        msg = u'<pre>{0}</pre>'.format(stdout)
-                    else:
-                        # Non-escaped output (html, usually)
-                        msg = result['stdout'].decode('utf8')
-
-                output = HTML_SUBMIT_RESPONSE.format(
-                    header=HTML_HEADER.format(
-                        title=form_config.title,
-                        custom_css=form_config.custom_css
-                    ),
-                    footer=HTML_FOOTER,
-                    title=form_def.title,
-                    form_name=form_def.name,
-                    msg=msg,
-                )
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                self.wfile.write(output.encode('utf8'))
+                self.write_submit_result(form_def, result)
+            elif output is not self.wfile:
+                output.close()
         else:
             # Form had errors
             form_values.pop('form_name')
-            self.h_form(form_name, form_errors, **form_values)
+            self.render_form(form_def.name, form_errors, form_values,
+                             resolved)
+
+    def raw_output(self, form_def):
+        """
+        Return the file-like object to which the output of `form_def`, which
+        has raw output, should be written. That's the connection, unless the
+        form has `compress` enabled and the client accepts compressed
+        responses.
+        """
+        level = self.get_compression()[0]
+        if form_def.compress and level and self.accepts_gzip():
+            return RawResponseCompressor(self.wfile, level)
+        return self.wfile
+
+    def submit_job(self, form_def, form_values, username, resolved,
+                   tmp_files):
+        """
+        Run the script of `form_def` in the background and send the user to
+        the job page. The job takes over the uploaded `tmp_files`.
+        """
+        def run_cb():
+            """
+            Run the script of the job.
+            """
+            return call_script(form_def, form_values, username, resolved,
+                               spool=True)
+        job = self.scriptform.job_store.submit(form_def.name, username,
+                                               run_cb, list(tmp_files))
+        del tmp_files[:]
+        self.send_response(303)
+        self.send_header('Location', 'job?id={0}'.format(job.job_id))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def write_submit_result(self, form_def, result):
+        """
+        Send the page with the `result` of the script of `form_def`.
+        """
+        with result['stdout'], result['stderr']:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/html')
+            self.start_stream(compress=True)
+            self.write_result_page(
+                HTML_SUBMIT_RESPONSE,
+                iter_result(form_def, result['stdout'],
+                            result['stderr'], result['exitcode']),
+                title=form_def.title,
+                form_name=form_def.name,
+            )
+
+    def submit_live(self, form_def, form_values, username, resolved):
+        """
+        Call the script of `form_def` and stream its output to the client
+        while it runs. The exit code and any errors follow the output.
+        """
+        head, tail = self.split_result_page(HTML_SUBMIT_RESPONSE,
+                                            title=form_def.title,
+                                            form_name=form_def.name)
+        live = LiveOutput(self, form_def, head)
+        try:
+            result = call_script(form_def, form_values, username, resolved,
+                                 spool=True, live=live)
+        except runscript.QueueFullError as err:
+            raise queue_full_error(err) from None
+        self.write_live_result(form_def, live, result, tail)
+
+    def write_live_result(self, form_def, live, result, tail):
+        """
+        Send the end of the page of a script whose output was sent to the
+        client by `live`: its errors and exit code, followed by `tail`.
+        """
+        with result['stdout'], result['stderr']:
+            if not live.started:
+                live.start()
+            live.finish()
+            for chunk in iter_live_result(form_def, result['stderr'],
+                                          result['exitcode']):
+                live.write_text(chunk)
+        self.write_stream(tail)
+        self.end_stream()
+
+    def write_page(self, body):
+        """
+        Send a complete HTML page with `body` between the page header and
+        footer.
+        """
+        chrome = get_page_chrome(self.get_form_config())
+        output = chrome.header + body.encode('utf8') + chrome.footer
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        self.send_body(output, compress=True)
+
+    def write_cached_page(self, cache_key, render):
+        """
+        Send a complete HTML page from the render cache of the form config.
+        If it isn't cached under `cache_key` yet, `render()` is called to
+        render the body of the page. If the client already has the page
+        (according to its If-None-Match header), '304 Not Modified' is sent.
+        The compressed variant of the page is cached as well.
+        """
+        form_config = self.get_form_config()
+        page = form_config.render_cache.get(cache_key)
+        if page is None:
+            chrome = get_page_chrome(form_config)
+            output = chrome.header + render().encode('utf8') + chrome.footer
+            etag = '"{0}"'.format(hashlib.sha256(output).hexdigest()[:16])
+            page = (output, etag, None)
+            form_config.render_cache[cache_key] = page
+
+        output, etag, gzip_output = page
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match in (etag, gzip_etag(etag)):
+            self.send_response(304)
+            self.send_header('ETag', if_none_match)
+            self.end_headers()
+            return
+
+        level, min_size = self.get_compression()
+        if level and len(output) >= min_size and gzip_output is None:
+            gzip_output = gzip.compress(output, level)
+            form_config.render_cache[cache_key] = (output, etag, gzip_output)
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        # Pages may require authentication, so only the browser may cache them
+        # and it must check whether they're still current.
+        self.send_header('Cache-Control', 'private, no-cache')
+        self.send_body(output, gzip_output or False, etag)
+
+    def split_result_page(self, template, **params):
+        """
+        Render `template` and return the encoded parts of the page before and
+        after the '{msg}' placeholder, including the page header and footer.
+        """
+        chrome = get_page_chrome(self.get_form_config())
+        head, tail = template.split(u'{msg}')
+        return (chrome.header + head.format(**params).encode('utf8'),
+                tail.format(**params).encode('utf8') + chrome.footer)
+
+    def write_result_page(self, template, msg_chunks, **params):
+        """
+        Write a page from `template` to the client, where the '{msg}'
+        placeholder is replaced by the chunks from the `msg_chunks` iterable
+        as they are generated. The response must have been started with
+        start_stream().
+        """
+        head, tail = self.split_result_page(template, **params)
+        self.write_stream(head)
+        for chunk in msg_chunks:
+            self.write_stream(chunk.encode('utf8'))
+        self.write_stream(tail)
+        self.end_stream()
+
+    def h_submit_batch(self, form_values):
+        """
+        Handle the submitting of many rows of values for a single form at
+        once. The `rows` field contains one JSON object of field values per
+        line. All rows are validated against the same resolved form. If the
+        `execute` field is 'on', the script is called for each valid row,
+        using at most `batch_workers` (from the form definition) concurrent
+        scripts. The result is returned as one JSON object per row.
+        """
+        form_def, username, resolved, execute, validated, line_nrs = \
+            self.read_batch(form_values)
+        results = batch_results(line_nrs, validated)
+
+        if execute:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=form_def.batch_workers) as executor:
+                futures = {}
+                for row_nr, (row_errors, row_values) in enumerate(validated):
+                    if not row_errors:
+                        futures[row_nr] = executor.submit(
+                            call_script, form_def, row_values, username,
+                            resolved
+                        )
+                for row_nr, future in futures.items():
+                    try:
+                        result = future.result()
+                    except runscript.QueueFullError as err:
+                        results[row_nr]['error'] = str(err)
+                        continue
+                    add_batch_result(results[row_nr], result)
+
+        self.write_batch_results(results)
+
+    def read_batch(self, form_values):
+        """
+        Authenticate the user, then read and validate the rows of a batch
+        submission. Returns the form definition, the username, the resolved
+        form, whether the scripts should be executed, the validated rows and
+        the number of the line each row was on. Blank lines are skipped.
+        """
+        username = self.auth()
+        form_name = form_values.getfirst('form_name', None)
+        form_def = self.get_allowed_form(form_name)
+
+        execute = form_values.getfirst('execute', 'off') == 'on'
+        if execute and form_def.output == 'raw':
+            raise HTTPError(400, "Can't batch execute forms with raw output")
+
+        rows_data = form_values.getfirst('rows', b'')
+        if isinstance(rows_data, bytes):
+            rows_data = rows_data.decode('utf8')
+        # Fields missing from a row are treated as if they were left empty
+        # in the form.
+        resolved = form_def.resolve()
+        empty_values = dict([(field['name'], '') for field in resolved.fields
+                             if field['type'] not in ('file', 'checkbox')])
+        # Files can't be uploaded in a batch, so values for file fields
+        # can't be trusted to be uploaded files.
+        file_keys = []
+        for field in resolved.fields:
+            if field['type'] == 'file':
+                file_keys.extend([field['name'],
+                                  '{0}__name'.format(field['name'])])
+
+        rows = []
+        line_nrs = []
+        for line_nr, line in enumerate(rows_data.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as err:
+                msg = "Invalid JSON on line {0}: {1}".format(line_nr, err)
+                raise HTTPError(400, msg) from None
+            if not isinstance(row, dict):
+                msg = "Line {0} is not a JSON object".format(line_nr)
+                raise HTTPError(400, msg)
+            for key in file_keys:
+                row.pop(key, None)
+            for key, value in row.items():
+                row[key] = batch_value(value, line_nr, key)
+            row = dict(empty_values, **row)
+            row['form_name'] = form_name
+            rows.append(row)
+            line_nrs.append(line_nr)
+
+        validated = form_def.validate_many(rows, resolved)
+        return form_def, username, resolved, execute, validated, line_nrs
+
+    def write_batch_results(self, results):
+        """
+        Send the `results` of a batch submission, one JSON object per line.
+        """
+        output = u''.join([json.dumps(result) + u'\n' for result in results])
+        output = output.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-type', 'application/x-ndjson')
+        self.send_body(output, compress=True)
+
+    def get_job(self, job_id, username):
+        """
+        Return the job with id `job_id`. Raises a 404 HTTP error if there's
+        no such job and a 403 HTTP error if it belongs to another user.
+        """
+        try:
+            job = self.scriptform.job_store.get(job_id)
+        except KeyError:
+            raise HTTPError(404, "No such job") from None
+        if job.username != username:
+            raise HTTPError(403, "You're not authorized to view this job")
+        return job
+
+    def h_job(self, id):  # pylint: disable=W0622
+        """
+        Render the status of an asynchronous job. Once the job has finished,
+        its output is shown like that of a normal form submission.
+        """
+        job, form_def, params = self.start_job_page(id)
+        if job.is_finished():
+            # Jobs that failed to run have no exit code, so their error
+            # output is shown.
+            with job.open_output('stdout') as stdout, \
+                    job.open_output('stderr') as stderr:
+                msg_chunks = iter_result(form_def, stdout, stderr,
+                                         job.exitcode)
+                self.write_result_page(HTML_JOB, msg_chunks, **params)
+        else:
+            self.write_result_page(HTML_JOB, [HTML_JOB_PENDING], **params)
+
+    def start_job_page(self, job_id):
+        """
+        Send the headers of the status page of the job `job_id`. Returns the
+        job, its form definition and the parameters of the HTML_JOB page.
+        """
+        username = self.auth()
+        form_config = self.get_form_config()
+        job = self.get_job(job_id, username)
+        form_def = form_config.get_form_def(job.form_name)
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html')
+        if not job.is_finished():
+            self.send_header('Refresh', '2')
+        self.start_stream(compress=True)
+
+        params = {
+            'title': form_def.title,
+            'form_name': form_def.name,
+            'job_id': job.job_id,
+            'status': job.status,
+        }
+        return job, form_def, params
+
+    def h_job_result(self, id, stream='stdout'):  # pylint: disable=W0622
+        """
+        Return the stored `stream` ('stdout' or 'stderr') output of an
+        asynchronous job as-is. The status and exit code of the job are sent
+        in the 'X-Job-Status' and 'X-Job-Exitcode' headers. If the job hasn't
+        finished yet, a '202 Accepted' without output is sent.
+        """
+        path, size = self.start_job_result(id, stream)
+        if size:
+            with open(path, 'rb') as output_file:
+                shutil.copyfileobj(output_file, self.wfile)
+
+    def start_job_result(self, job_id, stream):
+        """
+        Send the headers of the response of h_job_result(). Returns the path
+        and the size of the output file to send as the body, which is 0 if
+        there's no body.
+        """
+        username = self.auth()
+        job = self.get_job(job_id, username)
+        if stream not in ('stdout', 'stderr'):
+            raise HTTPError(400, "Invalid stream")
+
+        if not job.is_finished():
+            self.send_response(202)
+            self.send_header('X-Job-Status', job.status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None, 0
+
+        path = job.output_path(stream)
+        size = 0
+        if os.path.exists(path):
+            size = os.path.getsize(path)
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(size))
+        self.send_header('X-Job-Status', job.status)
+        self.send_header('X-Job-Exitcode', str(job.exitcode))
+        self.end_headers()
+        return path, size
+
+    def h_status(self):
+        """
+        Return the state of the script execution queue and the static file
+        cache as JSON, for monitoring purposes.
+        """
+        self.auth()
+        stats = runscript.script_limiter.stats()
+        static_cache = self.get_form_config().static_cache
+        if static_cache is not None:
+            stats['static_cache'] = static_cache.stats()
+        output = json.dumps(stats).encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json')
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
 
-        # Clean up uploaded files
-        for file_name in tmp_files:
-            if os.path.exists(file_name):
-                os.unlink(file_name)
+    def h_css(self, v=None):  # pylint: disable=W0613
+        """
+        Serve the CSS of the pages for form configs with `external_css`. The
+        `v` parameter is the version of the CSS, which changes whenever the
+        CSS does, so the response can be cached indefinitely.
+        """
+        chrome = get_page_chrome(self.get_form_config())
+        if self.headers.get('If-None-Match') == chrome.css_etag:
+            self.send_response(304)
+            self.send_header('ETag', chrome.css_etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/css; charset=utf-8')
+        self.send_header('Content-Length', str(len(chrome.css)))
+        self.send_header('ETag', chrome.css_etag)
+        if v == chrome.css_version:
+            self.send_header('Cache-Control', 'public, max-age=31536000')
+        else:
+            self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(chrome.css)
 
     def h_static(self, fname):
         """Serve static files"""
-        form_config = self.scriptform.get_form_config()
+        form_config = self.get_form_config()
+        self.send_file(self.static_path(fname),
+                       form_config.static_cache_control,
+                       form_config.static_cache)
+
+    def static_path(self, fname):
+        """
+        Return the path to the static file `fname`.
+        """
+        form_config = self.get_form_config()
 
         if not form_config.static_dir:
             raise HTTPError(501, "Static file serving not enabled")
 
-        if '..' in fname:
+        if '..' in fname or os.path.isabs(fname):
             raise HTTPError(403, "Invalid file name")
 
-        path = os.path.join(form_config.static_dir, fname)
-        if not os.path.exists(path):
-            raise HTTPError(404, "Not found")
+        return os.path.join(form_config.static_dir, fname)
 
-        self.send_response(200)
-        self.end_headers()
-        with open(path, "rb") as static_file:
-            self.wfile.write(static_file.read())
+
+class AsyncScriptFormWebApp(AsyncRequestHandler, ScriptFormWebApp):
+    """
+    Request handler for the asyncio engine. Requests are handled like they
+    are by ScriptFormWebApp, but scripts are run in the event loop, so that
+    no thread is needed while waiting for them. Work that would block the
+    event loop for long, such as checking passwords against slow hashes and
+    running the scripts of dynamic fields and options, is done in a thread.
+    Output is written in chunks, waiting for the client to receive each
+    chunk.
+    """
+    async def handle_one_request_async(self):
+        """
+        Handle a single request. The form configuration is looked up again
+        and the user is authenticated again for every request.
+        """
+        self.form_config = None
+        self.authenticated = False
+        self.username = None
+        self.auth_error = None
+        await AsyncRequestHandler.handle_one_request_async(self)
+
+    async def _call(self, path, params):
+        """
+        Find a method for `path` and call it. See AsyncRequestHandler._call().
+        If the user's password has to be checked against a slow hash, the
+        user is authenticated in a thread first.
+        """
+        if self.checks_slow_hash():
+            await self.run_blocking(self.pre_auth)
+        return await AsyncRequestHandler._call(self, path, params)
+
+    def checks_slow_hash(self):
+        """
+        Return True if authenticating the user of the request means checking
+        a password against a slow hash (see userauth.is_slow_hash()).
+        """
+        if 'Authorization' not in self.headers or \
+           'REMOTE_USER' in self.headers:
+            return False
+        form_config = self.get_form_config()
+        credentials = self.get_basic_auth()
+        if not form_config.users or credentials is None:
+            return False
+        pw_hash = form_config.users.get(credentials[0], None)
+        if pw_hash is None:
+            pw_hash = userauth.dummy_hash(form_config.users)
+        return pw_hash is not None and userauth.is_slow_hash(pw_hash)
+
+    def pre_auth(self):
+        """
+        Authenticate the user. The result, or the HTTP error if it fails, is
+        remembered by auth() for the handler of the request.
+        """
+        try:
+            self.auth()
+        except HTTPError:
+            pass
+
+    async def h_form(self, form_name, errors=None, **form_values):
+        """
+        Render a form. See ScriptFormWebApp.h_form(). Dynamic fields and
+        options are resolved in a thread.
+        """
+        form_def = self.get_allowed_form(form_name)
+        resolved = None
+        if not form_def.is_static():
+            resolved = await self.run_blocking(form_def.resolve)
+        self.render_form(form_name, errors, form_values, resolved)
+
+    async def h_static(self, fname):
+        """
+        Serve static files. See ScriptFormWebApp.h_static().
+        """
+        form_config = self.get_form_config()
+        await self.send_file(self.static_path(fname),
+                             form_config.static_cache_control,
+                             form_config.static_cache)
+
+    async def h_submit(self, form_values):
+        """
+        Handle the submitting of a form. See ScriptFormWebApp.h_submit().
+        """
+        form_def, values, username = self.read_submission(form_values)
+        await self.submit(form_def, values, username, form_values.tmp_files)
+
+    async def submit(self, form_def, values, username, tmp_files):
+        """
+        Validate the submitted `values` for `form_def` and call the script if
+        they're valid. See ScriptFormWebApp.submit(). Forms with dynamic
+        fields or options are resolved and validated in a thread.
+        """
+        def validate():
+            """
+            Resolve the form and validate the values.
+            """
+            resolved = form_def.resolve()
+            return (resolved,) + tuple(form_def.validate(values, resolved))
+
+        if form_def.is_static():
+            resolved, form_errors, form_values = validate()
+        else:
+            resolved, form_errors, form_values = \
+                await self.run_blocking(validate)
+
+        if form_errors:
+            form_values.pop('form_name')
+            self.render_form(form_def.name, form_errors, form_values,
+                             resolved)
+        elif form_def.run_async:
+            self.submit_job(form_def, form_values, username, resolved,
+                            tmp_files)
+        elif form_def.output == 'raw':
+            # The script's output is sent as it is. Since its length isn't
+            # known, the connection is closed afterwards.
+            self.close_connection = True
+            output = self.raw_output(form_def)
+            try:
+                await call_script_async(form_def, form_values, username,
+                                        resolved, output, output,
+                                        drain=self.drain)
+            except runscript.QueueFullError as err:
+                raise queue_full_error(err) from None
+            if output is not self.wfile:
+                output.close()
+        elif form_def.stream:
+            await self.submit_live(form_def, form_values, username, resolved)
+        else:
+            try:
+                result = await call_script_async(form_def, form_values,
+                                                 username, resolved,
+                                                 spool=True)
+            except runscript.QueueFullError as err:
+                raise queue_full_error(err) from None
+            await self.write_submit_result(form_def, result)
+
+    async def write_submit_result(self, form_def, result):
+        """
+        Send the page with the `result` of the script of `form_def`. See
+        ScriptFormWebApp.write_submit_result().
+        """
+        with result['stdout'], result['stderr']:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/html')
+            self.start_stream(compress=True)
+            await self.write_result_page(
+                HTML_SUBMIT_RESPONSE,
+                iter_result(form_def, result['stdout'],
+                            result['stderr'], result['exitcode']),
+                title=form_def.title,
+                form_name=form_def.name,
+            )
+
+    async def submit_live(self, form_def, form_values, username, resolved):
+        """
+        Call the script of `form_def` and stream its output to the client
+        while it runs. See ScriptFormWebApp.submit_live().
+        """
+        head, tail = self.split_result_page(HTML_SUBMIT_RESPONSE,
+                                            title=form_def.title,
+                                            form_name=form_def.name)
+        live = LiveOutput(self, form_def, head)
+        try:
+            result = await call_script_async(form_def, form_values, username,
+                                             resolved, spool=True, live=live,
+                                             drain=self.drain)
+        except runscript.QueueFullError as err:
+            raise queue_full_error(err) from None
+        await self.write_live_result(form_def, live, result, tail)
+
+    async def write_live_result(self, form_def, live, result, tail):
+        """
+        Send the end of the page of a script whose output was sent to the
+        client by `live`. See ScriptFormWebApp.write_live_result().
+        """
+        with result['stdout'], result['stderr']:
+            if not live.started:
+                live.start()
+            live.finish()
+            for chunk in iter_live_result(form_def, result['stderr'],
+                                          result['exitcode']):
+                live.write_text(chunk)
+                await self.drain()
+        self.write_stream(tail)
+        self.end_stream()
+
+    async def write_result_page(self, template, msg_chunks, **params):
+        """
+        Write a page from `template` to the client. See
+        ScriptFormWebApp.write_result_page(). After each chunk, this waits
+        until the client has received most of the output.
+        """
+        head, tail = self.split_result_page(template, **params)
+        self.write_stream(head)
+        for chunk in msg_chunks:
+            self.write_stream(chunk.encode('utf8'))
+            await self.drain()
+        self.write_stream(tail)
+        self.end_stream()
+
+    async def h_submit_batch(self, form_values):
+        """
+        Handle the submitting of many rows of values for a single form at
+        once. See ScriptFormWebApp.h_submit_batch(). The rows are read and
+        validated in a thread.
+        """
+        form_def, username, resolved, execute, validated, line_nrs = \
+            await self.run_blocking(self.read_batch, form_values)
+        results = batch_results(line_nrs, validated)
+
+        if execute:
+            semaphore = asyncio.Semaphore(form_def.batch_workers)
+
+            async def run_row(row_nr, row_values):
+                """
+                Call the script for a single row.
+                """
+                async with semaphore:
+                    try:
+                        result = await call_script_async(
+                            form_def, row_values, username, resolved)
+                    except runscript.QueueFullError as err:
+                        results[row_nr]['error'] = str(err)
+                        return
+                add_batch_result(results[row_nr], result)
+
+            await asyncio.gather(*[
+                run_row(row_nr, row_values)
+                for row_nr, (row_errors, row_values) in enumerate(validated)
+                if not row_errors
+            ])
+
+        self.write_batch_results(results)
+
+    async def h_job(self, id):  # pylint: disable=W0622
+        """
+        Render the status of an asynchronous job. See
+        ScriptFormWebApp.h_job().
+        """
+        job, form_def, params = self.start_job_page(id)
+        if job.is_finished():
+            with job.open_output('stdout') as stdout, \
+                    job.open_output('stderr') as stderr:
+                msg_chunks = iter_result(form_def, stdout, stderr,
+                                         job.exitcode)
+                await self.write_result_page(HTML_JOB, msg_chunks, **params)
+        else:
+            await self.write_result_page(HTML_JOB, [HTML_JOB_PENDING],
+                                         **params)
+
+    async def h_job_result(self, id, stream='stdout'):  # pylint: disable=W0622
+        """
+        Return the stored `stream` output of an asynchronous job as-is. See
+        ScriptFormWebApp.h_job_result().
+        """
+        path, size = self.start_job_result(id, stream)
+        if size:
+            with open(path, 'rb') as output_file:
+                await self.copy_file(output_file, 0, size)
@@ -5,7 +5,23 @@ Basic web server / framework.
 from socketserver import ThreadingMixIn
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import urllib.parse
-import cgi
+import email.utils
+import mimetypes
+import threading
+import queue
+import asyncio
+import concurrent.futures
+import inspect
+import io
+import os
+import socket
+import stat
+import sys
+import gzip
+import zlib
+
+import formparser
+import staticcache
 
 
 class HTTPError(Exception):
@@ -25,10 +41,136 @@ class HTTPError(Exception):
         Exception.__init__(self, status_code, msg, headers)
 
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+SENDFILE_BLOCK_SIZE = 1024 * 1024 * 8
+
+# Number of seconds the asyncio engine waits for each read of a request body
+# that's parsed in a thread, if the server has no request timeout.
+BODY_READ_TIMEOUT = 60
+
+REJECT_RESPONSE = (b'HTTP/1.0 503 Service Unavailable\r\n'
+                   b'Content-Type: text/plain\r\n'
+                   b'Content-Length: 22\r\n'
+                   b'Retry-After: 1\r\n'
+                   b'\r\n'
+                   b'Too many connections\r\n')
+
+
+class HTTPServerBase(HTTPServer):
     """
-    Base class for multithreaded HTTP servers.
+    HTTP server with a configurable listen `backlog`, a `request_timeout`
+    for reading from and writing to connections and a limit on the number
+    of connections that are handled at the same time. Connections beyond
+    `max_connections` get a '503 Service Unavailable' response.
     """
+    def __init__(self, server_address, handler_class, backlog=None,
+                 request_timeout=None, max_connections=None):
+        if backlog is not None:
+            self.request_queue_size = backlog
+        self.request_timeout = request_timeout
+        self.max_connections = max_connections
+        self.nr_of_connections = 0
+        self.connections_lock = threading.Lock()
+        HTTPServer.__init__(self, server_address, handler_class)
+
+    def get_request(self):
+        """
+        Accept a connection and set its timeout.
+        """
+        request, client_address = HTTPServer.get_request(self)
+        if self.request_timeout is not None:
+            request.settimeout(self.request_timeout)
+        return request, client_address
+
+    def verify_request(self, request, client_address):
+        """
+        Count the connection and reject it if there are too many.
+        """
+        with self.connections_lock:
+            # shutdown_request() is called for rejected connections too, so
+            # they're counted as well.
+            self.nr_of_connections += 1
+            if self.max_connections is None or \
+               self.nr_of_connections <= self.max_connections:
+                return True
+        try:
+            request.sendall(REJECT_RESPONSE)
+        except OSError:
+            pass
+        return False
+
+    def shutdown_request(self, request):
+        """
+        Close the connection and stop counting it.
+        """
+        with self.connections_lock:
+            self.nr_of_connections -= 1
+        HTTPServer.shutdown_request(self, request)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServerBase):
+    """
+    Base class for multithreaded HTTP servers. Every connection is handled
+    in a new thread.
+    """
+
+
+class ThreadPoolHTTPServer(HTTPServerBase):
+    """
+    Multithreaded HTTP server that handles connections with a fixed number
+    of reusable `threads`. Connections wait in a queue until a thread is
+    available.
+    """
+    def __init__(self, server_address, handler_class, threads=16,
+                 **kwargs):
+        self.nr_of_threads = threads
+        self.threads = []
+        self.queue = queue.Queue()
+        HTTPServerBase.__init__(self, server_address, handler_class, **kwargs)
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Start the threads and handle requests until shutdown() is called.
+        The threads are started here rather than in the constructor, so that
+        the server can be created before forking worker processes.
+        """
+        while len(self.threads) < self.nr_of_threads:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        HTTPServerBase.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        """
+        Queue the connection for the next available thread.
+        """
+        self.queue.put((request, client_address))
+
+    def _work(self):
+        """
+        Handle queued connections until None is queued.
+        """
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:  # pylint: disable=broad-except
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def server_close(self):
+        """
+        Close the listening socket and stop the threads once they've handled
+        the queued connections.
+        """
+        HTTPServerBase.server_close(self)
+        for _ in self.threads:
+            self.queue.put(None)
+        self.threads = []
 
 
 class RequestHandler(BaseHTTPRequestHandler):
@@ -36,7 +178,317 @@ class RequestHandler(BaseHTTPRequestHandler):
     Basic web server request handler. Handles GET and POST requests. You should
     inherit from this class and implement h_ methods for handling requests.
     If no path is set, it dispatches to the 'index' or 'default' method.
+
+    Connections are kept open for multiple requests (HTTP/1.1 keep-alive),
+    so responses must have a Content-Length header or be sent with
+    start_stream(). Idle connections are closed after `keepalive_timeout`
+    seconds and after `keepalive_max_requests` requests.
     """
+    protocol_version = 'HTTP/1.1'
+    keepalive_timeout = 5
+    keepalive_max_requests = 100
+    nr_of_requests = 0
+    chunked = False
+    compressor = None
+    stream_buffer = None
+
+    def handle(self):
+        """
+        Handle requests on the connection until it's closed.
+        """
+        self.nr_of_requests = 0
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            # Wait at most the keep-alive timeout for the next request. The
+            # normal timeout is restored in parse_request().
+            if self.keepalive_timeout is not None:
+                self.connection.settimeout(self.keepalive_timeout)
+            self.handle_one_request()
+
+    def parse_request(self):
+        """
+        Parse the request line and headers. Overridden to restore the
+        connection's normal timeout once a request has arrived.
+        """
+        self.connection.settimeout(getattr(self.server, 'request_timeout',
+                                           None))
+        self.nr_of_requests += 1
+        return BaseHTTPRequestHandler.parse_request(self)
+
+    def end_headers(self):
+        """
+        Send the blank line ending the headers. Overridden to close the
+        connection after the last allowed request.
+        """
+        if self.keepalive_max_requests is not None and \
+           self.nr_of_requests >= self.keepalive_max_requests and \
+           not self.close_connection:
+            self.send_header('Connection', 'close')
+        BaseHTTPRequestHandler.end_headers(self)
+
+    def start_stream(self, compress=False):
+        """
+        End the headers of a response of which the length isn't known in
+        advance. The body must be sent with write_stream() and end_stream().
+        HTTP/1.1 clients receive the body with chunked transfer encoding, for
+        older clients the connection is closed after the response.
+
+        If `compress` is True and the client accepts it, the body is gzip
+        compressed. The headers are then held back until enough of the body
+        has been written to be worth compressing (see get_compression()).
+        If the response turns out to be smaller, it's sent uncompressed with
+        a Content-Length instead.
+        """
+        self.compressor = None
+        self.stream_buffer = None
+        level, min_size = self.get_compression()
+        if compress and level and self.accepts_gzip():
+            self.send_header('Vary', 'Accept-Encoding')
+            self.stream_buffer = bytearray()
+            if min_size > 0:
+                return
+        self._start_stream()
+
+    def _start_stream(self):
+        """
+        Send the headers of a response started with start_stream(). The body
+        is compressed if start_stream() decided it should be.
+        """
+        if self.stream_buffer is not None:
+            self.send_header('Content-Encoding', 'gzip')
+            self.compressor = zlib.compressobj(self.get_compression()[0],
+                                               zlib.DEFLATED, 16 + 15)
+        self.chunked = self.request_version == 'HTTP/1.1'
+        if self.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.stream_buffer is not None:
+            buf = bytes(self.stream_buffer)
+            self.stream_buffer = None
+            self.write_stream(buf)
+
+    def write_stream(self, data):
+        """
+        Send `data` (bytes) as part of a response started with
+        start_stream().
+        """
+        if self.stream_buffer is not None:
+            self.stream_buffer += data
+            if len(self.stream_buffer) >= self.get_compression()[1]:
+                self._start_stream()
+            return
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self._write_chunk(data)
+
+    def flush_stream(self):
+        """
+        Send everything that was written with write_stream() to the client
+        right away, for responses that show progress while they're being
+        generated.
+        """
+        if self.stream_buffer is not None:
+            self._start_stream()
+        if self.compressor is not None:
+            self._write_chunk(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.wfile.flush()
+
+    def end_stream(self):
+        """
+        End a response started with start_stream().
+        """
+        if self.stream_buffer is not None:
+            # Too small to compress, so the length is known after all.
+            output = bytes(self.stream_buffer)
+            self.stream_buffer = None
+            self.send_header('Content-Length', str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
+            return
+        if self.compressor is not None:
+            self._write_chunk(self.compressor.flush())
+            self.compressor = None
+        if self.chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def _write_chunk(self, data):
+        """
+        Send `data` (bytes) as a single chunk of a streamed response.
+        """
+        if not data:
+            return
+        if self.chunked:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def send_body(self, output, compress=False, etag=None):
+        """
+        End the headers and send `output` (bytes) as the body of the
+        response. If `compress` is True, the client accepts it and `output`
+        is large enough, it's gzip compressed. Alternatively, `compress` may
+        be the already compressed `output`. If `etag` is given, it's sent as
+        the ETag header, with a suffix for the compressed variant.
+        """
+        level, min_size = self.get_compression()
+        if compress and level and len(output) >= min_size:
+            self.send_header('Vary', 'Accept-Encoding')
+            if self.accepts_gzip():
+                if compress is True:
+                    compress = gzip.compress(output, level)
+                output = compress
+                self.send_header('Content-Encoding', 'gzip')
+                if etag is not None:
+                    etag = gzip_etag(etag)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def get_compression(self):
+        """
+        Return the gzip compression level for responses (0 for no
+        compression) and the minimum size in bytes of responses that are
+        compressed. Responses aren't compressed by default.
+        """
+        return 0, 0
+
+    def accepts_gzip(self):
+        """
+        Return True if the client accepts gzip compressed responses.
+        """
+        return _accepts_gzip(self.headers)
+
+    def send_file(self, path, cache_control=None, cache=None):
+        """
+        Send the file at `path` as the response, with the kernel copying it
+        straight to the connection with sendfile(). See start_file(). If
+        `cache` (a staticcache.StaticCache) is given, small files are sent
+        from the cache instead. See send_cached_file().
+        """
+        if cache is not None and \
+           self.send_cached_file(path, cache_control, cache):
+            return
+        static_file, offset, count = self.start_file(path, cache_control)
+        if static_file is None:
+            return
+        with static_file:
+            self.wfile.flush()
+            if count > 0:
+                self.connection.sendfile(static_file, offset, count)
+
+    def send_cached_file(self, path, cache_control, cache):
+        """
+        Send the file at `path` from `cache` (a staticcache.StaticCache).
+        Clients that accept it get the gzip compressed variant of the file,
+        unless they requested a range. Conditional and range requests are
+        handled like they are by start_file(). Returns False if the file
+        isn't in the cache and can't be added to it.
+        """
+        entry = cache.get(path)
+        if entry is None:
+            return False
+        data, etag = entry.data, entry.etag
+        headers = {}
+        if entry.compressible:
+            headers['Vary'] = 'Accept-Encoding'
+            if 'Range' not in self.headers and self.accepts_gzip():
+                gzip_data = cache.get_gzip(entry)
+                if gzip_data is not None:
+                    data, etag = gzip_data, gzip_etag(entry.etag)
+                    headers['Content-Encoding'] = 'gzip'
+        status, offset, count = self._file_range(len(data), etag,
+                                                 entry.last_modified,
+                                                 entry.mtime)
+        self._send_file_headers(status, entry.content_type, offset, count,
+                                len(data), etag, entry.last_modified,
+                                cache_control, headers)
+        if count > 0:
+            self.wfile.write(memoryview(data)[offset:offset + count])
+        return True
+
+    def start_file(self, path, cache_control=None):
+        """
+        Open the file at `path` and send the headers of the response for it.
+        If the client already has the current version of the file (according
+        to its If-None-Match or If-Modified-Since header), a '304 Not
+        Modified' is sent. A single byte range of the file can be requested
+        with a Range header. If `cache_control` is given, it's sent as the
+        Cache-Control header.
+
+        Returns the open file, the offset and the number of bytes to send, or
+        (None, 0, 0) if no body has to be sent. Raises an HTTPError if the
+        file doesn't exist or the range can't be satisfied.
+        """
+        try:
+            static_file = open(path, 'rb')
+        except OSError:
+            raise HTTPError(404, "Not found") from None
+        try:
+            file_stat = os.fstat(static_file.fileno())
+            if not stat.S_ISREG(file_stat.st_mode):
+                raise HTTPError(404, "Not found")
+            size = file_stat.st_size
+            etag, last_modified = staticcache.file_validators(file_stat)
+            status, offset, count = self._file_range(size, etag,
+                                                     last_modified,
+                                                     int(file_stat.st_mtime))
+            self._send_file_headers(status, mimetypes.guess_type(path)[0],
+                                    offset, count, size, etag, last_modified,
+                                    cache_control)
+        except BaseException:
+            static_file.close()
+            raise
+
+        if status == 304:
+            static_file.close()
+            return None, 0, 0
+        return static_file, offset, count
+
+    def _file_range(self, size, etag, last_modified, mtime):
+        """
+        Determine which part of a file of `size` bytes to send, based on the
+        conditional and range headers of the request. Returns the status
+        code, offset and number of bytes to send.
+        """
+        if _not_modified(self.headers, etag, mtime):
+            return 304, 0, 0
+        if 'Range' in self.headers and \
+           self.headers.get('If-Range', etag) in (etag, last_modified):
+            byte_range = _parse_range(self.headers['Range'], size)
+            if byte_range is not None:
+                return (206, ) + byte_range
+        return 200, 0, size
+
+    def _send_file_headers(self, status, content_type, offset, count, size,
+                           etag, last_modified, cache_control, headers=None):
+        """
+        Send the status and headers of a response with `count` bytes at
+        `offset` of a file of `size` bytes. Extra `headers` may be given as a
+        dict.
+        """
+        self.send_response(status)
+        if status != 304:
+            self.send_header('Content-Type',
+                             content_type or 'application/octet-stream')
+            self.send_header('Content-Length', str(count))
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                offset, offset + count - 1, size))
+        for header_k, header_v in (headers or {}).items():
+            if status != 304 or header_k != 'Content-Encoding':
+                self.send_header(header_k, header_v)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('ETag', etag)
+        if cache_control is not None:
+            self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+
     def log_message(self, fmt, *args):  # pylint: disable=arguments-differ
         """Overrides BaseHTTPRequestHandler which logs to the console. We log
         to our log file instead"""
@@ -51,13 +503,42 @@ class RequestHandler(BaseHTTPRequestHandler):
 
     def do_POST(self):  # pylint: disable=invalid-name
         """
-        Handle a POST request.
+        Handle a POST request. Temporary files of uploaded files are removed
+        afterwards, unless the handler took them out of the form data's
+        `tmp_files`.
         """
-        form_values = cgi.FieldStorage(
-            fp=self.rfile,
-            headers=self.headers,
-            environ={'REQUEST_METHOD': 'POST'})
-        self._call(self.path.strip('/'), params={'form_values': form_values})
+        try:
+            form_values = self._parse_form_values()
+        except HTTPError as err:
+            self._send_http_error(err)
+            return
+        try:
+            self._call(self.path.strip('/'),
+                       params={'form_values': form_values})
+        finally:
+            form_values.cleanup()
+
+    def _parse_form_values(self):
+        """
+        Parse the form data in the body of a POST request into a
+        formparser.FormData. Raises an HTTPError if it's invalid or too
+        large.
+        """
+        try:
+            return formparser.parse_form(self.rfile, self.headers,
+                                         **self.get_form_limits())
+        except formparser.FormParseError as err:
+            # The rest of the request hasn't been read, so the connection
+            # can't be used for another request.
+            raise HTTPError(err.status_code, err.msg,
+                            {'Connection': 'close'}) from None
+
+    def get_form_limits(self):
+        """
+        Return the size limits for submitted form data, as keyword arguments
+        for formparser.parse_form(). There are no limits by default.
+        """
+        return {}
 
     def _parse(self, reqinfo):
         """
@@ -83,31 +564,641 @@ class RequestHandler(BaseHTTPRequestHandler):
         themselves using self.send_response(), self.send_header(),
         self.end_header() and by writing to self.wfile.
         """
+        try:
+            self._find_method(path)(**params)
+        except HTTPError as err:
+            self._send_http_error(err)
+            return False
+        except Exception as err:
+            self.scriptform.log.exception(err)
+            self.send_error(500, "Internal server error")
+            raise
+
+    def _find_method(self, path):
+        """
+        Return the method that handles requests for `path`. See _call().
+        """
         method_name = 'h_{0}'.format(path)
-        method_cb = None
-        try:
-            if hasattr(self, method_name) and \
-               callable(getattr(self, method_name)):
-                method_cb = getattr(self, method_name)
-            elif path == '' and hasattr(self, 'index'):
-                method_cb = getattr(self, 'index')
-            elif hasattr(self, 'default'):
-                method_cb = getattr(self, 'default')
+        if hasattr(self, method_name) and \
+           callable(getattr(self, method_name)):
+            return getattr(self, method_name)
+        elif path == '' and hasattr(self, 'index'):
+            return getattr(self, 'index')
+        elif hasattr(self, 'default'):
+            return getattr(self, 'default')
+        else:
+            raise HTTPError(404, "Not found")
+
+    def _send_http_error(self, err):
+        """
+        Send the HTTPError `err` to the client.
+        """
+        # HTTP erors are generally thrown by the webapp on purpose. Send
+        # error to the browser.
+        if err.status_code not in (401, ):
+            self.scriptform.log.exception(err)
+        output = "Error {0}: {1}".format(err.status_code,
+                                         err.msg).encode('utf-8')
+        self.send_response(err.status_code)
+        for header_k, header_v in err.headers.items():
+            self.send_header(header_k, header_v)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+        self.wfile.flush()
+
+
+def _not_modified(headers, etag, mtime):
+    """
+    Return True if the conditional request `headers` show that the client
+    already has the version of a file with `etag` that was last modified at
+    `mtime`.
+    """
+    if 'If-None-Match' in headers:
+        tags = [tag.strip() for tag in headers['If-None-Match'].split(',')]
+        # Weak comparison, as required for If-None-Match.
+        return '*' in tags or etag in [tag[2:] if tag.startswith('W/')
+                                       else tag for tag in tags]
+    if 'If-Modified-Since' in headers:
+        try:
+            since = email.utils.parsedate_to_datetime(
+                headers['If-Modified-Since'])
+        except (TypeError, ValueError):
+            return False
+        return since.tzinfo is not None and mtime <= since.timestamp()
+    return False
+
+
+class RawResponseCompressor(object):
+    """
+    File-like object that gzip compresses a complete HTTP response (status
+    line, headers and body) as it's written, such as the output of a script
+    with raw output. Content-Encoding and Vary headers are added to the
+    response's headers and its Content-Length header is removed. Responses
+    that are already encoded are passed on as they are. Since the length of
+    the compressed response isn't known, the connection must be closed after
+    it. close() must be called at the end of the response.
+    """
+    max_head_size = 1024 * 64
+
+    def __init__(self, wfile, level):
+        self.wfile = wfile
+        self.level = level
+        self.head = bytearray()
+        self.compressor = None
+
+    def write(self, data):
+        """
+        Compress and send `data` (bytes).
+        """
+        if self.head is not None:
+            self.head += data
+            data = self._write_head()
+            if data is None:
+                return
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if data:
+            self.wfile.write(data)
+
+    def _write_head(self):
+        """
+        Send the status line and headers once they're complete. Returns the
+        part of the body that was written along with them, or None if the
+        headers aren't complete yet.
+        """
+        head = bytes(self.head)
+        ends = [(head.find(sep), sep) for sep in (b'\r\n\r\n', b'\n\n')
+                if sep in head]
+        if not ends:
+            if len(head) > self.max_head_size:
+                # Not a HTTP response.
+                self.wfile.write(head)
+                self.head = None
+                return b''
+            return None
+
+        end, sep = min(ends)
+        self.head = None
+        eol = sep[:len(sep) // 2]
+        lines = head[:end].split(eol)
+        names = [line.split(b':', 1)[0].strip().lower() for line in lines]
+        body = head[end + len(sep):]
+        if b'content-encoding' in names or b'transfer-encoding' in names:
+            self.wfile.write(head)
+            return b''
+        lines = [line for line, name in zip(lines, names)
+                 if name != b'content-length']
+        lines.extend([b'Content-Encoding: gzip',
+                      b'Vary: Accept-Encoding'])
+        self.wfile.write(eol.join(lines) + sep)
+        self.compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                           16 + 15)
+        return body
+
+    def flush(self):
+        """
+        Send the compressed output that was written so far.
+        """
+        if self.compressor is not None:
+            self.wfile.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.wfile.flush()
+
+    def close(self):
+        """
+        End the response.
+        """
+        if self.head is not None:
+            # Incomplete headers
+            self.wfile.write(bytes(self.head))
+            self.head = None
+        if self.compressor is not None:
+            self.wfile.write(self.compressor.flush())
+            self.compressor = None
+
+
+def gzip_etag(etag):
+    """
+    Return the ETag of the gzip compressed variant of a response with
+    `etag`.
+    """
+    return etag[:-1] + '-gz"'
+
+
+def _accepts_gzip(headers):
+    """
+    Return True if the request `headers` show that the client accepts gzip
+    compressed responses.
+    """
+    for coding in headers.get('Accept-Encoding', '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() in ('gzip', 'x-gzip'):
+            _, _, quality = params.partition('q=')
+            try:
+                return float(quality or 1) > 0
+            except ValueError:
+                return False
+    return False
+
+
+def _parse_range(range_header, size):
+    """
+    Parse the Range header `range_header` for a file of `size` bytes. Returns
+    the offset and number of bytes of the requested range, or None if the
+    header is invalid or requests multiple ranges, in which case the whole
+    file is sent. Raises a '416 Range Not Satisfiable' HTTPError if the
+    range lies beyond the end of the file.
+    """
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in ranges:
+        return None
+    first, sep, last = ranges.strip().partition('-')
+    if not sep or not (first + last).isdigit():
+        return None
+    if first == '':
+        # Suffix range: the last `last` bytes.
+        start = max(size - int(last), 0)
+        end = size - 1
+        if int(last) == 0:
+            start = size
+    else:
+        start = int(first)
+        end = size - 1
+        if last != '':
+            end = min(int(last), size - 1)
+            if end < start:
+                return None
+    if start >= size:
+        raise HTTPError(416, "Range not satisfiable",
+                        {'Content-Range': 'bytes */{0}'.format(size)})
+    return start, end - start + 1
+
+
+class AsyncHTTPServer(object):
+    """
+    HTTP server that handles all connections in a single thread with an
+    asyncio event loop, instead of with a thread per connection. Connections
+    are handled by `handler_class`, which must be an AsyncRequestHandler.
+    It's used the same way as the HTTPServerBase servers and takes the same
+    options, so it can also be forked into worker processes after it has
+    been created.
+
+    Large request bodies are parsed by a separate pool of `body_threads`
+    threads, so that slow uploads can't hold up work that request handlers
+    do in the event loop's default pool of threads.
+    """
+    body_threads = 4
+
+    def __init__(self, server_address, handler_class, backlog=None,
+                 request_timeout=None, max_connections=None):
+        self.server_address = server_address
+        self.RequestHandlerClass = handler_class  # pylint: disable=C0103
+        self.request_timeout = request_timeout
+        self.max_connections = max_connections
+        self.nr_of_connections = 0
+        self.socket = socket.create_server(server_address,
+                                           backlog=backlog or 5)
+        self.loop = None
+        self.body_executor = None
+        self.wakeup = None
+        self.shutdown_requested = False
+        self.is_shut_down = threading.Event()
+        self.is_shut_down.set()
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Handle connections until shutdown() is called. service_actions() is
+        called every `poll_interval` seconds.
+        """
+        self.is_shut_down.clear()
+        self.shutdown_requested = False
+        self.loop = asyncio.new_event_loop()
+        if sys.version_info < (3, 12) and _have_pidfd():
+            # Wait for scripts with a pidfd in the event loop, rather than
+            # with a thread per script, which is the default on older
+            # Pythons.
+            watcher = asyncio.PidfdChildWatcher()
+            watcher.attach_loop(self.loop)
+            asyncio.set_child_watcher(watcher)
+        self.body_executor = concurrent.futures.ThreadPoolExecutor(
+            self.body_threads)
+        try:
+            self.loop.run_until_complete(self._serve(poll_interval))
+        finally:
+            self.body_executor.shutdown(wait=False)
+            self.body_executor = None
+            self.loop.close()
+            self.loop = None
+            self.is_shut_down.set()
+
+    async def _serve(self, poll_interval):
+        """
+        Accept connections until shutdown() is called.
+        """
+        self.wakeup = asyncio.Event()
+        # The event loop takes ownership of the socket it's given, so it gets
+        # a copy. The listening socket itself stays open until
+        # server_close() is called.
+        server = await asyncio.start_server(self._handle_connection,
+                                            sock=self.socket.dup())
+        try:
+            while not self.shutdown_requested:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.service_actions()
+        finally:
+            server.close()
+            # Abort the connections that are still open.
+            tasks = [task for task in asyncio.all_tasks()
+                     if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _handle_connection(self, reader, writer):
+        """
+        Handle a single connection with the request handler class.
+        """
+        if self.max_connections is not None and \
+           self.nr_of_connections >= self.max_connections:
+            writer.write(REJECT_RESPONSE)
+            writer.close()
+            return
+
+        self.nr_of_connections += 1
+        try:
+            handler = self.RequestHandlerClass(reader, writer, self)
+            await handler.handle_async()
+        except (ConnectionError, asyncio.TimeoutError,
+                asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.nr_of_connections -= 1
+            writer.close()
+
+    def service_actions(self):
+        """
+        Called regularly while serving. Does nothing by default.
+        """
+
+    def shutdown(self):
+        """
+        Stop serve_forever() and wait until it has stopped. Must be called
+        from another thread.
+        """
+        self.shutdown_requested = True
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.wakeup.set)
+            except RuntimeError:
+                # The loop has already been closed
+                pass
+        self.is_shut_down.wait()
+
+    def server_close(self):
+        """
+        Close the listening socket.
+        """
+        self.socket.close()
+
+
+def _have_pidfd():
+    """
+    Return True if the OS supports process file descriptors.
+    """
+    if not hasattr(os, 'pidfd_open'):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError:
+        return False
+    return True
+
+
+class _StreamWriterFile(object):
+    """
+    File-like wrapper for an asyncio StreamWriter, which is used as the
+    `wfile` of AsyncRequestHandlers. Writes are buffered by the event loop
+    and sent to the client when the handler awaits drain().
+    """
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        """
+        Write `data` (bytes) to the client.
+        """
+        self.writer.write(data)
+
+    def flush(self):
+        """
+        Does nothing; the event loop sends the data.
+        """
+
+
+class _StreamReaderFile(object):
+    """
+    File-like wrapper for an asyncio StreamReader, which is used as the
+    `rfile` of AsyncRequestHandlers. It reads the `length` bytes of the body
+    of a request. Reading blocks until the event loop has received the data,
+    so it must be done in another thread than the one running the event
+    loop. Each read is awaited with `wait` and may take at most `timeout`
+    seconds.
+    """
+    def __init__(self, reader, loop, length, wait, timeout):
+        self.reader = reader
+        self.loop = loop
+        self.remaining = length
+        self.wait = wait
+        self.timeout = timeout
+        self.buffer = None
+
+    async def read_all(self):
+        """
+        Read the rest of the body into memory, after which read() doesn't
+        block. Only meant for small bodies.
+        """
+        data = await self.wait(self.reader.readexactly(self.remaining))
+        self.buffer = io.BytesIO(data)
+        self.remaining = 0
+
+    def read(self, size=-1):
+        """
+        Read at most `size` bytes of the body, or all of the rest of the
+        body if `size` is negative. Returns b'' at the end of the body.
+        """
+        if self.buffer is not None:
+            return self.buffer.read(size)
+        if self.remaining <= 0:
+            return b''
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            raise RuntimeError("Can't read the request body from the event "
+                               "loop")
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        future = asyncio.run_coroutine_threadsafe(
+            self.wait(self.reader.read(size), self.timeout), self.loop)
+        data = future.result()
+        if not data:
+            # The client closed the connection.
+            self.remaining = 0
+        self.remaining -= len(data)
+        return data
+
+
+class AsyncRequestHandler(RequestHandler):
+    """
+    Request handler for the AsyncHTTPServer. It works like RequestHandler,
+    except that the h_ methods may also be coroutines, which are awaited.
+    Other h_ methods run in the event loop, so they must not block.
+
+    The body of a POST request is parsed by one of the server's
+    `body_threads` while it's received, like the threaded server does, so
+    uploaded files are written to their temporary files directly and the
+    size limits are checked as soon as they're exceeded. `rfile` can't be
+    read on the event loop. Bodies of at most `body_buffer_size` bytes are
+    read into memory and parsed in the event loop instead, which is quicker.
+    """
+    max_header_lines = 100
+    body_buffer_size = 1024 * 64
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, reader, writer, server):
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.client_address = writer.get_extra_info('peername')
+        self.connection = writer.get_extra_info('socket')
+        self.rfile = None
+        self.wfile = _StreamWriterFile(writer)
+
+    async def handle_async(self):
+        """
+        Handle requests on the connection until it's closed.
+        """
+        self.nr_of_requests = 0
+        self.close_connection = True
+        await self.handle_one_request_async()
+        while not self.close_connection:
+            await self.handle_one_request_async()
+
+    async def _wait(self, coro, timeout=None):
+        """
+        Await `coro`, which reads from or writes to the client, for at most
+        `timeout` seconds, or the server's `request_timeout` if not given.
+        """
+        if timeout is None:
+            timeout = self.server.request_timeout
+        return await asyncio.wait_for(coro, timeout)
+
+    async def drain(self):
+        """
+        Wait until the buffered output has been sent to the client.
+        """
+        await self._wait(self.writer.drain())
+
+    async def handle_one_request_async(self):
+        """
+        Read and handle a single request.
+        """
+        self.requestline = ''
+        self.request_version = ''
+        self.command = ''
+        timeout = None
+        if self.nr_of_requests > 0:
+            timeout = self.keepalive_timeout
+        try:
+            self.raw_requestline = await self._wait(self.reader.readline(),
+                                                    timeout)
+            if not self.raw_requestline:
+                self.close_connection = True
+                return
+            # Read the headers, so that parse_request() can parse them
+            # without blocking.
+            header_lines = []
+            while True:
+                line = await self._wait(self.reader.readline())
+                header_lines.append(line)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                if len(header_lines) > self.max_header_lines:
+                    self.send_error(431, "Too many headers")
+                    return
+        except ValueError:
+            # Line too long
+            self.send_error(431, "Line too long")
+            return
+        self.rfile = io.BytesIO(b''.join(header_lines))
+        if not self.parse_request():
+            return
+
+        if self.headers.get('Transfer-Encoding', 'identity') != 'identity':
+            self.send_error(411, "Length required")
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            self.send_error(400, "Invalid Content-Length")
+            return
+
+        body_timeout = self.server.request_timeout
+        if body_timeout is None:
+            body_timeout = BODY_READ_TIMEOUT
+        self.rfile = _StreamReaderFile(self.reader,
+                                       asyncio.get_running_loop(), length,
+                                       self._wait, body_timeout)
+        method_name = 'do_{0}'.format(self.command)
+        if not hasattr(self, method_name):
+            self.send_error(501, "Unsupported method")
+        else:
+            result = getattr(self, method_name)()
+            if inspect.isawaitable(result):
+                await result
+        await self.drain()
+        if self.rfile.remaining > 0:
+            # The rest of the body wasn't read, so the connection can't be
+            # used for another request.
+            self.close_connection = True
+
+    async def run_blocking(self, func, *args):
+        """
+        Call `func` with `args` in a thread and return its result, so that
+        the event loop can handle other connections while it blocks.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    def parse_request(self):
+        """
+        Parse the request line and headers. Overridden because the
+        connection's timeouts are handled by the event loop.
+        """
+        self.nr_of_requests += 1
+        return BaseHTTPRequestHandler.parse_request(self)
+
+    async def send_file(self, path, cache_control=None, cache=None):
+        """
+        Send the file at `path` as the response. See
+        RequestHandler.send_file(). The file is sent with copy_file().
+        """
+        if cache is not None and \
+           self.send_cached_file(path, cache_control, cache):
+            return
+        static_file, offset, count = self.start_file(path, cache_control)
+        if static_file is None:
+            return
+        with static_file:
+            await self.copy_file(static_file, offset, count)
+
+    async def copy_file(self, file_obj, offset, count):
+        """
+        Send `count` bytes of the (binary) `file_obj`, starting at `offset`,
+        to the client. The event loop copies them with sendfile() in blocks,
+        so that a client that stops reading times out.
+        """
+        loop = asyncio.get_running_loop()
+        await self.drain()
+        while count > 0:
+            sent = await self._wait(loop.sendfile(
+                self.writer.transport, file_obj, offset,
+                min(count, SENDFILE_BLOCK_SIZE)))
+            if not sent:
+                break
+            offset += sent
+            count -= sent
+
+    async def do_GET(self):  # pylint: disable=invalid-name
+        """
+        Handle a GET request.
+        """
+        await self._call(*self._parse(self.path.lstrip('/')))
+
+    async def do_POST(self):  # pylint: disable=invalid-name
+        """
+        Handle a POST request. See RequestHandler.do_POST(). Large bodies
+        are parsed while they're received by one of the server's
+        `body_threads`. Bodies that are too large are rejected before they're
+        read.
+        """
+        buffer_size = self.body_buffer_size
+        max_request_size = self.get_form_limits().get('max_request_size')
+        if max_request_size is not None:
+            buffer_size = min(buffer_size, max_request_size)
+        try:
+            if self.rfile.remaining <= buffer_size:
+                await self.rfile.read_all()
+                form_values = self._parse_form_values()
             else:
-                raise HTTPError(404, "Not found")
-            method_cb(**params)
+                loop = asyncio.get_running_loop()
+                form_values = await loop.run_in_executor(
+                    self.server.body_executor, self._parse_form_values)
         except HTTPError as err:
-            # HTTP erors are generally thrown by the webapp on purpose. Send
-            # error to the browser.
-            if err.status_code not in (401, ):
-                self.scriptform.log.exception(err)
-            self.send_response(err.status_code)
-            for header_k, header_v in err.headers.items():
-                self.send_header(header_k, header_v)
-            self.end_headers()
-            self.wfile.write("Error {0}: {1}".format(err.status_code,
-                                                     err.msg).encode('utf-8'))
-            self.wfile.flush()
+            self._send_http_error(err)
+            return
+        try:
+            await self._call(self.path.strip('/'),
+                             params={'form_values': form_values})
+        finally:
+            form_values.cleanup()
+
+    async def _call(self, path, params):
+        """
+        Find a method for `path` and call it. See RequestHandler._call().
+        Coroutines are awaited.
+        """
+        try:
+            result = self._find_method(path)(**params)
+            if inspect.isawaitable(result):
+                await result
+        except HTTPError as err:
+            self._send_http_error(err)
             return False
         except Exception as err:
             self.scriptform.log.exception(err)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark that compares rendering a large generated form field by field
+with FormRender.r_field() and r_form_line() (the old render path) to
+rendering it from compiled fields with FormRender.render_fields().
+
+Usage: ./bench_formrender.py [NR_OF_FIELDS] [NR_OF_RUNS]
+"""
+
+import sys
+import timeit
+
+sys.path.insert(0, '../src')
+from formdefinition import FormDefinition  # noqa: E402
+from formrender import FormRender  # noqa: E402
+
+
+FIELD_TYPES = [
+    {'type': 'string', 'minlen': 2, 'maxlen': 20, 'required': True},
+    {'type': 'integer', 'min': 0, 'max': 100},
+    {'type': 'float', 'min': 0, 'max': 1.5},
+    {'type': 'date', 'min': '2020-01-01'},
+    {'type': 'radio', 'options': [['a', 'Option A'], ['b', 'Option B']]},
+    {'type': 'select', 'options': [[str(i), 'Option {0}'.format(i)]
+                                   for i in range(10)]},
+    {'type': 'checkbox', 'checked': True},
+    {'type': 'text', 'rows': 4, 'cols': 40, 'classes': 'wide'},
+    {'type': 'password', 'minlen': 8},
+]
+
+
+def gen_fields(nr_of_fields):
+    """
+    Generate `nr_of_fields` field definitions of various types.
+    """
+    fields = []
+    for i in range(nr_of_fields):
+        field = dict(FIELD_TYPES[i % len(FIELD_TYPES)])
+        field['name'] = 'field_{0}'.format(i)
+        field['title'] = 'Field {0}'.format(i)
+        fields.append(field)
+    return fields
+
+
+def render_old(fr_inst, fields, form_values, errors):
+    """
+    Render the fields like Scriptform did before fields were compiled.
+    """
+    def render_field(field, errors):
+        params = {
+            'name': field['name'],
+            'classes': [],
+        }
+        if field.get('hidden', None):
+            params['classes'].append('hidden')
+        if field.get('required', None):
+            params['classes'].append('required')
+        params['classes'].extend(field.get('classes', '').split())
+        params["style"] = field.get("style", "")
+        if field['type'] not in ('file', 'checkbox'):
+            default_value = field.get('default_value', '')
+            params['value'] = form_values.get(field['name'], default_value)
+        if field['type'] not in ('radio', 'checkbox', 'select'):
+            params['required'] = field.get('required', False)
+        if field['type'] == 'string':
+            params['size'] = field.get('size', '')
+        if field['type'] in ('string', 'password', 'text'):
+            params['minlen'] = field.get('minlen', '')
+        if field['type'] in ('string', 'text'):
+            params['maxlen'] = field.get('maxlen', '')
+        if field['type'] in ('integer', 'float', 'date'):
+            params['minval'] = field.get('min', '')
+            params['maxval'] = field.get('max', '')
+        if field['type'] == 'text':
+            params['rows'] = field.get('rows', '')
+            params['cols'] = field.get('cols', '')
+        if field['type'] in ('radio', 'select'):
+            params['options'] = field['options']
+        if field['type'] == 'radio':
+            if not form_values.get(field['name'], None):
+                params['value'] = params['options'][0][0]
+        if field['type'] == 'checkbox':
+            params['checked'] = False
+            if 'checked' in field and field['checked']:
+                params['checked'] = True
+            if field['name'] in form_values:
+                if form_values[field['name']] == 'on':
+                    params['checked'] = True
+                else:
+                    params['checked'] = False
+        h_input = fr_inst.r_field(field['type'], **params)
+        return fr_inst.r_form_line(field['type'], field['title'],
+                                   h_input, params['classes'], errors)
+
+    return u''.join([render_field(f, errors.get(f['name'], []))
+                     for f in fields])
+
+
+def main():
+    nr_of_fields = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    nr_of_runs = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    fields = gen_fields(nr_of_fields)
+    form_def = FormDefinition('bench', 'Bench', 'Bench', fields, 'bench.sh')
+    resolved = form_def.resolve()
+    form_values = {'field_0': 'foo', 'field_4': 'b', 'field_6': ''}
+    errors = {'field_1': ['Invalid value']}
+
+    fr_old = FormRender(form_def)
+    fr_new = FormRender(form_def)
+    old = render_old(fr_old, fields, form_values, errors)
+    new = fr_new.render_fields(fields, form_values, errors, resolved)
+    if old != new:
+        sys.stderr.write("Old and new render paths produce different HTML\n")
+        sys.exit(1)
+
+    t_old = timeit.timeit(
+        lambda: render_old(fr_old, fields, form_values, errors),
+        number=nr_of_runs)
+    t_new = timeit.timeit(
+        lambda: fr_new.render_fields(fields, form_values, errors, resolved),
+        number=nr_of_runs)
+    print("{0} fields, {1} runs".format(nr_of_fields, nr_of_runs))
+    print("old: {0:.3f} ms/form".format(t_old / nr_of_runs * 1000))
+    print("new: {0:.3f} ms/form".format(t_new / nr_of_runs * 1000))
+    print("speedup: {0:.1f}x".format(t_old / t_new))
+
+
+if __name__ == '__main__':
+    main()
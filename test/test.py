@@ -9,6 +9,19 @@ import time
 import requests
 import re
 import random
+import shutil
+import tempfile
+import base64
+import socket
+import signal
+import select
+import subprocess
+import datetime
+import http.client
+import asyncio
+import io
+import gzip
+import zlib
 
 
 def gen_random_file(fname, size=1024):
@@ -50,6 +63,24 @@ class FormConfigTestCase(unittest.TestCase):
         fc = sf.get_form_config()
         self.assertTrue(fc.get_visible_forms() == [])
 
+    def testVisibleForms(self):
+        """Users see public forms and the forms they're allowed to run"""
+        from formconfig import FormConfig
+        from formdefinition import FormDefinition
+        forms = [
+            FormDefinition('public', 'Public', '', [], 'test.sh'),
+            FormDefinition('hidden', 'Hidden', '', [], 'test.sh', hidden=True),
+            FormDefinition('admin', 'Admin', '', [], 'test.sh', allowed_users=['admin']),
+            FormDefinition('both', 'Both', '', [], 'test.sh', allowed_users=['admin', 'user']),
+        ]
+        fc = FormConfig('Visible', forms)
+        names = lambda username: [f.name for f in fc.get_visible_forms(username)]
+        self.assertEqual(names(None), ['public'])
+        self.assertEqual(names('other'), ['public'])
+        self.assertEqual(names('user'), ['public', 'both'])
+        self.assertEqual(names('admin'), ['public', 'admin', 'both'])
+        self.assertIs(fc.get_form_def('hidden'), forms[1])
+
     def testCallbackStore(self):
         """Test a callback that returns output in strings"""
         sf = scriptform.ScriptForm('test_formconfig_callback.json')
@@ -75,6 +106,50 @@ class FormConfigTestCase(unittest.TestCase):
         stdout.close()
         stderr.close()
 
+    def testCallbackSpool(self):
+        """Test a callback that returns output in files"""
+        sf = scriptform.ScriptForm('test_formconfig_callback.json')
+        fc = sf.get_form_config()
+        fd = fc.get_form_def('test_store')
+        res = runscript.run_script(fd, {}, {}, spool=True)
+        self.assertEqual(res['exitcode'], 33)
+        self.assertEqual(res['stdout'].read(), b'stdout\n')
+        self.assertEqual(res['stderr'].read(), b'stderr\n')
+        self.assertFalse(res['truncated'])
+        res['stdout'].close()
+        res['stderr'].close()
+
+    def testCallbackTruncate(self):
+        """Output beyond max_output should be truncated"""
+        sf = scriptform.ScriptForm('test_formconfig_callback.json')
+        fc = sf.get_form_config()
+        fd = fc.get_form_def('test_truncate')
+        res = runscript.run_script(fd, {}, {})
+        self.assertEqual(res['stdout'], b'std' + runscript.TRUNCATED_MARKER)
+        self.assertTrue(res['truncated'])
+
+    def testCallbackLiveDisconnect(self):
+        """The script is killed if its live output can't be sent"""
+        from formdefinition import FormDefinition
+
+        class BrokenLive(object):
+            def start(self):
+                pass
+
+            def write(self, buf):
+                raise BrokenPipeError()
+
+        if os.path.exists('tmp_orphan'):
+            os.unlink('tmp_orphan')
+        fd = FormDefinition('live', 'Live', '', [],
+                            'echo out; sleep 1; touch tmp_orphan',
+                            stream=True)
+        self.assertRaises(BrokenPipeError, runscript.run_script, fd, {}, {},
+                          live=BrokenLive())
+        self.assertEqual(runscript.script_limiter.stats()['running'], 0)
+        time.sleep(1.5)
+        self.assertFalse(os.path.exists('tmp_orphan'))
+
     def testCallbackMissingParams(self):
         """
         """
@@ -84,6 +159,89 @@ class FormConfigTestCase(unittest.TestCase):
         self.assertRaises(ValueError, runscript.run_script, fd, {}, {})
 
 
+class ReloadTest(unittest.TestCase):
+    """
+    Test reloading of the form configuration when it changes.
+    """
+    config_file = 'tmp_reload.json'
+
+    def setUp(self):
+        self.config = {
+            "title": "Reload",
+            "forms": [
+                {"name": "one", "title": "One", "description": "", "script": "test.sh", "fields": []},
+                {"name": "two", "title": "Two", "description": "", "script": "test.sh", "fields": []},
+            ]
+        }
+        self.write_config()
+
+    def tearDown(self):
+        os.unlink(self.config_file)
+
+    def write_config(self, contents=None):
+        if contents is None:
+            contents = json.dumps(self.config)
+        with open(self.config_file, 'w') as fh:
+            fh.write(contents)
+        # Make sure the modification time changes
+        mtime = time.time() + random.randint(1, 1000)
+        os.utime(self.config_file, (mtime, mtime))
+
+    def testNoChange(self):
+        sf = scriptform.ScriptForm(self.config_file, cache=False)
+        fc = sf.get_form_config()
+        self.assertIs(sf.get_form_config(), fc)
+
+    def testChange(self):
+        """Only changed forms are recreated"""
+        sf = scriptform.ScriptForm(self.config_file, cache=False)
+        fc = sf.get_form_config()
+        self.config['forms'][1]['title'] = 'Changed'
+        self.write_config()
+        new_fc = sf.get_form_config()
+        self.assertIsNot(new_fc, fc)
+        self.assertIs(new_fc.get_form_def('one'), fc.get_form_def('one'))
+        self.assertEqual(new_fc.get_form_def('two').title, 'Changed')
+        self.assertEqual(fc.get_form_def('two').title, 'Two')
+
+    def testCache(self):
+        """Without reloading, changes are ignored"""
+        sf = scriptform.ScriptForm(self.config_file)
+        fc = sf.get_form_config()
+        self.config['forms'][1]['title'] = 'Changed'
+        self.write_config()
+        self.assertIs(sf.get_form_config(), fc)
+
+    def testReloadConfig(self):
+        """Forced reloads (SIGHUP) replace the config, even when cached"""
+        sf = scriptform.ScriptForm(self.config_file)
+        fc = sf.get_form_config()
+        self.config['title'] = 'Changed'
+        self.write_config()
+        self.assertTrue(sf.reload_form_config())
+        self.assertEqual(sf.get_form_config().title, 'Changed')
+        self.assertEqual(fc.title, 'Reload')
+
+        fc = sf.get_form_config()
+        self.write_config('{"title": ')
+        self.assertFalse(sf.reload_form_config())
+        self.assertIs(sf.get_form_config(), fc)
+
+    def testInvalid(self):
+        """An invalid configuration keeps the old one"""
+        sf = scriptform.ScriptForm(self.config_file, cache=False)
+        fc = sf.get_form_config()
+        self.write_config('{"title": ')
+        self.assertIs(sf.get_form_config(), fc)
+        self.config['forms'][0]['script'] = 'nosuchscript.sh'
+        self.write_config()
+        self.assertIs(sf.get_form_config(), fc)
+        self.config['forms'][0]['script'] = 'test.sh'
+        self.config['title'] = 'Fixed'
+        self.write_config()
+        self.assertEqual(sf.get_form_config().title, 'Fixed')
+
+
 class FormDefinitionTest(unittest.TestCase):
     """
     Form Definition tests. Mostly directly testing if validations work.
@@ -96,6 +254,15 @@ class FormDefinitionTest(unittest.TestCase):
         fd = self.fc.get_form_def('test_required')
         self.assertRaises(KeyError, fd.get_field_def, 'nosuchfield')
 
+    def testIsStatic(self):
+        fd = self.fc.get_form_def('test_val_date')
+        self.assertTrue(fd.is_static())
+        fd = copy.copy(fd)
+        fd.fields = [{'name': 'date', 'type': 'date', 'min': 'today'}]
+        self.assertFalse(fd.is_static())
+        fd.fields = None
+        self.assertFalse(fd.is_static())
+
     def testRequired(self):
         fd = self.fc.get_form_def('test_required')
         form_values = {}
@@ -103,6 +270,19 @@ class FormDefinitionTest(unittest.TestCase):
         self.assertIn('string', errors)
         self.assertIn('required', errors['string'][0])
 
+    def testValidateFieldMethods(self):
+        """The per-type validate methods still validate single fields"""
+        from formdefinition import ValidationError
+        fd = self.fc.get_form_def('test_val_integer')
+        field_def = fd.get_field_def('val_integer')
+        self.assertEqual(fd.validate_integer(field_def, {'val_integer': '6'}), 6)
+        self.assertRaises(ValidationError, fd.validate_integer, field_def, {'val_integer': 'a'})
+        fd = self.fc.get_form_def('test_val_select')
+        field_def = fd.get_field_def('val_select')
+        self.assertEqual(fd.validate_select(field_def, {'val_select': 'option_a'}), 'option_a')
+        self.assertRaises(ValidationError, fd.validate_select, field_def, {'val_select': 'option_b'},
+                          [['option_a', 'Option A']])
+
     def testValidateStringMin(self):
         fd = self.fc.get_form_def('test_val_string')
         form_values = {"val_string": "123"}
@@ -258,6 +438,22 @@ class FormDefinitionTest(unittest.TestCase):
         self.assertIn('val_text', errors)
         self.assertIn('Maximum', errors['val_text'][0])
 
+    def testValidatorsCompiledOnce(self):
+        """Static fields should only be compiled into validators once"""
+        fd = self.fc.get_form_def('test_val_integer')
+        validators = fd.get_validators(fd.get_fields())
+        fd.validate({"val_integer": 5})
+        self.assertIs(fd.get_validators(fd.get_fields()), validators)
+
+    def testValidateMany(self):
+        fd = self.fc.get_form_def('test_val_integer')
+        rows = [{"val_integer": 5}, {"val_integer": 7}, {"val_integer": 'x'}]
+        results = fd.validate_many(rows)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0], ({}, {"val_integer": 5}))
+        self.assertIn('Maximum', results[1][0]['val_integer'][0])
+        self.assertIn('Must be a', results[2][0]['val_integer'][0])
+
     def testValidateFileMissingFile(self):
         fd = self.fc.get_form_def('test_val_file')
         form_values = {}
@@ -268,7 +464,493 @@ class FormDefinitionTest(unittest.TestCase):
     def testValidateFileMissingFileName(self):
         fd = self.fc.get_form_def('test_val_file')
         form_values = {'val_file': 'foo'}
-        self.assertRaises(KeyError, fd.validate, form_values)
+        errors, values = fd.validate(form_values)
+        self.assertEqual(errors['val_file'], ['Invalid file upload'])
+
+
+    def testDeliverInvalid(self):
+        from formdefinition import FormDefinition
+        fields = [{'name': 'f', 'title': 'F', 'type': 'file',
+                   'deliver': 'mail'}]
+        self.assertRaises(ValueError, FormDefinition, 'f', 'F', '', fields,
+                          'test.sh')
+        fields = [{'name': 'f{0}'.format(i), 'title': 'F', 'type': 'file',
+                   'deliver': 'stdin'} for i in range(2)]
+        self.assertRaises(ValueError, FormDefinition, 'f', 'F', '', fields,
+                          'test.sh')
+
+    def testGetUploads(self):
+        from formdefinition import FormDefinition
+        fields = [{'name': 'a', 'title': 'A', 'type': 'file'},
+                  {'name': 'b', 'title': 'B', 'type': 'file',
+                   'deliver': 'stdin'},
+                  {'name': 'c', 'title': 'C', 'type': 'file',
+                   'deliver': 'fd'}]
+        resolved = FormDefinition('f', 'F', '', fields, 'test.sh').resolve()
+        uploads = resolved.get_uploads({'a': '/tmp/a', 'b': '/tmp/b',
+                                        'c': ''})
+        self.assertEqual(uploads, {'b': 'stdin'})
+
+
+class StaticCacheTest(unittest.TestCase):
+    """
+    Test the in-memory cache of static files.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='scriptform_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, fname, data, mtime=None):
+        path = os.path.join(self.tmp_dir, fname)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def testHitMiss(self):
+        from staticcache import StaticCache
+        cache = StaticCache()
+        path = self.write('a.txt', b'foo')
+        entry = cache.get(path)
+        self.assertEqual(entry.data, b'foo')
+        self.assertEqual(entry.content_type, 'text/plain')
+        self.assertIs(cache.get(path), entry)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+        # Changed files are read again
+        self.write('a.txt', b'foobar', mtime=time.time() + 10)
+        self.assertEqual(cache.get(path).data, b'foobar')
+        self.assertEqual(cache.stats()['size'], 6)
+
+    def testNotCached(self):
+        from staticcache import StaticCache
+        cache = StaticCache(max_file_size=10)
+        self.assertIsNone(cache.get(os.path.join(self.tmp_dir, 'nosuchfile')))
+        self.assertIsNone(cache.get(self.tmp_dir))
+        self.assertIsNone(cache.get(self.write('large.txt', b'x' * 11)))
+        self.assertEqual(cache.stats()['files'], 0)
+
+    def testEvict(self):
+        from staticcache import StaticCache
+        cache = StaticCache(max_size=25, max_file_size=10)
+        paths = [self.write('{0}.txt'.format(i), b'x' * 10) for i in range(3)]
+        cache.get(paths[0])
+        cache.get(paths[1])
+        cache.get(paths[0])
+        cache.get(paths[2])
+        # The least recently used file was evicted
+        self.assertEqual(list(cache.entries), [paths[0], paths[2]])
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['size'], 20)
+
+    def testGzip(self):
+        from staticcache import StaticCache
+        cache = StaticCache()
+        data = b'body { color: red; }\n' * 100
+        entry = cache.get(self.write('a.css', data))
+        self.assertEqual(gzip.decompress(cache.get_gzip(entry)), data)
+        self.assertEqual(cache.stats()['size'],
+                         len(data) + len(entry.gzip_data))
+
+        # Pre-compressed files are used if they're up to date
+        mtime = time.time() - 100
+        path = self.write('b.js', data, mtime=mtime)
+        self.write('b.js.gz', b'precompressed', mtime=mtime)
+        self.assertEqual(cache.get_gzip(cache.get(path)), b'precompressed')
+        path = self.write('c.js', data, mtime=mtime)
+        self.write('c.js.gz', b'precompressed', mtime=mtime - 10)
+        self.assertNotEqual(cache.get_gzip(cache.get(path)), b'precompressed')
+
+        # Images and incompressible files aren't compressed
+        entry = cache.get(self.write('a.png', data))
+        self.assertIsNone(cache.get_gzip(entry))
+        entry = cache.get(self.write('d.txt', os.urandom(1000)))
+        self.assertIsNone(cache.get_gzip(entry))
+
+
+class DynamicFormTest(unittest.TestCase):
+    """
+    Test the execution and caching of dynamic fields and options read from
+    scripts.
+    """
+    def setUp(self):
+        self.sf = scriptform.ScriptForm('test_formdefinition_cache.json')
+        self.fc = self.sf.get_form_config()
+        runscript.invalidate_from_file()
+        if os.path.exists('cache_calls.log'):
+            os.unlink('cache_calls.log')
+
+    def tearDown(self):
+        if os.path.exists('cache_calls.log'):
+            os.unlink('cache_calls.log')
+
+    def calls(self, kind):
+        if not os.path.exists('cache_calls.log'):
+            return 0
+        with open('cache_calls.log', 'r') as fh:
+            return fh.read().split().count(kind)
+
+    def testFieldsCached(self):
+        fd = self.fc.get_form_def('test_cache_fields')
+        for i in range(3):
+            fd.get_fields()
+        self.assertEqual(self.calls('fields'), 1)
+
+    def testOptionsCached(self):
+        fd = self.fc.get_form_def('test_cache_fields')
+        form_values = {"dyn_string": "abc", "dyn_select": "option_a"}
+        for i in range(3):
+            errors, values = fd.validate(form_values)
+            self.assertEqual(errors, {})
+        self.assertEqual(self.calls('options'), 1)
+
+    def testNotCached(self):
+        fd = self.fc.get_form_def('test_nocache_fields')
+        fd.get_fields()
+        fd.get_fields()
+        self.assertEqual(self.calls('fields'), 2)
+
+    def testInvalidate(self):
+        fd = self.fc.get_form_def('test_cache_fields')
+        fd.get_fields()
+        fd.invalidate_cache()
+        fd.get_fields()
+        self.assertEqual(self.calls('fields'), 2)
+
+    def testValidateExecutesOnce(self):
+        """Validating should execute dynamic fields and options only once"""
+        fd = self.fc.get_form_def('test_nocache_fields')
+        form_values = {"dyn_string": "a", "dyn_select": "option_c"}
+        errors, values = fd.validate(form_values)
+        self.assertIn('dyn_string', errors)
+        self.assertIn('dyn_select', errors)
+        self.assertEqual(self.calls('fields'), 1)
+        self.assertEqual(self.calls('options'), 1)
+
+    def testResolvedFieldDef(self):
+        fd = self.fc.get_form_def('test_nocache_fields')
+        resolved = fd.resolve()
+        self.assertEqual(resolved.get_field_def('dyn_string')['type'],
+                         'string')
+        self.assertRaises(KeyError, resolved.get_field_def, 'nosuchfield')
+        self.assertEqual(self.calls('fields'), 1)
+
+    def testSingleFlight(self):
+        """Concurrent lookups should wait for a single execution"""
+        fd = self.fc.get_form_def('test_cache_fields')
+        os.environ['CACHE_SLEEP'] = '0.5'
+        try:
+            threads = [threading.Thread(target=fd.get_fields)
+                       for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            del os.environ['CACHE_SLEEP']
+        self.assertEqual(self.calls('fields'), 1)
+
+
+class ScriptLimiterTest(unittest.TestCase):
+    """
+    Test limiting the number of concurrently running scripts.
+    """
+    def testUnlimited(self):
+        limiter = runscript.ScriptLimiter()
+        for i in range(10):
+            limiter.acquire('form')
+        self.assertEqual(limiter.stats()['running'], 10)
+
+    def testQueueFull(self):
+        limiter = runscript.ScriptLimiter(max_concurrent=1, max_queued=0)
+        limiter.acquire('form')
+        self.assertRaises(runscript.QueueFullError, limiter.acquire, 'form')
+        limiter.release('form')
+        limiter.acquire('form')
+        self.assertEqual(limiter.stats()['rejected'], 1)
+
+    def testQueueTimeout(self):
+        limiter = runscript.ScriptLimiter(max_concurrent=1, queue_timeout=0.1)
+        limiter.acquire('form')
+        self.assertRaises(runscript.QueueFullError, limiter.acquire, 'form')
+
+    def testPerFormLimit(self):
+        limiter = runscript.ScriptLimiter(max_queued=0)
+        limiter.acquire('form_a', 1)
+        limiter.acquire('form_b', 1)
+        self.assertRaises(runscript.QueueFullError, limiter.acquire,
+                          'form_a', 1)
+        self.assertEqual(limiter.stats()['running_forms'],
+                         {'form_a': 1, 'form_b': 1})
+
+    def testQueued(self):
+        """Queued scripts should run once a running script finishes"""
+        limiter = runscript.ScriptLimiter(max_concurrent=1)
+        limiter.acquire('form')
+        thread = threading.Thread(target=limiter.acquire, args=('form',))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(limiter.stats()['queued'], 1)
+        limiter.release('form')
+        thread.join()
+        stats = limiter.stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['running'], 1)
+        self.assertEqual(stats['waited'], 1)
+        self.assertGreater(stats['wait_time_max'], 0)
+
+
+    def testQueuedAsync(self):
+        """Scripts can wait for a slot in an event loop"""
+        limiter = runscript.ScriptLimiter(max_concurrent=1)
+        limiter.acquire('form')
+
+        async def wait():
+            task = asyncio.ensure_future(limiter.acquire_async('form'))
+            await asyncio.sleep(0.1)
+            self.assertEqual(limiter.stats()['queued'], 1)
+            threading.Thread(target=limiter.release, args=('form',)).start()
+            await asyncio.wait_for(task, 1)
+        asyncio.run(wait())
+        stats = limiter.stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['running'], 1)
+
+        limiter.configure(max_concurrent=1, queue_timeout=0.1)
+        self.assertRaises(runscript.QueueFullError, asyncio.run,
+                          limiter.acquire_async('form'))
+        self.assertEqual(limiter.stats()['queued'], 0)
+
+
+class JobStoreTest(unittest.TestCase):
+    """
+    Test running and storing asynchronous jobs.
+    """
+    def setUp(self):
+        self.jobs_dir = tempfile.mkdtemp(prefix='scriptform_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.jobs_dir)
+
+    def wait(self, job):
+        for i in range(50):
+            if job.is_finished():
+                return
+            time.sleep(0.1)
+
+    def testRun(self):
+        store = jobs.JobStore(self.jobs_dir)
+        result = {'stdout': b'out', 'stderr': b'err', 'exitcode': 3}
+        job = store.submit('form', 'user', lambda: result)
+        self.wait(job)
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.exitcode, 3)
+        self.assertEqual(job.read_output('stdout'), b'out')
+        self.assertEqual(job.read_output('stderr'), b'err')
+
+    def testFailed(self):
+        def run_cb():
+            raise OSError("no such script")
+        store = jobs.JobStore(self.jobs_dir)
+        job = store.submit('form', 'user', run_cb)
+        self.wait(job)
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.read_output('stderr'), b'no such script')
+
+    def testPersisted(self):
+        store = jobs.JobStore(self.jobs_dir)
+        result = {'stdout': b'out', 'stderr': b'', 'exitcode': 0}
+        job = store.submit('form', 'user', lambda: result)
+        self.wait(job)
+        store = jobs.JobStore(self.jobs_dir)
+        self.assertEqual(store.get(job.job_id).read_output('stdout'), b'out')
+
+    def testMaxCount(self):
+        store = jobs.JobStore(self.jobs_dir, max_count=2)
+        result = {'stdout': b'', 'stderr': b'', 'exitcode': 0}
+        job_ids = []
+        for i in range(4):
+            job = store.submit('form', 'user', lambda: result)
+            self.wait(job)
+            job_ids.append(job.job_id)
+        self.assertRaises(KeyError, store.get, job_ids[0])
+        self.assertEqual(store.get(job_ids[3]).status, 'done')
+        self.assertEqual(len(os.listdir(self.jobs_dir)), 2)
+
+    def testMaxAge(self):
+        """Old jobs expire without new jobs being submitted"""
+        store = jobs.JobStore(self.jobs_dir, max_age=3600)
+        result = {'stdout': b'', 'stderr': b'', 'exitcode': 0}
+        job = store.submit('form', 'user', lambda: result)
+        self.wait(job)
+        self.assertIs(store.get(job.job_id), job)
+        job.created -= 7200
+        job.save()
+        # Another worker process reads it from disk
+        other_store = jobs.JobStore(max_age=3600)
+        other_store.path = self.jobs_dir
+        self.assertRaises(KeyError, other_store.get, job.job_id)
+        self.assertRaises(KeyError, store.get, job.job_id)
+        self.assertEqual(os.listdir(self.jobs_dir), [])
+
+
+class SlowReader(object):
+    """
+    File-like object that returns at most `size` bytes per read, like a
+    socket.
+    """
+    def __init__(self, data, size=7):
+        self.fh = io.BytesIO(data)
+        self.size = size
+
+    def read(self, size=-1):
+        return self.fh.read(min(size, self.size))
+
+
+class FormParserTest(unittest.TestCase):
+    """
+    Test parsing of submitted form data.
+    """
+    def parse(self, body, content_type, size=7, **kwargs):
+        import email.message
+        import formparser
+        headers = email.message.Message()
+        headers['Content-Type'] = content_type
+        headers['Content-Length'] = str(len(body))
+        return formparser.parse_form(SlowReader(body, size), headers, **kwargs)
+
+    def multipart(self, parts, epilogue=b''):
+        body = b'preamble'
+        for headers, value in parts:
+            body += b'\r\n--XyZ\r\n' + headers + b'\r\n\r\n' + value
+        return body + b'\r\n--XyZ--\r\n' + epilogue
+
+    def testMultipart(self):
+        # Partial delimiters in the data must be kept
+        data = b'\r\n--Xy\r\n' * 3 + bytes(range(256)) * 10 + b'\r\n--Xy'
+        body = self.multipart([
+            (b'Content-Disposition: form-data; name="string"', u'f\u00f6\r\no'.encode('utf8')),
+            (b'Content-Disposition: form-data; name="empty"', b''),
+            (b'Content-Disposition: form-data; name="file"; filename="a \xc3\xa9.txt"\r\n'
+             b'Content-Type: application/octet-stream', data),
+            (b'Content-Disposition: form-data; name="nofile"; filename=""', b''),
+        ], epilogue=b'GET / HTTP/1.1')
+        form_values = self.parse(body, 'multipart/form-data; boundary=XyZ')
+        self.assertEqual(list(form_values), ['string', 'empty', 'file', 'nofile'])
+        self.assertEqual(form_values.getfirst('string'), u'f\u00f6\r\no')
+        self.assertEqual(form_values.getfirst('empty'), u'')
+        self.assertEqual(form_values.getfirst('missing', 'default'), 'default')
+        field = form_values['file']
+        self.assertEqual(field.filename, u'a \u00e9.txt')
+        self.assertEqual(form_values.getfirst('file'), data)
+        self.assertEqual(form_values.tmp_files, [field.path])
+        self.assertEqual(form_values['nofile'].filename, '')
+        form_values.cleanup()
+        self.assertFalse(os.path.exists(field.path))
+
+    def testUrlencoded(self):
+        form_values = self.parse(b'a=1&b=&c=%C3%A9+x&a=2', 'application/x-www-form-urlencoded')
+        self.assertEqual(list(form_values), ['a', 'c'])
+        self.assertEqual(form_values.getfirst('a'), '1')
+        self.assertEqual(form_values.getfirst('c'), u'\u00e9 x')
+
+    def testLimits(self):
+        import formparser
+        body = self.multipart([
+            (b'Content-Disposition: form-data; name="field"', b'x' * 100),
+            (b'Content-Disposition: form-data; name="file"; filename="a"', b'x' * 1000),
+        ])
+        content_type = 'multipart/form-data; boundary=XyZ'
+        self.parse(body, content_type, max_request_size=len(body), max_field_size=100, max_file_size=1000)
+        for kwargs in ({'max_request_size': len(body) - 1}, {'max_field_size': 99}, {'max_file_size': 999}):
+            with self.assertRaises(formparser.FormParseError) as ctx:
+                self.parse(body, content_type, **kwargs)
+            self.assertEqual(ctx.exception.status_code, 413)
+        tmp_files = set(os.listdir(tempfile.gettempdir()))
+        self.assertRaises(formparser.FormParseError, self.parse, body, content_type, size=100, max_file_size=999)
+        self.assertEqual(set(os.listdir(tempfile.gettempdir())), tmp_files)
+
+    def testInvalid(self):
+        import formparser
+        content_type = 'multipart/form-data; boundary=XyZ'
+        body = self.multipart([(b'Content-Disposition: form-data; name="field"', b'x')])
+        self.assertRaises(formparser.FormParseError, self.parse, body[:-10], content_type)
+        self.assertRaises(formparser.FormParseError, self.parse, body, 'multipart/form-data')
+        body = self.multipart([(b'Content-Disposition: form-data', b'x')])
+        self.assertRaises(formparser.FormParseError, self.parse, body, content_type)
+
+
+class FormRenderTest(unittest.TestCase):
+    """
+    Test the rendering of compiled form fields.
+    """
+    def setUp(self):
+        from formdefinition import FormDefinition
+        from formrender import FormRender
+        self.fields = [
+            {'name': 'string', 'title': 'String', 'type': 'string', 'required': True},
+            {'name': 'date', 'title': 'Date', 'type': 'date', 'default_value': 'today', 'max': 'today'},
+            {'name': 'radio', 'title': 'Radio', 'type': 'radio', 'options': [['a', 'A'], ['b', 'B']]},
+            {'name': 'select', 'title': 'Select', 'type': 'select', 'options': [['a', 'A'], ['b', 'B']]},
+            {'name': 'checkbox', 'title': 'Checkbox', 'type': 'checkbox', 'checked': True},
+        ]
+        self.form_def = FormDefinition('render', 'Render', 'Render', self.fields, 'test.sh')
+        self.fr = FormRender(self.form_def)
+
+    def testRender(self):
+        values = {'string': '<foo>', 'select': 'b', 'checkbox': ''}
+        errors = {'string': ['Error 1', 'Error 2']}
+        output = self.fr.render_fields(self.fields, values, errors, self.form_def.resolve())
+        self.assertIn('value="<foo>"', output)
+        self.assertIn('Error 1, Error 2', output)
+        self.assertIn('<input checked type="radio" name="radio" value="a"', output)
+        self.assertIn('<option value="b" style="" selected>B</option>', output)
+        self.assertIn('<input  type="checkbox" name="checkbox"', output)
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        self.assertIn('value="{0}" min="" max="{0}"'.format(today), output)
+
+        # Values from the previous render must not stick
+        output = self.fr.render_fields(self.fields, {}, {}, self.form_def.resolve())
+        self.assertIn('name="string" value=""', output)
+        self.assertNotIn('Error 1', output)
+        self.assertIn('<option value="b" style="" >B</option>', output)
+        self.assertIn('<input checked type="checkbox" name="checkbox"', output)
+
+    def testPlanCache(self):
+        plan = self.fr.get_plan(self.fields)
+        self.assertIs(self.fr.get_plan(self.fields), plan)
+        self.assertIsNot(self.fr.get_plan(list(self.fields)), plan)
+
+
+class PageChromeTest(unittest.TestCase):
+    """
+    Test the rendering of the page header and footer.
+    """
+    def testInlineCSS(self):
+        """CSS is included in the header by default"""
+        from formconfig import FormConfig
+        from webapp import get_page_chrome
+        fc = FormConfig('Chrome', [], custom_css='h1 { color: red; }')
+        chrome = get_page_chrome(fc)
+        self.assertIn(b'<style>', chrome.header)
+        self.assertIn(b'h1 { color: red; }', chrome.header)
+        self.assertIn(b'<h1>Chrome</h1>', chrome.header)
+        self.assertIs(get_page_chrome(fc), chrome)
+
+    def testExternalCSS(self):
+        """With external_css, the header links to the CSS"""
+        from formconfig import FormConfig
+        from webapp import get_page_chrome
+        fc = FormConfig('Chrome', [], custom_css='h1 { color: red; }',
+                        external_css=True)
+        chrome = get_page_chrome(fc)
+        self.assertNotIn(b'<style>', chrome.header)
+        self.assertIn('css?v={0}'.format(chrome.css_version).encode('utf8'), chrome.header)
+        self.assertIn(b'h1 { color: red; }', chrome.css)
 
 
 class FormDefinitionFieldMissingProperty(unittest.TestCase):
@@ -278,10 +960,219 @@ class FormDefinitionFieldMissingProperty(unittest.TestCase):
         self.assertRaises(KeyError, scriptform.ScriptForm, 'test_formdefinition_missing_title.json')
 
 
+class UserAuthTest(unittest.TestCase):
+    """
+    Test the hashing of passwords and the session tokens.
+    """
+    def testHashPassword(self):
+        import userauth
+        for scheme in userauth.HASH_SCHEMES:
+            pw_hash = userauth.hash_password(u'pässword', scheme)
+            self.assertTrue(userauth.check_password(u'pässword', pw_hash))
+            self.assertFalse(userauth.check_password(u'password', pw_hash))
+        # Hashes are salted
+        self.assertNotEqual(userauth.hash_password('pw', 'pbkdf2'),
+                            userauth.hash_password('pw', 'pbkdf2'))
+        self.assertRaises(ValueError, userauth.hash_password, 'pw', 'md5')
+
+    def testCheckPasswordMalformed(self):
+        import userauth
+        for pw_hash in ['pbkdf2_sha256$1000$c2FsdA', 'pbkdf2_sha256$x$c2FsdA$c2FsdA',
+                        'pbkdf2_sha256$1000$c2FsdA$', 'scrypt$0$8$1$c2FsdA$c2FsdA',
+                        'md5$c2FsdA$c2FsdA', u'ä', '']:
+            self.assertFalse(userauth.check_password('admin', pw_hash))
+
+    def testSession(self):
+        import userauth
+        users = {u'üser': 'hash1', 'other': 'hash2'}
+        secret = b'secret'
+        token = userauth.make_session(u'üser', 'hash1', secret, 60)
+        self.assertEqual(userauth.check_session(token, users, secret), u'üser')
+        # Wrong secret
+        self.assertIsNone(userauth.check_session(token, users, b'other'))
+        # Changed password
+        self.assertIsNone(userauth.check_session(token, {u'üser': 'hash3'}, secret))
+        # Removed user
+        self.assertIsNone(userauth.check_session(token, {'other': 'hash2'}, secret))
+        # Expired
+        token_expired = userauth.make_session(u'üser', 'hash1', secret, -1)
+        self.assertIsNone(userauth.check_session(token_expired, users, secret))
+        # Tampered with
+        user, expires, signature = token.split('.')
+        for tampered in ['b3RoZXI.{0}.{1}'.format(expires, signature),
+                         '{0}.{1}.{2}'.format(user, int(expires) + 1, signature),
+                         '{0}.{1}.{2}'.format(user, expires, u'ä'),
+                         token + '.', 'garbage', '']:
+            self.assertIsNone(userauth.check_session(tampered, users, secret))
+
+    def testDummyHash(self):
+        import userauth
+        self.assertIsNone(userauth.dummy_hash({}))
+        self.assertEqual(userauth.dummy_hash({'admin': 'hash1'}), 'hash1')
+
+    def testUnknownUserTiming(self):
+        """Unknown users take as long to reject as wrong passwords"""
+        import types
+        import userauth
+        import webapp
+        pw_hash = userauth.hash_password('admin')
+        form_config = types.SimpleNamespace(users={'admin': pw_hash},
+                                            auth_cache=userauth.AuthCache())
+        check_password = webapp.ScriptFormWebApp.check_password
+        start = time.monotonic()
+        self.assertIsNone(check_password(form_config, 'admin', 'wrong'))
+        known = time.monotonic() - start
+        start = time.monotonic()
+        self.assertIsNone(check_password(form_config, 'nobody', 'wrong'))
+        unknown = time.monotonic() - start
+        self.assertGreater(unknown, known / 2)
+        self.assertEqual(check_password(form_config, 'admin', 'admin'), pw_hash)
+
+    def testAuthCache(self):
+        import userauth
+        pw_hash = userauth.hash_password('pw', 'sha256')
+        auth_cache = userauth.AuthCache(ttl=60, max_entries=2)
+        self.assertFalse(auth_cache.check('user', 'wrong', pw_hash))
+        self.assertEqual(len(auth_cache.entries), 0)
+        self.assertTrue(auth_cache.check('user', 'pw', pw_hash))
+        self.assertEqual(len(auth_cache.entries), 1)
+        # The cached result is only used for the same password and hash
+        self.assertTrue(auth_cache.check('user', 'pw', pw_hash))
+        self.assertFalse(auth_cache.check('user', 'pw', 'otherhash'))
+        self.assertFalse(auth_cache.check('user', 'wrong', pw_hash))
+        self.assertTrue(auth_cache.check('user2', 'pw', pw_hash))
+        self.assertTrue(auth_cache.check('user3', 'pw', pw_hash))
+        self.assertEqual(len(auth_cache.entries), 2)
+        # Caching disabled
+        auth_cache = userauth.AuthCache(ttl=0)
+        self.assertTrue(auth_cache.check('user', 'pw', pw_hash))
+        self.assertEqual(len(auth_cache.entries), 0)
+
+
+class UserFileTest(unittest.TestCase):
+    """
+    Test reading users from users files.
+    """
+    users_file = 'tmp_users'
+    users_db = 'tmp_users.db'
+    config_file = 'tmp_users.json'
+
+    def tearDown(self):
+        for path in [self.users_file, self.users_db, self.config_file]:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def write_users(self, contents, mode='w'):
+        with open(self.users_file, mode) as fh:
+            fh.write(contents)
+
+    def testText(self):
+        import userauth
+        self.write_users('# Comment\n\nadmin:hash1\nuser: hash2 \ninvalid\n')
+        users = userauth.UserFile(self.users_file, check_interval=0)
+        self.assertTrue(users)
+        self.assertEqual(len(users), 2)
+        self.assertEqual(users['admin'], 'hash1')
+        self.assertEqual(users.get('user'), 'hash2')
+        self.assertNotIn('invalid', users)
+        self.assertIsNone(users.get('nobody'))
+
+        # Appended lines are read incrementally and override earlier lines.
+        # The users are replaced by a new dict, rather than changed while
+        # they may be read. A last line without a newline isn't read yet.
+        users_dict = users.users
+        self.write_users('admin:hash3\nnew:hash4', mode='a')
+        self.assertEqual(users['admin'], 'hash3')
+        self.assertNotIn('new', users)
+        self.assertIsNot(users.users, users_dict)
+        self.assertEqual(users_dict['admin'], 'hash1')
+        self.write_users('5\n', mode='a')
+        self.assertEqual(users['new'], 'hash45')
+
+        # Rewritten files are read entirely
+        self.write_users('admin:hash1\nother:hash2\n')
+        self.assertEqual(users['admin'], 'hash1')
+        self.assertNotIn('new', users)
+        self.assertIsNot(users.users, users_dict)
+
+        # If the file is gone, the old users are kept
+        os.unlink(self.users_file)
+        self.assertEqual(users['other'], 'hash2')
+
+    def testEmpty(self):
+        """An empty users file still requires authentication"""
+        import userauth
+        self.write_users('')
+        users = userauth.UserFile(self.users_file)
+        self.assertTrue(users)
+        self.assertEqual(len(users), 0)
+
+    def testCheckInterval(self):
+        import userauth
+        self.write_users('admin:hash1\n')
+        users = userauth.UserFile(self.users_file, check_interval=3600)
+        self.assertNotIn('user', users)
+        self.write_users('user:hash2\n', mode='a')
+        self.assertNotIn('user', users)
+        users.refresh()
+        self.assertIn('user', users)
+
+    def testSQLite(self):
+        import userauth
+        userauth.add_user(self.users_db, 'admin', 'hash1')
+        userauth.add_user(self.users_db, 'user', 'hash2')
+        users = userauth.UserFile(self.users_db, check_interval=0)
+        self.assertEqual(len(users), 2)
+        self.assertEqual(users['admin'], 'hash1')
+        userauth.add_user(self.users_db, 'admin', 'hash3')
+        self.assertEqual(users['admin'], 'hash3')
+        self.assertEqual(len(users), 2)
+
+    def testAddUser(self):
+        import userauth
+        self.write_users('admin:hash1')
+        userauth.add_user(self.users_file, 'user', 'hash2')
+        userauth.add_user(self.users_file, 'admin', 'hash3')
+        with open(self.users_file) as fh:
+            self.assertEqual(fh.read(), 'admin:hash1\nuser:hash2\nadmin:hash3\n')
+        for username in ['', 'a:b', 'a\nb']:
+            self.assertRaises(ValueError, userauth.add_user, self.users_file, username, 'hash')
+
+    def testMissing(self):
+        import userauth
+        self.assertRaises(OSError, userauth.UserFile, 'nosuchfile')
+
+    def testFormConfig(self):
+        """The users file is reused when the form configuration is reloaded"""
+        from formconfig import FormConfigError
+        self.write_users('user:04f8996da763b7a969b1028ee3007569eaf3a635486ddab211d512c85b9df8fb\n')
+        config = {
+            "title": "Users file",
+            "users_file": self.users_file,
+            "forms": [
+                {"name": "one", "title": "One", "description": "", "script": "test.sh", "fields": []},
+            ]
+        }
+        with open(self.config_file, 'w') as fh:
+            json.dump(config, fh)
+        sf = scriptform.ScriptForm(self.config_file)
+        fc = sf.get_form_config()
+        self.assertIn('user', fc.users)
+        self.assertTrue(sf.reload_form_config())
+        self.assertIs(sf.get_form_config().users, fc.users)
+
+        config['users'] = {'admin': 'hash'}
+        with open(self.config_file, 'w') as fh:
+            json.dump(config, fh)
+        self.assertRaises(FormConfigError, scriptform.ScriptForm, self.config_file)
+
+
 class WebAppTest(unittest.TestCase):
     """
     Test the web app by actually running the server and making web calls to it.
     """
+    engine = 'threads'
+
     @classmethod
     def setUpClass(cls):
         cls.auth_admin = requests.auth.HTTPBasicAuth('admin', 'admin')
@@ -290,7 +1181,7 @@ class WebAppTest(unittest.TestCase):
         # Run the server in a thread, so we can execute the tests in the main
         # program.
         def server_thread(sf):
-            sf.run(listen_port=8002)
+            sf.run(listen_port=8002, engine=cls.engine)
         cls.sf = scriptform.ScriptForm('test_webapp.json')
 
         thread = threading.Thread(target=server_thread, args=(cls.sf,))
@@ -328,6 +1219,39 @@ class WebAppTest(unittest.TestCase):
         r = requests.post('http://localhost:8002/submit', data)
         self.assertEqual(r.status_code, 401)
 
+    def testAuthMalformed(self):
+        for header in ['Basic', 'Basic !!!', 'Basic ' + base64.b64encode(b'admin').decode(),
+                       'Bearer ' + base64.b64encode(b'admin:admin').decode()]:
+            r = requests.get('http://localhost:8002/', headers={'Authorization': header})
+            self.assertEqual(r.status_code, 401)
+
+    def testAuthWrongPassword(self):
+        auth = requests.auth.HTTPBasicAuth('admin', 'wrong')
+        r = requests.get('http://localhost:8002/form?form_name=admin_only', auth=auth)
+        self.assertEqual(r.status_code, 401)
+        self.assertNotIn('Set-Cookie', r.headers)
+
+    def testAuthSession(self):
+        r = requests.get('http://localhost:8002/', auth=self.auth_admin)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('HttpOnly', r.headers['Set-Cookie'])
+        self.assertIn('Max-Age=3600', r.headers['Set-Cookie'])
+        token = r.cookies['scriptform_session']
+
+        # The session cookie authenticates without a password
+        cookies = {'scriptform_session': token}
+        r = requests.get('http://localhost:8002/form?form_name=admin_only', cookies=cookies)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('Set-Cookie', r.headers)
+
+        # Tampered session cookie
+        user, expires, signature = token.split('.')
+        cookies = {'scriptform_session': '{0}.{1}.{2}'.format(
+            base64.urlsafe_b64encode(b'user').decode().rstrip('='), expires, signature)}
+        r = requests.get('http://localhost:8002/', cookies=cookies)
+        self.assertEqual(r.status_code, 401)
+        self.assertNotIn('Set-Cookie', r.headers)
+
     def testAuthFormUnauthorizedGet(self):
         r = requests.get('http://localhost:8002/form?form_name=admin_only', auth=self.auth_user)
         self.assertEqual(r.status_code, 403)
@@ -469,6 +1393,65 @@ class WebAppTest(unittest.TestCase):
         r = requests.post('http://localhost:8002/submit', data, auth=self.auth_user)
         self.assertIn('string=<foo>', r.text)
 
+    def testOutputRawCompress(self):
+        data = {"form_name": 'output_raw_compress'}
+        r = requests.post('http://localhost:8002/submit', data,
+                          auth=self.auth_user)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', r.headers)
+        self.assertEqual(r.text, 'raw output\n' * 200)
+
+        r = requests.post('http://localhost:8002/submit', data,
+                          auth=self.auth_user,
+                          headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(r.text, 'raw output\n' * 200)
+
+    def testOutputRawNotCompressed(self):
+        """Raw output is only compressed if the form asks for it"""
+        data = {"form_name": 'output_raw', "string": 'x' * 2000}
+        r = requests.post('http://localhost:8002/submit', data,
+                          auth=self.auth_user)
+        self.assertNotIn('Content-Encoding', r.headers)
+
+    def testCompress(self):
+        # Generated pages
+        r = requests.get('http://localhost:8002/', auth=self.auth_user,
+                         headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(r.headers['Vary'], 'Accept-Encoding')
+        self.assertIn('Output raw', r.text)
+        r_plain = requests.get('http://localhost:8002/', auth=self.auth_user,
+                               headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', r_plain.headers)
+        self.assertEqual(r.text, r_plain.text)
+
+        # Cached pages have an ETag for each variant
+        url = 'http://localhost:8002/form?form_name=validate'
+        r = requests.get(url, auth=self.auth_user)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        etag = r.headers['ETag']
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'Accept-Encoding': 'identity'})
+        self.assertNotEqual(r.headers['ETag'], etag)
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
+        # Streamed result pages
+        data = {"form_name": 'output_escaped', "string": 'x' * 2000}
+        r = requests.post('http://localhost:8002/submit', data,
+                          auth=self.auth_user)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(r.headers['Transfer-Encoding'], 'chunked')
+        self.assertIn('string=' + 'x' * 2000, r.text)
+
+        # Small responses aren't compressed
+        data = {"form_name": "validate", "rows": ''}
+        r = requests.post('http://localhost:8002/submit_batch', data,
+                          auth=self.auth_user)
+        self.assertNotIn('Content-Encoding', r.headers)
+
     def testOutputHTML(self):
         data = {
             "form_name": 'output_html',
@@ -489,6 +1472,91 @@ class WebAppTest(unittest.TestCase):
             self.assertIn('SAME', r.text)
             os.unlink('data.raw')
 
+    def testUploadDeliver(self):
+        gen_random_file('data.raw')
+        try:
+            for form_name in ('upload_stdin', 'upload_fd'):
+                with open('data.raw', 'rb') as fh:
+                    r = requests.post("http://localhost:8002/submit",
+                                      files={'file': fh},
+                                      data={"form_name": form_name},
+                                      auth=self.auth_user)
+                self.assertIn('SAME', r.text)
+                if form_name == 'upload_stdin':
+                    self.assertIn('file=/dev/stdin fd=', r.text)
+                else:
+                    self.assertRegex(r.text, r'file=/dev/fd/(\d+) fd=\1')
+        finally:
+            os.unlink('data.raw')
+
+    def testUploadSpoofed(self):
+        """
+        A normal field can't pass off a path as an uploaded file.
+        """
+        with open('spoofed.raw', 'wb') as fh:
+            fh.write(b'spoofed')
+        try:
+            data = {"form_name": "upload_fd", "file": "spoofed.raw",
+                    "file__name": "spoofed.raw"}
+            r = requests.post("http://localhost:8002/submit", files={'x': b''},
+                              data=data, auth=self.auth_user)
+            self.assertNotIn('SAME', r.text)
+            self.assertTrue(os.path.exists('spoofed.raw'))
+        finally:
+            os.unlink('spoofed.raw')
+
+    def testUploadNotAFile(self):
+        """A normal field in place of a file upload is a validation error"""
+        data = {"form_name": "upload", "file": "foo"}
+        r = requests.post("http://localhost:8002/submit", files={'x': b''},
+                          data=data, auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('Invalid file upload', r.text)
+
+    def testUploadTooLarge(self):
+        data = {"form_name": "upload"}
+        files = {'file': ('data.raw', b'x' * (1024 * 1024 + 1))}
+        r = requests.post("http://localhost:8002/submit", files=files, data=data, auth=self.auth_user)
+        self.assertEqual(r.status_code, 413)
+        self.assertEqual(r.headers['Connection'], 'close')
+
+    def testUploadTooLargeStreamed(self):
+        """Too large uploads are rejected before the whole body is sent"""
+        boundary = 'xxBOUNDARYxx'
+        head = (
+            '--{0}\r\n'
+            'Content-Disposition: form-data; name="form_name"\r\n\r\n'
+            'upload\r\n'
+            '--{0}\r\n'
+            'Content-Disposition: form-data; name="file"; filename="data.raw"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'
+        ).format(boundary).encode('ascii')
+        auth = base64.b64encode(b'user:user').decode('ascii')
+        sock = socket.create_connection(('localhost', 8002))
+        sock.sendall((
+            'POST /submit HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'Authorization: Basic {0}\r\n'
+            'Content-Type: multipart/form-data; boundary={1}\r\n'
+            'Content-Length: {2}\r\n\r\n'
+        ).format(auth, boundary, 100 * 1024 * 1024).encode('ascii') + head)
+        chunk = b'x' * (64 * 1024)
+        sent = 0
+        try:
+            while sent < 4 * 1024 * 1024:
+                readable, _, _ = select.select([sock], [], [], 0.02)
+                if readable:
+                    break
+                sock.sendall(chunk)
+                sent += len(chunk)
+        except OSError:
+            pass
+        sock.settimeout(10)
+        response = sock.recv(4096)
+        sock.close()
+        self.assertTrue(response.startswith(b'HTTP/1.1 413'))
+        self.assertLess(sent, 4 * 1024 * 1024)
+
     def testStaticValid(self):
         r = requests.get("http://localhost:8002/static?fname=ssh_server.png", auth=self.auth_user)
         self.assertEqual(r.status_code, 200)
@@ -500,10 +1568,116 @@ class WebAppTest(unittest.TestCase):
             f_orig = fh.read()
             self.assertEqual(f_orig, f_served)
 
+    def testStaticHeaders(self):
+        url = "http://localhost:8002/static?fname=ssh_server.png"
+        r = requests.get(url, auth=self.auth_user)
+        self.assertEqual(r.headers['Content-Type'], 'image/png')
+        self.assertEqual(r.headers['Content-Length'],
+                         str(os.path.getsize('static/ssh_server.png')))
+        self.assertEqual(r.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(r.headers['Accept-Ranges'], 'bytes')
+
+        # Conditional requests
+        r2 = requests.get(url, auth=self.auth_user,
+                          headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(r2.status_code, 304)
+        self.assertEqual(r2.content, b'')
+        r2 = requests.get(url, auth=self.auth_user,
+                          headers={'If-Modified-Since': r.headers['Last-Modified']})
+        self.assertEqual(r2.status_code, 304)
+        r2 = requests.get(url, auth=self.auth_user,
+                          headers={'If-None-Match': '"other"',
+                                   'If-Modified-Since': r.headers['Last-Modified']})
+        self.assertEqual(r2.status_code, 200)
+        self.assertEqual(r2.content, r.content)
+
+    def testStaticRange(self):
+        url = "http://localhost:8002/static?fname=ssh_server.png"
+        with open('static/ssh_server.png', 'rb') as fh:
+            f_orig = fh.read()
+        size = len(f_orig)
+
+        r = requests.get(url, auth=self.auth_user, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, f_orig[10:20])
+        self.assertEqual(r.headers['Content-Range'], 'bytes 10-19/{0}'.format(size))
+
+        r = requests.get(url, auth=self.auth_user, headers={'Range': 'bytes=100-'})
+        self.assertEqual(r.content, f_orig[100:])
+        r = requests.get(url, auth=self.auth_user, headers={'Range': 'bytes=-100'})
+        self.assertEqual(r.content, f_orig[-100:])
+
+        # Multiple ranges and stale If-Range give the whole file
+        r = requests.get(url, auth=self.auth_user, headers={'Range': 'bytes=0-1,5-6'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, f_orig)
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'Range': 'bytes=10-19', 'If-Range': '"other"'})
+        self.assertEqual(r.status_code, 200)
+
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'Range': 'bytes={0}-'.format(size)})
+        self.assertEqual(r.status_code, 416)
+        self.assertEqual(r.headers['Content-Range'], 'bytes */{0}'.format(size))
+
+    def testStaticLarge(self):
+        """Files larger than a sendfile block are sent completely"""
+        f_orig = os.urandom(1024 * 1024 * 20)
+        with open('static/large.raw', 'wb') as fh:
+            fh.write(f_orig)
+        try:
+            url = "http://localhost:8002/static?fname=large.raw"
+            r = requests.get(url, auth=self.auth_user)
+            self.assertEqual(r.headers['Content-Type'], 'application/octet-stream')
+            self.assertEqual(r.content, f_orig)
+            r = requests.get(url, auth=self.auth_user,
+                             headers={'Range': 'bytes=1000-'})
+            self.assertEqual(r.content, f_orig[1000:])
+        finally:
+            os.unlink('static/large.raw')
+
+    def testStaticGzip(self):
+        url = "http://localhost:8002/static?fname=test.css"
+        with open('static/test.css', 'rb') as fh:
+            f_orig = fh.read()
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(r.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(r.headers['Content-Type'], 'text/css')
+        self.assertLess(int(r.headers['Content-Length']), len(f_orig))
+        self.assertEqual(r.content, f_orig)
+        gzip_etag = r.headers['ETag']
+
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(r.headers['Content-Length'], str(len(f_orig)))
+        self.assertEqual(r.content, f_orig)
+        self.assertNotEqual(r.headers['ETag'], gzip_etag)
+
+        r = requests.get(url, auth=self.auth_user,
+                         headers={'Accept-Encoding': 'gzip',
+                                  'If-None-Match': gzip_etag})
+        self.assertEqual(r.status_code, 304)
+
+        stats = requests.get("http://localhost:8002/status",
+                             auth=self.auth_user).json()['static_cache']
+        self.assertGreaterEqual(stats['hits'], 2)
+        self.assertGreaterEqual(stats['files'], 1)
+
     def testStaticInvalidFilename(self):
         r = requests.get("http://localhost:8002/static?fname=../../ssh_server.png", auth=self.auth_user)
         self.assertEqual(r.status_code, 403)
 
+    def testStaticAbsoluteFilename(self):
+        r = requests.get("http://localhost:8002/static?fname=/etc/passwd", auth=self.auth_user)
+        self.assertEqual(r.status_code, 403)
+
+    def testStaticDirectory(self):
+        r = requests.get("http://localhost:8002/static?fname=.", auth=self.auth_user)
+        self.assertEqual(r.status_code, 404)
+
     def testStaticInvalidNotFound(self):
         r = requests.get("http://localhost:8002/static?fname=nosuchfile.png", auth=self.auth_user)
         self.assertEqual(r.status_code, 404)
@@ -512,6 +1686,283 @@ class WebAppTest(unittest.TestCase):
         r = requests.get('http://localhost:8002/form?form_name=hidden_field', auth=self.auth_user)
         self.assertIn('class="hidden"', r.text)
 
+    def testDynamicFieldsExecutedOnce(self):
+        """Submitting a form should execute its dynamic fields only once"""
+        if os.path.exists('cache_calls.log'):
+            os.unlink('cache_calls.log')
+        data = {
+            "form_name": "dyn_fields",
+            "dyn_string": "a",
+            "dyn_select": "option_b",
+        }
+        r = requests.post("http://localhost:8002/submit", data=data, auth=self.auth_user)
+        self.assertIn('Minimum length is 2', r.text)
+        self.assertIn('selected>Option B', r.text)
+        with open('cache_calls.log', 'r') as fh:
+            calls = fh.read().split()
+        os.unlink('cache_calls.log')
+        self.assertEqual(calls.count('fields'), 1)
+        self.assertEqual(calls.count('options'), 1)
+
+    def testSubmitBatchValidate(self):
+        rows = [
+            {"string": "12345", "integer": "12"},
+            {"string": "12345678", "integer": "9"},
+        ]
+        data = {
+            "form_name": "validate",
+            "rows": "\n".join([json.dumps(row) for row in rows]),
+        }
+        r = requests.post("http://localhost:8002/submit_batch", data=data, auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        results = [json.loads(line) for line in r.text.splitlines()]
+        self.assertEqual(len(results), 2)
+        self.assertNotIn('string', results[0]['errors'])
+        self.assertIn('Maximum length is 7', results[1]['errors']['string'])
+        self.assertIn('Minimum value is 10', results[1]['errors']['integer'])
+        self.assertNotIn('exitcode', results[0])
+
+    def testSubmitBatchLineNumbers(self):
+        """Results report the line each row was on, counting blank lines"""
+        data = {
+            "form_name": "validate",
+            "rows": '\n{"string": "12345"}\n\n{"string": "12345678"}\n',
+        }
+        r = requests.post("http://localhost:8002/submit_batch", data=data, auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        results = [json.loads(line) for line in r.text.splitlines()]
+        self.assertEqual([result['row'] for result in results], [0, 1])
+        self.assertEqual([result['line'] for result in results], [2, 4])
+        self.assertIn('string', results[1]['errors'])
+
+    def testSubmitBatchNonString(self):
+        """JSON numbers and booleans are validated like submitted strings"""
+        rows = [
+            {"string": 12345, "integer": 12, "float": 0.75, "date": 20150101, "checkbox": True},
+            {"string": 12345678, "integer": 9.5, "checkbox": None},
+        ]
+        data = {
+            "form_name": "validate",
+            "rows": "\n".join([json.dumps(row) for row in rows]),
+        }
+        r = requests.post("http://localhost:8002/submit_batch", data=data, auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        results = [json.loads(line) for line in r.text.splitlines()]
+        for field in ('string', 'integer', 'float', 'checkbox'):
+            self.assertNotIn(field, results[0]['errors'])
+        self.assertIn('Invalid date', results[0]['errors']['date'][0])
+        self.assertIn('Maximum length is 7', results[1]['errors']['string'])
+        self.assertIn('Must be an integer number', results[1]['errors']['integer'])
+
+        data['rows'] = '{"string": "12345"}\n{"string": ["12345"]}'
+        r = requests.post("http://localhost:8002/submit_batch", data=data, auth=self.auth_user)
+        self.assertEqual(r.status_code, 400)
+        self.assertIn('line 2', r.text)
+
+    def testSubmitBatchExecute(self):
+        rows = '{"string": "<row1>"}\n\n{"string": "row2"}\n'
+        data = {
+            "form_name": "output_escaped",
+            "execute": "on",
+        }
+        files = {"rows": ("rows.jsonl", rows)}
+        r = requests.post("http://localhost:8002/submit_batch", data=data, files=files, auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        results = [json.loads(line) for line in r.text.splitlines()]
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['exitcode'], 0)
+        self.assertIn('string=<row1>', results[0]['stdout'])
+        self.assertIn('string=row2', results[1]['stdout'])
+
+    def testSubmitBatchInvalidJSON(self):
+        data = {
+            "form_name": "output_escaped",
+            "rows": '{"string": "row1"}\n{"string": ',
+        }
+        r = requests.post("http://localhost:8002/submit_batch", data=data, auth=self.auth_user)
+        self.assertEqual(r.status_code, 400)
+        self.assertIn('line 2', r.text)
+
+    def testSubmitBatchRawExecute(self):
+        data = {
+            "form_name": "output_raw",
+            "execute": "on",
+            "rows": '{"string": "row1"}',
+        }
+        r = requests.post("http://localhost:8002/submit_batch", data=data, auth=self.auth_user)
+        self.assertEqual(r.status_code, 400)
+
+    def testStatus(self):
+        r = requests.get("http://localhost:8002/status", auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('queued', r.json())
+
+    def testAsync(self):
+        data = {
+            "form_name": 'output_async',
+            "string": '<foo>'
+        }
+        r = requests.post('http://localhost:8002/submit', data, auth=self.auth_user)
+        self.assertEqual(r.history[0].status_code, 303)
+        job_id = r.url.split('id=')[1]
+        self.assertIn('Job {0}'.format(job_id), r.text)
+
+        for i in range(50):
+            r = requests.get('http://localhost:8002/job?id={0}'.format(job_id), auth=self.auth_user)
+            if 'Job {0}: done'.format(job_id) in r.text:
+                break
+            time.sleep(0.1)
+        self.assertIn('string=&lt;foo&gt;', r.text)
+
+        r = requests.get('http://localhost:8002/job_result?id={0}'.format(job_id), auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['X-Job-Exitcode'], '0')
+        self.assertIn('string=<foo>', r.text)
+
+        r = requests.get('http://localhost:8002/job?id={0}'.format(job_id), auth=self.auth_admin)
+        self.assertEqual(r.status_code, 403)
+
+    def testAsyncNoSuchJob(self):
+        r = requests.get('http://localhost:8002/job?id=nosuchjob', auth=self.auth_user)
+        self.assertEqual(r.status_code, 404)
+
+    def testStreamCompressed(self):
+        """Compressed output reaches the client while the script runs"""
+        auth = base64.b64encode(b'user:user').decode('ascii')
+        conn = http.client.HTTPConnection('localhost', 8002)
+        start = time.time()
+        conn.request('POST', '/submit', 'form_name=output_stream', {
+            'Authorization': 'Basic {0}'.format(auth),
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Accept-Encoding': 'gzip',
+        })
+        r = conn.getresponse()
+        self.assertEqual(r.getheader('Content-Encoding'), 'gzip')
+        decompressor = zlib.decompressobj(16 + 15)
+        body = b''
+        while b'&lt;first&gt;' not in body:
+            chunk = r.read1()
+            self.assertTrue(chunk)
+            body += decompressor.decompress(chunk)
+        self.assertLess(time.time() - start, 1)
+        body += decompressor.decompress(r.read())
+        self.assertIn(b'Exit code: 2', body)
+        conn.close()
+
+    def testStream(self):
+        """Output should reach the client while the script is still running"""
+        auth = base64.b64encode(b'user:user').decode('ascii')
+        conn = http.client.HTTPConnection('localhost', 8002)
+        start = time.time()
+        conn.request('POST', '/submit', 'form_name=output_stream', {
+            'Authorization': 'Basic {0}'.format(auth),
+            'Content-Type': 'application/x-www-form-urlencoded',
+        })
+        r = conn.getresponse()
+        self.assertEqual(r.status, 200)
+        body = b''
+        while b'&lt;first&gt;' not in body:
+            chunk = r.read1()
+            self.assertTrue(chunk)
+            body += chunk
+        self.assertLess(time.time() - start, 1)
+        body += r.read()
+        conn.close()
+        self.assertIn(b'<pre>&lt;first&gt;\nsecond\n</pre>', body)
+        self.assertIn(b'<span class="error">error\n</span>', body)
+        self.assertIn(b'Exit code: 2', body)
+
+    def testKeepAlive(self):
+        """Multiple requests should be handled over the same connection"""
+        auth = base64.b64encode(b'user:user').decode('ascii')
+        headers = {'Authorization': 'Basic {0}'.format(auth)}
+        conn = http.client.HTTPConnection('localhost', 8002)
+        conn.request('GET', '/', headers=headers)
+        r = conn.getresponse()
+        self.assertEqual(r.status, 200)
+        self.assertEqual(int(r.getheader('Content-Length')), len(r.read()))
+        sock = conn.sock
+
+        # Multipart POST with a streamed (chunked) result page
+        req = requests.Request('POST', 'http://localhost:8002/submit',
+                               data={"form_name": "upload"},
+                               files={"file": ('test.txt', b'hello\n')},
+                               headers=headers).prepare()
+        conn.request('POST', '/submit', req.body, req.headers)
+        r = conn.getresponse()
+        self.assertEqual(r.status, 200)
+        self.assertEqual(r.getheader('Transfer-Encoding'), 'chunked')
+        self.assertIn(b'DIFFERENT', r.read())
+
+        conn.request('GET', '/form?form_name=output_escaped', headers=headers)
+        r = conn.getresponse()
+        self.assertEqual(r.status, 200)
+        r.read()
+        self.assertIs(conn.sock, sock)
+        conn.close()
+
+    def testHTTP10(self):
+        """HTTP/1.0 clients get streamed responses without chunking"""
+        conn = socket.create_connection(('localhost', 8002))
+        auth = base64.b64encode(b'user:user')
+        body = b'form_name=output_escaped&string=foo'
+        conn.sendall(b'POST /submit HTTP/1.0\r\n'
+                     b'Authorization: Basic ' + auth + b'\r\n'
+                     b'Content-Type: application/x-www-form-urlencoded\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                     b'\r\n' + body)
+        response = b''
+        while True:
+            buf = conn.recv(4096)
+            if not buf:
+                break
+            response += buf
+        conn.close()
+        self.assertTrue(response.startswith(b'HTTP/1.1 200'))
+        self.assertNotIn(b'Transfer-Encoding', response)
+        self.assertIn(b'string=foo', response)
+
+    def testListETag(self):
+        r = requests.get("http://localhost:8002/", auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        etag = r.headers['ETag']
+        r = requests.get("http://localhost:8002/", auth=self.auth_user, headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.text, '')
+
+        r = requests.get("http://localhost:8002/", auth=self.auth_user, headers={'If-None-Match': '"other"'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['ETag'], etag)
+        self.assertEqual(r.headers['Cache-Control'], 'private, no-cache')
+
+    def testFormETag(self):
+        r = requests.get("http://localhost:8002/form?form_name=output_escaped", auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        etag = r.headers['ETag']
+        r = requests.get("http://localhost:8002/form?form_name=output_escaped", auth=self.auth_user, headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
+        # Prefilled forms aren't cached
+        r = requests.get("http://localhost:8002/form?form_name=output_escaped&string=foo", auth=self.auth_user, headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('ETag', r.headers)
+        self.assertIn('value="foo"', r.text)
+
+        # Neither are dynamic forms
+        r = requests.get("http://localhost:8002/form?form_name=dyn_fields", auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('ETag', r.headers)
+
+    def testCSS(self):
+        r = requests.get("http://localhost:8002/css")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['Content-Type'], 'text/css; charset=utf-8')
+        self.assertIn('.btn {', r.text)
+        etag = r.headers['ETag']
+
+        r = requests.get("http://localhost:8002/css", headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+
     def testCallbackFail(self):
         data = {
             "form_name": "callback_fail"
@@ -520,17 +1971,138 @@ class WebAppTest(unittest.TestCase):
         self.assertIn('<span class="error">stderr output\n</span>', r.text)
 
 
+class ThreadPoolTest(unittest.TestCase):
+    """
+    Test the thread pool server with connection limits.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.auth_user = requests.auth.HTTPBasicAuth('user', 'user')
+
+        def server_thread(sf):
+            sf.run(listen_port=8005, threads=2, timeout=1, max_connections=3)
+        cls.sf = scriptform.ScriptForm('test_webapp.json')
+
+        thread = threading.Thread(target=server_thread, args=(cls.sf,))
+        thread.start()
+
+        while True:
+            time.sleep(0.1)
+            if cls.sf.running is True:
+                break
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sf.shutdown()
+        while True:
+            time.sleep(0.1)
+            if cls.sf.running is False:
+                break
+
+    def testRequests(self):
+        for i in range(5):
+            r = requests.get('http://localhost:8005/', auth=self.auth_user)
+            self.assertEqual(r.status_code, 200)
+        data = {"form_name": "output_raw", "string": "<foo>"}
+        r = requests.post('http://localhost:8005/submit', data, auth=self.auth_user)
+        self.assertIn('string=<foo>', r.text)
+
+    def testTimeout(self):
+        """Idle connections are closed"""
+        conn = socket.create_connection(('localhost', 8005))
+        conn.settimeout(5)
+        start = time.time()
+        self.assertEqual(conn.recv(1024), b'')
+        self.assertLess(time.time() - start, 3)
+        conn.close()
+
+    def testMaxConnections(self):
+        """Connections beyond the maximum get a 503"""
+        conns = [socket.create_connection(('localhost', 8005)) for i in range(3)]
+        time.sleep(0.2)
+        conn = socket.create_connection(('localhost', 8005))
+        conn.settimeout(5)
+        self.assertIn(b'503 Service Unavailable', conn.recv(1024))
+        conn.close()
+        for conn in conns:
+            conn.close()
+        time.sleep(1.5)
+        r = requests.get('http://localhost:8005/', auth=self.auth_user)
+        self.assertEqual(r.status_code, 200)
+
+
+class WorkersTest(unittest.TestCase):
+    """
+    Test running Scriptform with multiple worker processes.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.auth_user = requests.auth.HTTPBasicAuth('user', 'user')
+        cls.proc = subprocess.Popen([sys.executable, '../src/scriptform.py',
+                                     '-f', '-p', '8004', '-w', '2',
+                                     '--log-file', 'test.log',
+                                     'test_webapp.json'])
+        for i in range(50):
+            time.sleep(0.1)
+            if len(cls.get_workers()) == 2:
+                break
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.proc.poll() is None:
+            cls.proc.kill()
+            cls.proc.wait()
+
+    @classmethod
+    def get_workers(cls):
+        path = '/proc/{0}/task/{0}/children'.format(cls.proc.pid)
+        with open(path, 'r') as fh:
+            return [int(pid) for pid in fh.read().split()]
+
+    def testWorkers(self):
+        for i in range(4):
+            r = requests.get('http://localhost:8004/', auth=self.auth_user)
+            self.assertEqual(r.status_code, 200)
+
+        # Jobs submitted to one worker can be viewed through the others
+        r = requests.post('http://localhost:8004/submit', {"form_name": 'output_async', "string": 'foo'}, auth=self.auth_user)
+        job_id = r.url.split('id=')[1]
+        for i in range(4):
+            r = requests.get('http://localhost:8004/job?id={0}'.format(job_id), auth=self.auth_user)
+            self.assertEqual(r.status_code, 200)
+
+        # Workers that die are restarted
+        workers = self.get_workers()
+        os.kill(workers[0], signal.SIGKILL)
+        for i in range(30):
+            time.sleep(0.1)
+            new_workers = self.get_workers()
+            if len(new_workers) == 2 and workers[0] not in new_workers:
+                break
+        self.assertEqual(len(new_workers), 2)
+        self.assertNotIn(workers[0], new_workers)
+
+        # SIGTERM stops the master and its workers
+        self.proc.send_signal(signal.SIGTERM)
+        self.assertEqual(self.proc.wait(timeout=5), 0)
+        for pid in new_workers:
+            self.assertFalse(os.path.exists('/proc/{0}/cmdline'.format(pid)) and
+                             open('/proc/{0}/cmdline'.format(pid)).read())
+
+
 class WebAppSingleTest(unittest.TestCase):
     """
     Test that Scriptform doesn't show us a list of forms, but directly shows us
     the form is there's only one.
     """
+    engine = 'threads'
+
     @classmethod
     def setUpClass(cls):
         # Run the server in a thread, so we can execute the tests in the main
         # program.
         def server_thread(sf):
-            sf.run(listen_port=8002)
+            sf.run(listen_port=8002, engine=cls.engine)
         cls.sf = scriptform.ScriptForm('test_webapp_singleform.json')
 
         thread = threading.Thread(target=server_thread, args=(cls.sf,))
@@ -563,6 +2135,96 @@ class WebAppSingleTest(unittest.TestCase):
         self.assertEqual(r.status_code, 501)
 
 
+class AsyncWebAppTest(WebAppTest):
+    """
+    Run the web app tests against the asyncio engine.
+    """
+    engine = 'asyncio'
+
+    def testConcurrent(self):
+        """Running scripts don't need a thread each"""
+        self.assertIsInstance(self.sf.httpd, webserver.AsyncHTTPServer)
+        auth = base64.b64encode(b'user:user').decode('ascii')
+        nr_of_threads = threading.active_count()
+        start = time.time()
+        conns = []
+        for i in range(10):
+            conn = http.client.HTTPConnection('localhost', 8002)
+            conn.request('POST', '/submit', 'form_name=output_stream', {
+                'Authorization': 'Basic {0}'.format(auth),
+                'Content-Type': 'application/x-www-form-urlencoded',
+            })
+            conns.append(conn)
+        time.sleep(0.5)
+        self.assertEqual(threading.active_count(), nr_of_threads)
+        for conn in conns:
+            r = conn.getresponse()
+            self.assertIn(b'Exit code: 2', r.read())
+            conn.close()
+        self.assertLess(time.time() - start, 3)
+
+    def testStalledUploads(self):
+        """Stalled uploads don't hold up other requests and time out"""
+        auth = base64.b64encode(b'user:user').decode('ascii')
+        request = (
+            'POST /submit HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'Authorization: Basic {0}\r\n'
+            'Content-Type: multipart/form-data; boundary=xxBOUNDARYxx\r\n'
+            'Content-Length: 1000000\r\n\r\n'
+        ).format(auth).encode('ascii')
+        request_timeout = self.sf.httpd.request_timeout
+        self.sf.httpd.request_timeout = 1
+        socks = []
+        try:
+            for i in range(webserver.AsyncHTTPServer.body_threads + 4):
+                sock = socket.create_connection(('localhost', 8002))
+                sock.sendall(request)
+                socks.append(sock)
+            time.sleep(0.2)
+            # Checking the admin's password requires a thread
+            r = requests.get('http://localhost:8002/', auth=self.auth_admin,
+                             timeout=2)
+            self.assertEqual(r.status_code, 200)
+            for sock in socks:
+                sock.settimeout(5)
+                try:
+                    self.assertEqual(sock.recv(4096), b'')
+                except ConnectionResetError:
+                    pass
+        finally:
+            self.sf.httpd.request_timeout = request_timeout
+            for sock in socks:
+                sock.close()
+
+    def testDynamicFieldsNotBlocking(self):
+        """Dynamic fields don't block other requests while they're resolved"""
+        url = "http://localhost:8002/form?form_name=dyn_fields"
+        os.environ['CACHE_SLEEP'] = '1'
+        try:
+            thread = threading.Thread(target=requests.get, args=(url,),
+                                      kwargs={'auth': self.auth_user})
+            thread.start()
+            time.sleep(0.3)
+            start = time.time()
+            r = requests.get("http://localhost:8002/css")
+            duration = time.time() - start
+            thread.join()
+        finally:
+            del os.environ['CACHE_SLEEP']
+            if os.path.exists('cache_calls.log'):
+                os.unlink('cache_calls.log')
+        self.assertEqual(r.status_code, 200)
+        self.assertLess(duration, 0.5)
+
+
+class AsyncWebAppSingleTest(WebAppSingleTest):
+    """
+    Run the single form tests against the asyncio engine.
+    """
+    engine = 'asyncio'
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.FATAL,
                         format='%(asctime)s:%(name)s:%(levelname)s:%(message)s',
@@ -575,6 +2237,8 @@ if __name__ == '__main__':
     sys.path.insert(0, '../src')
     import scriptform
     import runscript
+    import jobs
+    import webserver
     unittest.main(exit=True)
 
     cov.stop()
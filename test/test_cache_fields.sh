@@ -0,0 +1,26 @@
+#!/bin/sh
+
+#
+# Dynamic fields script that records each invocation, so tests can count how
+# often it was executed.
+#
+
+echo "fields" >> cache_calls.log
+sleep ${CACHE_SLEEP:-0}
+
+cat << EOF2
+[
+    {
+        "name": "dyn_string",
+        "title": "A dynamic string",
+        "type": "string",
+        "minlen": 2
+    },
+    {
+        "name": "dyn_select",
+        "title": "A dynamic select",
+        "type": "select",
+        "options_from": "test_cache_options.sh"
+    }
+]
+EOF2
@@ -0,0 +1,10 @@
+#!/bin/sh
+
+echo "options" >> cache_calls.log
+
+cat << EOF2
+[
+    ["option_a", "Option A"],
+    ["option_b", "Option B"]
+]
+EOF2
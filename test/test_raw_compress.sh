@@ -0,0 +1,13 @@
+#!/bin/sh
+
+#
+# Script with raw output that writes a complete HTTP response.
+#
+
+printf 'HTTP/1.0 200 OK\r\n'
+printf 'Content-Type: text/plain\r\n'
+printf 'Content-Length: 2200\r\n'
+printf '\r\n'
+for i in $(seq 200); do
+    printf 'raw output\n'
+done
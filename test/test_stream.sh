@@ -0,0 +1,12 @@
+#!/bin/sh
+
+#
+# Script that writes output with a pause in between, to test that the output
+# is streamed to the client while the script runs.
+#
+
+echo "<first>"
+sleep 1
+echo "second"
+echo "error" >&2
+exit 2